@@ -0,0 +1,82 @@
+from collections import deque
+import asyncio
+import base64
+import hashlib
+import hmac
+import math
+import random
+import time
+
+from fastapi.responses import PlainTextResponse
+import fastapi
+
+
+class FakeUpstream:
+    # local stand-in for Synthesia /crypto/sign with its sliding window quota, latency and failures
+    def __init__(
+        self,
+        limit: int = 10,
+        window: float = 60,
+        latency: float = 0.2,
+        latency_jitter: float = 0.05,
+        error_rate: float = 0.0,
+        secret: str = "benchmark",
+    ) -> None:
+        self._limit = limit
+        self._window = window
+        self._latency = latency
+        self._latency_jitter = latency_jitter
+        self._error_rate = error_rate
+        self._secret = secret.encode("utf-8")
+        # calls counted against the quota, rejected calls are not
+        self._window_calls: deque[float] = deque()
+        self.accepted: list[float] = []
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @property
+    def window(self) -> float:
+        return self._window
+
+    def sign(self, message: str) -> str:
+        digest = hmac.new(self._secret, message.encode("utf-8"), hashlib.sha256).digest()
+        return base64.b64encode(digest).decode("ascii")
+
+    def _reserve(self) -> float | None:
+        # returns seconds until the next slot frees if the quota is exhausted
+        now = time.monotonic()
+        while self._window_calls and self._window_calls[0] <= now - self._window:
+            self._window_calls.popleft()
+        if len(self._window_calls) >= self._limit:
+            return self._window_calls[0] + self._window - now
+        self._window_calls.append(now)
+        return None
+
+    async def _handle_sign(self, message: str) -> PlainTextResponse:
+        retry_after = self._reserve()
+        if retry_after is not None:
+            self.rejected += 1
+            return PlainTextResponse(
+                "Too Many Requests",
+                status_code=fastapi.status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+        await asyncio.sleep(max(0.0, random.gauss(self._latency, self._latency_jitter)))
+        if random.random() < self._error_rate:
+            self.failed += 1
+            return PlainTextResponse("Bad Gateway", status_code=fastapi.status.HTTP_502_BAD_GATEWAY)
+        self.accepted.append(time.time())
+        return PlainTextResponse(self.sign(message))
+
+    def create_app(self) -> fastapi.FastAPI:
+        app = fastapi.FastAPI(title="Fake Synthesia API")
+
+        @app.get("/crypto/sign")
+        async def sign(message: str) -> PlainTextResponse:
+            return await self._handle_sign(message)
+
+        return app
@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RequestRecord:
+    sent_at: float
+    latency: float
+    http_status: int
+    # status of the sign response body, 200 signed, 202 queued
+    status: int | None = None
+    request_id: str | None = None
+    # time the result was received by polling, set when benchmarking without webhooks
+    completed_at: float | None = None
+
+
+def steady_profile(rate: float, duration: float) -> list[float]:
+    # send offsets in seconds, evenly spaced
+    return [i / rate for i in range(int(rate * duration))]
+
+
+def bursty_profile(burst_size: int, burst_interval: float, bursts: int) -> list[float]:
+    # bursts of requests sent at once, burst_interval seconds apart
+    return [burst * burst_interval for burst in range(bursts) for _ in range(burst_size)]
+
+
+def messages(count: int, duplicate_ratio: float, hot_messages: int = 10) -> list[str]:
+    # duplicate_ratio of the messages are drawn from a small hot set, exercises cache and coalescing
+    return [
+        f"benchmark-hot-{random.randrange(hot_messages)}" if random.random() < duplicate_ratio else f"benchmark-{i}"
+        for i in range(count)
+    ]
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        api_url: str,
+        api_key: str,
+        webhook_url: str | None = None,
+        poll_wait: float = 30,
+        timeout: float = 130,
+    ) -> None:
+        self._api_url = api_url
+        self._api_key = api_key
+        # without webhook queued results are long polled from /crypto/sign/{request_id}
+        self._webhook_url = webhook_url
+        self._poll_wait = poll_wait
+        self._client = httpx.AsyncClient(
+            base_url=api_url,
+            headers={"Authorization": api_key},
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=100),
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def run(self, offsets: list[float], messages: list[str]) -> list[RequestRecord]:
+        start = time.time()
+        return list(
+            await asyncio.gather(
+                *(self._send(start + offset, message) for offset, message in zip(offsets, messages, strict=True))
+            )
+        )
+
+    async def _send(self, send_at: float, message: str) -> RequestRecord:
+        await asyncio.sleep(max(0.0, send_at - time.time()))
+        params = {"message": message}
+        if self._webhook_url is not None:
+            params["webhook_url"] = self._webhook_url
+        sent_at = time.time()
+        try:
+            response = await self._client.get("/crypto/sign", params=params)
+        except httpx.HTTPError as e:
+            logger.error(f"Benchmark request failed: {e}")
+            return RequestRecord(sent_at=sent_at, latency=time.time() - sent_at, http_status=0)
+        record = RequestRecord(sent_at=sent_at, latency=time.time() - sent_at, http_status=response.status_code)
+        if response.is_success:
+            body = response.json()
+            record.status = body.get("status")
+            record.request_id = body.get("request_id")
+            if record.status == 200:
+                record.completed_at = sent_at + record.latency
+            elif self._webhook_url is None and record.request_id is not None:
+                record.completed_at = await self._poll(record.request_id)
+        return record
+
+    async def _poll(self, request_id: str) -> float | None:
+        while True:
+            try:
+                response = await self._client.get(f"/crypto/sign/{request_id}", params={"wait": self._poll_wait})
+            except httpx.HTTPError as e:
+                logger.error(f"Polling result of {request_id} failed: {e}")
+                return None
+            if not response.is_success:
+                return None
+            if response.json().get("status") != 202:
+                return time.time()
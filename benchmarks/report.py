@@ -0,0 +1,90 @@
+from collections import Counter
+from typing import Any
+import math
+
+from benchmarks.fake_upstream import FakeUpstream
+from benchmarks.load import RequestRecord
+from benchmarks.webhook_sink import WebhookSink
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    # nearest rank percentile
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _summary(values: list[float]) -> dict[str, float | None]:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+def build_report(
+    records: list[RequestRecord],
+    upstream: FakeUpstream,
+    sink: WebhookSink | None,
+) -> dict[str, Any]:
+    sent_at = {record.request_id: record.sent_at for record in records if record.request_id is not None}
+    completed_at = {
+        record.request_id: record.completed_at
+        for record in records
+        if record.request_id is not None and record.completed_at is not None
+    }
+    if sink is not None:
+        # webhook arrival counts for queued requests and for requests signed synchronously
+        for request_id, (arrived_at, _) in sink.arrivals.items():
+            if request_id in sent_at:
+                completed_at[request_id] = arrived_at
+    start = min((record.sent_at for record in records), default=0)
+    end = max([*completed_at.values(), *(record.sent_at + record.latency for record in records)], default=start)
+    elapsed = max(end - start, 1e-9)
+    # a sliding window allows at most limit calls per started window
+    capacity = upstream.limit * max(1, math.ceil(elapsed / upstream.window))
+    return {
+        "requests": len(records),
+        "elapsed": elapsed,
+        "completed": len(completed_at),
+        "throughput": len(completed_at) / elapsed,
+        "http_status": dict(Counter(record.http_status for record in records)),
+        "response_status": dict(Counter(record.status for record in records if record.status is not None)),
+        "api_latency": _summary([record.latency for record in records]),
+        "time_to_result": _summary([completed_at[request_id] - sent_at[request_id] for request_id in completed_at]),
+        "webhook_deliveries": None if sink is None else sink.deliveries,
+        "webhook_duplicates": None if sink is None else sink.duplicates,
+        "upstream": {
+            "accepted": len(upstream.accepted),
+            "rejected": upstream.rejected,
+            "failed": upstream.failed,
+            "capacity": capacity,
+            "utilisation": len(upstream.accepted) / capacity,
+        },
+    }
+
+
+def _format_seconds(value: float | None) -> str:
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def format_report(report: dict[str, Any]) -> str:
+    lines = [
+        f"requests           {report['requests']} in {report['elapsed']:.2f}s",
+        f"completed          {report['completed']} ({report['throughput']:.2f}/s)",
+        f"http status        {report['http_status']}",
+        f"response status    {report['response_status']}",
+    ]
+    for name in ("api_latency", "time_to_result"):
+        summary = report[name]
+        lines.append(f"{name:<19}" + " ".join(f"{key} {_format_seconds(value)}" for key, value in summary.items()))
+    if report["webhook_deliveries"] is not None:
+        lines.append(f"webhook deliveries {report['webhook_deliveries']}, duplicates {report['webhook_duplicates']}")
+    upstream = report["upstream"]
+    lines.append(
+        f"upstream           accepted {upstream['accepted']}, rejected {upstream['rejected']}, "
+        f"failed {upstream['failed']}, utilisation {upstream['utilisation']:.0%} of {upstream['capacity']}"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+import fastapi
+import uvicorn
+
+from benchmarks.fake_upstream import FakeUpstream
+from benchmarks.load import LoadGenerator, bursty_profile, messages, steady_profile
+from benchmarks.report import build_report, format_report
+from benchmarks.webhook_sink import WebhookSink
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark of the signing API against a local fake Synthesia upstream. "
+        "Start the API with SYNTHESIA_BASE_URL pointing at the fake upstream.",
+    )
+    parser.add_argument("--api-url", default="http://localhost:8000")
+    parser.add_argument("--api-key", default=os.getenv("SYNTHESIA_API_KEY", ""))
+    parser.add_argument("--host", default="0.0.0.0", help="interface the fake upstream and webhook sink listen on")
+    parser.add_argument("--upstream-port", type=int, default=8081)
+    parser.add_argument("--sink-port", type=int, default=8082)
+    parser.add_argument(
+        "--webhook-url",
+        default="http://host.docker.internal:8082/",
+        help="webhook sink url as seen from the API",
+    )
+    parser.add_argument("--no-webhook", action="store_true", help="long poll queued results instead of webhooks")
+    parser.add_argument("--serve-only", action="store_true", help="only run fake upstream and webhook sink")
+    # fake upstream
+    parser.add_argument("--upstream-limit", type=int, default=10)
+    parser.add_argument("--upstream-window", type=float, default=60)
+    parser.add_argument("--upstream-latency", type=float, default=0.2)
+    parser.add_argument("--upstream-latency-jitter", type=float, default=0.05)
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0)
+    # load
+    parser.add_argument("--profile", choices=("steady", "bursty"), default="steady")
+    parser.add_argument("--rate", type=float, default=1, help="steady: requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="steady: seconds")
+    parser.add_argument("--burst-size", type=int, default=30, help="bursty: requests per burst")
+    parser.add_argument("--burst-interval", type=float, default=30, help="bursty: seconds between bursts")
+    parser.add_argument("--bursts", type=int, default=2)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="share of messages from a small hot set")
+    parser.add_argument("--drain-timeout", type=float, default=600, help="seconds to wait for outstanding results")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    return parser.parse_args()
+
+
+async def serve(app: fastapi.FastAPI, host: str, port: int) -> tuple[uvicorn.Server, asyncio.Task[None]]:
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+async def drain(sink: WebhookSink, request_ids: set[str], timeout: float) -> None:
+    # wait until the sink received a result for every accepted request
+    deadline = time.time() + timeout
+    while not request_ids.issubset(sink.arrivals) and time.time() < deadline:
+        await asyncio.sleep(0.5)
+    missing = len(request_ids - sink.arrivals.keys())
+    if missing:
+        logger.warning(f"{missing} webhooks did not arrive within {timeout} seconds")
+
+
+async def main() -> None:
+    args = parse_args()
+    upstream = FakeUpstream(
+        limit=args.upstream_limit,
+        window=args.upstream_window,
+        latency=args.upstream_latency,
+        latency_jitter=args.upstream_latency_jitter,
+        error_rate=args.upstream_error_rate,
+    )
+    sink = None if args.no_webhook else WebhookSink()
+    servers = [await serve(upstream.create_app(), args.host, args.upstream_port)]
+    if sink is not None:
+        servers.append(await serve(sink.create_app(), args.host, args.sink_port))
+    try:
+        if args.serve_only:
+            await asyncio.gather(*(task for _, task in servers))
+            return
+        if args.profile == "steady":
+            offsets = steady_profile(args.rate, args.duration)
+        else:
+            offsets = bursty_profile(args.burst_size, args.burst_interval, args.bursts)
+        load_generator = LoadGenerator(
+            args.api_url,
+            args.api_key,
+            webhook_url=None if sink is None else args.webhook_url,
+        )
+        try:
+            records = await load_generator.run(offsets, messages(len(offsets), args.duplicate_ratio))
+        finally:
+            await load_generator.close()
+        if sink is not None:
+            accepted = {record.request_id for record in records if record.request_id and record.status in (200, 202)}
+            await drain(sink, accepted, args.drain_timeout)
+        report = build_report(records, upstream, sink)
+        print(format_report(report))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+    finally:
+        for server, task in servers:
+            server.should_exit = True
+            await task
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(main())
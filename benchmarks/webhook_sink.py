@@ -0,0 +1,37 @@
+from typing import Any
+import time
+
+import fastapi
+
+
+class WebhookSink:
+    # records when the result of each request arrives, accepts single and batched deliveries
+    def __init__(self) -> None:
+        # request id -> (arrival time, result status) of the first delivery
+        self.arrivals: dict[str, tuple[float, int | None]] = {}
+        self.deliveries = 0
+        self.duplicates = 0
+
+    def _record(self, result: dict[str, Any], arrived_at: float) -> str | None:
+        request_id = result.get("request_id")
+        if request_id is None:
+            return None
+        if request_id in self.arrivals:
+            self.duplicates += 1
+        else:
+            self.arrivals[request_id] = (arrived_at, result.get("status"))
+        return request_id
+
+    def create_app(self) -> fastapi.FastAPI:
+        app = fastapi.FastAPI(title="Benchmark webhook sink")
+
+        @app.post("/")
+        async def receive(request: fastapi.Request) -> dict[str, Any]:
+            arrived_at = time.time()
+            body = await request.json()
+            results = body if isinstance(body, list) else [body]
+            self.deliveries += 1
+            acknowledged = [self._record(result, arrived_at) for result in results if isinstance(result, dict)]
+            return {"acknowledged": [request_id for request_id in acknowledged if request_id is not None]}
+
+        return app
@@ -8,6 +8,27 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
+def parse_weights(value: str) -> dict[str, float]:
+    weights = {}
+    for item in value.split(","):
+        if item.strip():
+            user_id, weight = item.split(":")
+            weights[user_id.strip()] = float(weight)
+    return weights
+
+
+class LoggingConfig:
+    def __init__(self) -> None:
+        self.level = os.getenv("LOG_LEVEL", "INFO").upper()
+        self.dir = os.getenv("LOG_DIR", "logs")
+        # one JSON object per line instead of plain text
+        self.json = os.getenv("LOG_JSON", "false").lower() == "true"
+        # share of per request debug lines that are logged
+        self.debug_sample_rate = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1"))
+        # console and file writes happen on a background thread instead of the event loop
+        self.use_queue = os.getenv("LOG_QUEUE", "true").lower() == "true"
+
+
 @dataclass
 class InterfaceConfig:
     api_key: str | None
@@ -18,7 +39,165 @@ class SynthesiaAPIConfig(InterfaceConfig):
         self.api_key = os.getenv("SYNTHESIA_API_KEY")
         if not self.api_key:
             raise ValueError("SYNTHESIA_API_KEY not found in environment variables")
-        self.base_url = "https://hiring.api.synthesia.io"
+        # overridden f.e. to point at the local fake upstream of the benchmarks
+        self.base_url = os.getenv("SYNTHESIA_BASE_URL", "https://hiring.api.synthesia.io")
         self.sign_endpoint = "/crypto/sign"
         self.verify_endpoint = "/crypto/verify"
         self.timeout = 108  # 1.8 minutes to be within the 2 minute limit
+        self.connect_timeout = float(os.getenv("SYNTHESIA_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = float(os.getenv("SYNTHESIA_READ_TIMEOUT", str(self.timeout)))
+        # pooled keep-alive connections shared by all upstream calls of the process
+        self.max_connections = int(os.getenv("SYNTHESIA_MAX_CONNECTIONS", "20"))
+        self.keepalive_expiry = float(os.getenv("SYNTHESIA_KEEPALIVE_EXPIRY", "60"))
+        # requires the optional h2 package
+        self.http2 = os.getenv("SYNTHESIA_HTTP2", "false").lower() == "true"
+        # PEM public key of the upstream signing key, signatures are verified locally with it instead of upstream.
+        # requires the optional cryptography package
+        self.public_key = os.getenv("SYNTHESIA_PUBLIC_KEY")
+        public_key_file = os.getenv("SYNTHESIA_PUBLIC_KEY_FILE")
+        if not self.public_key and public_key_file:
+            with open(public_key_file) as f:
+                self.public_key = f.read()
+
+
+class RedisConfig:
+    def __init__(self) -> None:
+        self.url = os.getenv("REDIS_URL", "redis://redis:6379/0")
+        # shared by requests and background tasks, every blocked queue worker, webhook sender and pubsub
+        # listener holds a connection. requests wait up to pool_timeout for a free one instead of failing
+        self.max_connections = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+        self.pool_timeout = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+        self.socket_timeout = float(os.getenv("REDIS_SOCKET_TIMEOUT", "10"))
+        self.socket_connect_timeout = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+        self.retry_on_timeout = os.getenv("REDIS_RETRY_ON_TIMEOUT", "true").lower() == "true"
+        self.health_check_interval = float(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+        # server assisted invalidation of the in process signature cache and api key registry
+        self.client_tracking = os.getenv("REDIS_CLIENT_TRACKING", "false").lower() == "true"
+        # blocking commands must return before the socket timeout
+        self.max_block = self.socket_timeout / 2
+
+
+class AuthConfig:
+    def __init__(self) -> None:
+        # api keys are read from this JSON file and the api_keys redis hash
+        self.api_keys_file = os.getenv("API_KEYS_FILE")
+        self.redis_key = "api_keys"
+        # SYNTHESIA_API_KEY is accepted as client key of user 1
+        self.allow_legacy_key = os.getenv("API_KEYS_ALLOW_LEGACY", "true").lower() == "true"
+        self.refresh_interval = float(os.getenv("API_KEYS_REFRESH_INTERVAL", "30"))
+        # requests per window of keys without own quota, 0 is unlimited
+        self.default_quota = int(os.getenv("API_KEY_DEFAULT_QUOTA", "0"))
+        self.quota_window = float(os.getenv("API_KEY_QUOTA_WINDOW", "60"))
+        # fair scheduling weight of each key priority class, f.e. "high:4,normal:1,low:0.25"
+        self.priority_weights = parse_weights(os.getenv("API_KEY_PRIORITY_WEIGHTS", "high:4,normal:1,low:0.25"))
+
+
+class SyncConfig:
+    def __init__(self) -> None:
+        # time budget of a /crypto/sign request, once spent it is answered with 202 and completed in the background
+        self.deadline = float(os.getenv("SIGN_DEADLINE", "2"))
+        # part of the deadline kept back to queue the request and respond in time
+        self.deadline_reserve = float(os.getenv("SIGN_DEADLINE_RESERVE", "0.2"))
+
+
+class RateLimiterConfig:
+    def __init__(self) -> None:
+        # upstream quota, the adaptive budget probes up to it but never above
+        self.limit = int(os.getenv("RATE_LIMIT", "10"))
+        self.window = float(os.getenv("RATE_LIMIT_WINDOW", "60"))
+        # AIMD: an upstream 429 multiplies the budget by decrease_factor,
+        # every full window of successful calls adds increase calls back
+        self.min_limit = int(os.getenv("RATE_LIMIT_MIN", "1"))
+        self.increase = float(os.getenv("RATE_LIMIT_INCREASE", "1"))
+        self.decrease_factor = float(os.getenv("RATE_LIMIT_DECREASE_FACTOR", "0.5"))
+
+
+class QueueConfig:
+    def __init__(self) -> None:
+        self.name = "sign_requests"
+        # concurrent workers per process, all of them share the global upstream rate limit
+        self.workers = int(os.getenv("QUEUE_WORKERS", "1"))
+        # claimed request is re-delivered if not completed within this time (seconds)
+        self.visibility_timeout = float(os.getenv("QUEUE_VISIBILITY_TIMEOUT", "300"))
+        self.upstream_api_max_retries = 3
+        # fair scheduling weights between users, f.e. "1:5,2:1", users not listed get weight 1
+        self.user_weights = parse_weights(os.getenv("QUEUE_USER_WEIGHTS", ""))
+        # optional cap on upstream calls per user and minute, 0 disables it
+        self.per_user_rate_limit = int(os.getenv("QUEUE_PER_USER_RATE_LIMIT", "0"))
+        # users checked for due requests per scheduling decision, a random sample when more are queued
+        self.scheduling_sample = int(os.getenv("QUEUE_SCHEDULING_SAMPLE", "100"))
+        # most messages accepted by one /crypto/sign/batch request
+        self.batch_max_size = int(os.getenv("SIGN_BATCH_MAX_SIZE", "1000"))
+        # admission control, requests over these queued totals are rejected with Retry-After, 0 disables
+        self.max_depth = int(os.getenv("QUEUE_MAX_DEPTH", "10000"))
+        self.max_user_depth = int(os.getenv("QUEUE_MAX_USER_DEPTH", "1000"))
+        # encoding of queued requests, json (orjson if installed) or msgpack
+        self.codec = os.getenv("QUEUE_CODEC", "json")
+
+
+class DeadLetterConfig:
+    def __init__(self) -> None:
+        # sign requests out of retries and webhook deliveries out of attempts, kept for inspection and replay
+        self.name = "dead_letters"
+        # share of the upstream budget replayed requests may take, the rest is kept for live traffic
+        self.replay_share = float(os.getenv("DEAD_LETTER_REPLAY_SHARE", "0.2"))
+
+
+class WorkerConfig:
+    def __init__(self) -> None:
+        # the api process runs queue workers and webhook senders itself unless they run in worker.py
+        self.in_api = os.getenv("API_RUN_WORKERS", "true").lower() == "true"
+        # prometheus metrics endpoint of the standalone worker, 0 disables it
+        self.metrics_port = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+
+
+class CacheConfig:
+    def __init__(self) -> None:
+        # shared redis tier expiry (seconds)
+        self.ttl = float(os.getenv("SIGNATURE_CACHE_TTL", "180"))
+        # in process LRU tier in front of redis
+        self.local_size = int(os.getenv("SIGNATURE_CACHE_LOCAL_SIZE", "1024"))
+        self.local_ttl = float(os.getenv("SIGNATURE_CACHE_LOCAL_TTL", "30"))
+        # expiry of verification results of (message, signature) pairs (seconds)
+        self.verified_ttl = float(os.getenv("VERIFIED_CACHE_TTL", "86400"))
+
+
+class PrefetchConfig:
+    def __init__(self) -> None:
+        # hot messages are signed again with upstream budget left unused while the queue is idle
+        self.enabled = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+        # messages whose request counts are tracked per api process
+        self.tracked_messages = int(os.getenv("PREFETCH_TRACKED_MESSAGES", "1000"))
+        # requests a message needs since the last decay to be prefetched
+        self.min_hits = int(os.getenv("PREFETCH_MIN_HITS", "3"))
+        # cached signatures expiring within this many seconds are refreshed
+        self.refresh_before = float(os.getenv("PREFETCH_REFRESH_BEFORE", "30"))
+        # share of the upstream budget always left to live requests
+        self.headroom = float(os.getenv("PREFETCH_HEADROOM", "0.3"))
+        self.interval = float(os.getenv("PREFETCH_INTERVAL", "5"))
+        # request counts are halved this often (seconds), so popularity follows recent traffic
+        self.decay_interval = float(os.getenv("PREFETCH_DECAY_INTERVAL", "300"))
+
+
+class WebhookConfig:
+    def __init__(self) -> None:
+        self.name = "webhooks"
+        # concurrent senders per process sharing one pooled http client
+        self.senders = int(os.getenv("WEBHOOK_SENDERS", "10"))
+        self.per_host_limit = int(os.getenv("WEBHOOK_PER_HOST_LIMIT", "4"))
+        self.timeout = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+        self.max_retries = int(os.getenv("WEBHOOK_MAX_RETRIES", "3"))
+        # retries are scheduled with full jitter up to backoff_base * 2**attempts seconds
+        self.backoff_base = float(os.getenv("WEBHOOK_BACKOFF_BASE", "1"))
+        self.backoff_max = float(os.getenv("WEBHOOK_BACKOFF_MAX", "60"))
+        # results for webhooks registered with webhook_batch=true are sent as one JSON array
+        self.batch_flush_window = float(os.getenv("WEBHOOK_BATCH_FLUSH_WINDOW", "2"))
+        self.batch_max_size = int(os.getenv("WEBHOOK_BATCH_MAX_SIZE", "100"))
+
+
+class ResultConfig:
+    def __init__(self) -> None:
+        # results of queued requests are kept for polling clients (seconds)
+        self.ttl = float(os.getenv("RESULT_TTL", "3600"))
+        # upper bound of the long polling wait on /crypto/sign/{request_id}
+        self.max_wait = float(os.getenv("RESULT_MAX_WAIT", "30"))
@@ -1,15 +1,51 @@
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
 import logging.config
 import os
+import queue
+import random
 
 
-# log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry)
+
+
+class DebugSampleFilter(logging.Filter):
+    # keeps only sample_rate of debug records, per request debug lines would flood the log under bursts
+    def __init__(self, sample_rate: float) -> None:
+        super().__init__()
+        self._sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        # decision is kept on the record, so every handler filtering it agrees
+        sampled = getattr(record, "debug_sampled", None)
+        if sampled is None:
+            sampled = record.debug_sampled = random.random() < self._sample_rate
+        return sampled
 
 
 def setup_logging(
     app_name: str,
-    log_level: str = "DEBUG",
+    log_level: str = "INFO",
     log_dir: str = "logs",
-) -> None:
+    json_format: bool = False,
+    debug_sample_rate: float = 1.0,
+    use_queue: bool = True,
+) -> QueueListener | None:
     """
     Setup logging configuration with both file and console handlers
 
@@ -17,6 +53,10 @@ def setup_logging(
         log_level: Logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
         log_dir: Directory to store log files
         app_name: Application name for log file naming
+        json_format: Log one JSON object per line
+        debug_sample_rate: Share of debug records that are logged
+        use_queue: Write records from a background thread, so console and file I/O never block the event loop.
+            Returns the listener doing the writes, it is stopped and flushed at exit
     """
     # Create logs directory if it doesn't exist
     os.makedirs(log_dir, exist_ok=True)
@@ -28,18 +68,21 @@ def setup_logging(
             "simple": {
                 "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s",
             },
+            "json": {
+                "()": JsonFormatter,
+            },
         },
         "handlers": {
             "console": {
                 "class": "logging.StreamHandler",
                 "level": log_level,
-                "formatter": "simple",
+                "formatter": "json" if json_format else "simple",
                 "stream": "ext://sys.stdout",
             },
             "file": {
                 "class": "logging.handlers.RotatingFileHandler",
                 "level": log_level,
-                "formatter": "simple",
+                "formatter": "json" if json_format else "simple",
                 "filename": os.path.join(log_dir, f"{app_name}.log"),
                 "maxBytes": 10485760,  # 10MB
                 "backupCount": 1,
@@ -51,3 +94,23 @@ def setup_logging(
     }
 
     logging.config.dictConfig(config)
+    root = logging.getLogger()
+    # logger filters don't see records propagated from child loggers, so sampling is done by the front handlers
+    debug_sample = DebugSampleFilter(debug_sample_rate)
+    if not use_queue:
+        for handler in root.handlers:
+            handler.addFilter(debug_sample)
+        return None
+
+    # swap the configured handlers for a queue handler, records are only enqueued on the event loop
+    handlers = root.handlers[:]
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(debug_sample)
+    root.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -4,21 +4,69 @@ import asyncio
 import logging
 import uuid
 
+from fastapi.responses import PlainTextResponse
 from pydantic import HttpUrl
 import fastapi
 import redis.asyncio as redis
 
-from configs.config import SynthesiaAPIConfig
+from configs.config import (
+    LoggingConfig,
+    QueueConfig,
+    RedisConfig,
+    ResultConfig,
+    SyncConfig,
+    SynthesiaAPIConfig,
+    WorkerConfig,
+)
 from configs.logging import setup_logging
-from service.queue import QueueProcessor, RequestProcessingQueue
+from service.admission import AdmissionController
+from service.components import (
+    create_api_keys,
+    create_cache,
+    create_dead_letter_replayer,
+    create_dead_letters,
+    create_invalidation_listener,
+    create_prefetcher,
+    create_queue_processor,
+    create_rate_limiter,
+    create_redis,
+    create_verifier,
+    create_webhook_manager,
+    create_webhook_producer,
+)
+from service.dead_letters import DeadLetterQueue
+from service.models import (
+    CryptoSignBatchRequest,
+    CryptoSignBatchResponse,
+    CryptoVerifyResponse,
+    DeadLetterList,
+    DeadLetterReplayRequest,
+    DeadLetterReplayResponse,
+)
+from service.queue import RequestProcessingQueue
 from service.rate_limiter import RateLimiter
+from service.replay import DeadLetterReplayer
+from service.results import ResultStore
+from service.scheduler import FairScheduler
 from service.service import CryptoSignResponse, Service
+from service.verifier import SignatureVerifier
+from service.webhook_manager import WebhookManager, WebhookProducer
 from upstream.synthesia_api import SynthesiaAPI
-from utils.auth import get_auth_info
+from utils.auth import ApiKeyRegistry, AuthInfo
+from utils.codec import get_codec
 from utils.helpers import RequestHeaders, is_docker
+from utils.metrics import add_collector, render as render_metrics
 
 
-setup_logging(log_level="DEBUG", log_dir="logs", app_name="booking_api")
+logging_config = LoggingConfig()
+setup_logging(
+    app_name="signing_api",
+    log_level=logging_config.level,
+    log_dir=logging_config.dir,
+    json_format=logging_config.json,
+    debug_sample_rate=logging_config.debug_sample_rate,
+    use_queue=logging_config.use_queue,
+)
 logger = logging.getLogger(__name__)
 
 
@@ -28,7 +76,22 @@ class AppState:
         self.config: SynthesiaAPIConfig | None = None
         self.redis_client: redis.Redis | None = None
         self.queue_processor_task: asyncio.Task | None = None
+        self.webhook_manager: WebhookProducer | None = None
+        self.webhook_manager_task: asyncio.Task | None = None
+        self.result_config: ResultConfig | None = None
+        self.queue_config: QueueConfig | None = None
+        self.sync_config: SyncConfig | None = None
+        self.results: ResultStore | None = None
+        self.results_listener_task: asyncio.Task | None = None
         self.rate_limiter: RateLimiter | None = None
+        self.upstream_api: SynthesiaAPI | None = None
+        self.api_keys: ApiKeyRegistry | None = None
+        self.api_keys_task: asyncio.Task | None = None
+        self.invalidation_task: asyncio.Task | None = None
+        self.prefetcher_task: asyncio.Task | None = None
+        self.dead_letters: DeadLetterQueue | None = None
+        self.dead_letter_replayer: DeadLetterReplayer | None = None
+        self.verifier: SignatureVerifier | None = None
 
 
 app_state = AppState()
@@ -39,28 +102,136 @@ async def lifespan(app: fastapi.FastAPI) -> AsyncGenerator[None, None]:
     logger.info("Application startup")
     if not is_docker():
         raise EnvironmentError("This service must be run in a Docker container.")
-    app_state.redis_client = await redis.from_url("redis://redis:6379")
-    app_state.rate_limiter = RateLimiter(app_state.redis_client)
-    queue = RequestProcessingQueue("sign_requests", app_state.redis_client)
+    redis_config = RedisConfig()
+    app_state.redis_client = create_redis(redis_config)
+    app_state.rate_limiter = create_rate_limiter(app_state.redis_client)
+    app_state.queue_config = queue_config = QueueConfig()
+    queue = RequestProcessingQueue(
+        queue_config.name,
+        app_state.redis_client,
+        codec=get_codec(queue_config.codec),
+        scheduling_sample=queue_config.scheduling_sample,
+    )
+    await queue.migrate()
     app_state.config = SynthesiaAPIConfig()
-    upstream_api = SynthesiaAPI(app_state.config)
-    app_state.service = Service(queue, upstream_api, app_state.rate_limiter)
-    queue_processor = QueueProcessor(queue, upstream_api, app_state.rate_limiter)
-    app_state.queue_processor_task = asyncio.create_task(queue_processor.process())
+    app_state.upstream_api = SynthesiaAPI(app_state.config)
+    cache = create_cache(app_state.redis_client, redis_config)
+    app_state.dead_letters = create_dead_letters(app_state.redis_client, queue_config)
+    # senders only run where the queue workers run
+    webhook_manager: WebhookManager | None = None
+    if WorkerConfig().in_api:
+        app_state.webhook_manager = webhook_manager = create_webhook_manager(
+            app_state.redis_client, redis_config, app_state.dead_letters
+        )
+    else:
+        # webhooks are only enqueued here, without the http client and per host state of the senders
+        app_state.webhook_manager = create_webhook_producer(app_state.redis_client)
+    app_state.result_config = ResultConfig()
+    app_state.results = ResultStore(app_state.redis_client, ttl=app_state.result_config.ttl)
+    app_state.dead_letter_replayer = create_dead_letter_replayer(
+        app_state.redis_client,
+        app_state.dead_letters,
+        queue,
+        app_state.results,
+        app_state.rate_limiter,
+    )
+    app_state.sync_config = SyncConfig()
+    # requests are counted where they arrive, so hot messages are prefetched by the api processes
+    prefetcher = create_prefetcher(queue, app_state.upstream_api, app_state.rate_limiter, cache)
+    app_state.verifier = create_verifier(
+        app_state.redis_client,
+        cache,
+        app_state.upstream_api,
+        app_state.rate_limiter,
+        app_state.config,
+    )
+    app_state.service = Service(
+        queue,
+        app_state.upstream_api,
+        app_state.rate_limiter,
+        cache,
+        app_state.webhook_manager,
+        app_state.results,
+        deadline_reserve=app_state.sync_config.deadline_reserve,
+        admission=AdmissionController(
+            queue,
+            app_state.rate_limiter,
+            max_depth=queue_config.max_depth,
+            max_user_depth=queue_config.max_user_depth,
+            # per user cap is per minute
+            user_rate=queue_config.per_user_rate_limit / 60,
+        ),
+        prefetcher=prefetcher,
+    )
+    scheduler = FairScheduler(queue_config.user_weights)
+    app_state.api_keys = create_api_keys(app_state.redis_client, scheduler, queue_config, app_state.config.api_key)
+    await app_state.api_keys.load()
+    # gauges read from redis are refreshed on scrape only
+    add_collector(queue.collect_metrics)
+    add_collector(app_state.rate_limiter.collect_metrics)
+    add_collector(app_state.webhook_manager.collect_metrics)
+    add_collector(app_state.dead_letters.collect_metrics)
+    if webhook_manager is not None:
+        queue_processor = create_queue_processor(
+            app_state.redis_client,
+            redis_config,
+            queue_config,
+            queue,
+            app_state.upstream_api,
+            app_state.rate_limiter,
+            cache,
+            webhook_manager,
+            app_state.results,
+            scheduler,
+            app_state.dead_letters,
+        )
+        app_state.queue_processor_task = asyncio.create_task(queue_processor.process())
+        app_state.webhook_manager_task = asyncio.create_task(webhook_manager.process())
+    else:
+        # only accepts and enqueues, queued requests and webhooks are processed by worker.py
+        logger.info("Queue workers and webhook senders are disabled in the api process")
+    app_state.results_listener_task = asyncio.create_task(app_state.results.listen())
+    app_state.api_keys_task = asyncio.create_task(app_state.api_keys.refresh())
+    if redis_config.client_tracking:
+        invalidation = create_invalidation_listener(app_state.redis_client, cache, app_state.api_keys)
+        app_state.invalidation_task = asyncio.create_task(invalidation.listen())
+    if prefetcher is not None:
+        app_state.prefetcher_task = asyncio.create_task(prefetcher.run())
 
     yield
 
+    await shutdown()
+
+
+async def shutdown() -> None:
     logger.info("Application shutdown")
-    if app_state.queue_processor_task:
-        await app_state.queue_processor_task.cancel()
-        try:
-            await app_state.queue_processor_task
-        except asyncio.CancelledError:
-            logger.info("Queue processor task cancelled")
-        except Exception as e:
-            logger.exception(f"Error while cancelling queue processor: {e}")
+    if app_state.service:
+        await app_state.service.close()
+    if app_state.dead_letter_replayer:
+        # dead letters not replayed yet stay in place
+        await app_state.dead_letter_replayer.close()
+    for task in (
+        app_state.queue_processor_task,
+        app_state.webhook_manager_task,
+        app_state.results_listener_task,
+        app_state.api_keys_task,
+        app_state.invalidation_task,
+        app_state.prefetcher_task,
+    ):
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                logger.info("Background task cancelled")
+            except Exception as e:
+                logger.exception(f"Error while cancelling background task: {e}")
+    if app_state.webhook_manager:
+        await app_state.webhook_manager.close()
+    if app_state.upstream_api:
+        await app_state.upstream_api.close()
     if app_state.redis_client:
-        await app_state.redis_client.close()
+        await app_state.redis_client.aclose()
 
 
 app = fastapi.FastAPI(
@@ -76,10 +247,24 @@ async def root() -> dict[str, Any]:
     return {
         "name": "Reliable Crypto Signing API",
         "status": "operational",
-        "endpoints": ["/crypto/sign"],
+        "endpoints": [
+            "/crypto/sign",
+            "/crypto/sign/batch",
+            "/crypto/sign/{request_id}",
+            "/crypto/verify",
+            "/admin/dead-letters",
+            "/admin/dead-letters/replay",
+            "/metrics",
+        ],
     }
 
 
+@app.get("/metrics", response_class=PlainTextResponse, description="Prometheus metrics")
+async def metrics() -> PlainTextResponse:
+    body, content_type = await render_metrics()
+    return PlainTextResponse(body, media_type=content_type)
+
+
 @app.get(
     "/crypto/sign",
     response_model=CryptoSignResponse,
@@ -93,23 +278,170 @@ async def sign_message(
         Union[HttpUrl, None],
         fastapi.Query(description="URL to notify when signature is ready"),
     ] = None,
+    webhook_batch: Annotated[
+        bool,
+        fastapi.Query(description="Webhook accepts several results as one JSON array"),
+    ] = False,
 ) -> CryptoSignResponse:
-    if not app_state.service or not app_state.config:
+    if not app_state.service or not app_state.api_keys or not app_state.sync_config:
         raise fastapi.HTTPException(
             status_code=500,
             detail="Service not initialized",
         )
 
-    auth_info = get_auth_info(authorization, app_state.config)
+    # the budget starts at entry, so auth and every later stage count against it
+    deadline = asyncio.get_running_loop().time() + app_state.sync_config.deadline
+    auth_info = await app_state.api_keys.authenticate(authorization)
     request_id = str(uuid.uuid4())
     request_headers = RequestHeaders(user_id=auth_info.user_id, request_id=request_id)
-    logger.info(f"Processing request {request_id} for user {auth_info.user_id}")
+    logger.debug("Processing request %s for user %s", request_id, auth_info.user_id)
     return await app_state.service.sign_message(
         request_headers=request_headers,
         message=message,
         background_tasks=background_tasks,
         webhook_url=webhook_url,
+        webhook_batch=webhook_batch,
+        deadline=deadline,
+    )
+
+
+@app.post(
+    "/crypto/sign/batch",
+    response_model=CryptoSignBatchResponse,
+    description="Sign many messages at once, cached signatures are returned right away and the rest is queued",
+)
+async def sign_batch(
+    batch: CryptoSignBatchRequest,
+    background_tasks: fastapi.BackgroundTasks,
+    authorization: Annotated[str, fastapi.Header(description="API Key")],
+) -> CryptoSignBatchResponse:
+    if not app_state.service or not app_state.api_keys or not app_state.queue_config:
+        raise fastapi.HTTPException(
+            status_code=500,
+            detail="Service not initialized",
+        )
+
+    if len(batch.messages) > app_state.queue_config.batch_max_size:
+        raise fastapi.HTTPException(
+            status_code=413,
+            detail=f"Batch exceeds {app_state.queue_config.batch_max_size} messages",
+        )
+    # every message counts against the key quota, a batch over the whole quota is rejected with 413
+    auth_info = await app_state.api_keys.authenticate(authorization, cost=len(batch.messages))
+    request_headers = RequestHeaders(user_id=auth_info.user_id, request_id=str(uuid.uuid4()))
+    items = await app_state.service.sign_batch(
+        request_headers=request_headers,
+        messages=batch.messages,
+        background_tasks=background_tasks,
+        webhook_url=batch.webhook_url,
+        webhook_batch=batch.webhook_batch,
     )
+    return CryptoSignBatchResponse(items=items)
+
+
+@app.get(
+    "/crypto/verify",
+    response_model=CryptoVerifyResponse,
+    description="Verify a signature of a message, locally or from cached results whenever possible",
+)
+async def verify_signature(
+    message: Annotated[str, fastapi.Query(description="Signed message")],
+    signature: Annotated[str, fastapi.Query(description="Signature to verify")],
+    authorization: Annotated[str, fastapi.Header(description="API Key")],
+) -> CryptoVerifyResponse:
+    if not app_state.verifier or not app_state.api_keys or not app_state.sync_config:
+        raise fastapi.HTTPException(
+            status_code=500,
+            detail="Service not initialized",
+        )
+
+    auth_info = await app_state.api_keys.authenticate(authorization)
+    request_id = str(uuid.uuid4())
+    logger.debug("Verifying signature for request %s of user %s", request_id, auth_info.user_id)
+    # an upstream verification waits for a rate limit slot at most for the sign deadline
+    valid = await app_state.verifier.verify(request_id, message, signature, timeout=app_state.sync_config.deadline)
+    return CryptoVerifyResponse(request_id=request_id, valid=valid)
+
+
+@app.get(
+    "/crypto/sign/{request_id}",
+    response_model=CryptoSignResponse,
+    description="Get the result of a queued signing request, optionally waiting for it to complete",
+)
+async def get_sign_result(
+    request_id: str,
+    authorization: Annotated[str, fastapi.Header(description="API Key")],
+    wait: Annotated[
+        float,
+        fastapi.Query(ge=0, description="Seconds to wait for the result if it is not ready yet"),
+    ] = 0,
+) -> CryptoSignResponse:
+    if not app_state.results or not app_state.api_keys or not app_state.result_config:
+        raise fastapi.HTTPException(
+            status_code=500,
+            detail="Service not initialized",
+        )
+
+    # polling doesn't count against the key quota
+    auth_info = await app_state.api_keys.authenticate(authorization, cost=0)
+    # results of other users are not found, so request ids can't be probed across users
+    response = await app_state.results.wait(
+        request_id, min(wait, app_state.result_config.max_wait), user_id=auth_info.user_id
+    )
+    if response is None:
+        raise fastapi.HTTPException(status_code=404, detail="Request not found")
+    return response
+
+
+async def authenticate_admin(authorization: str) -> AuthInfo:
+    if not app_state.api_keys:
+        raise fastapi.HTTPException(status_code=500, detail="Service not initialized")
+    # admin calls don't count against the key quota
+    auth_info = await app_state.api_keys.authenticate(authorization, cost=0)
+    if not auth_info.admin:
+        raise fastapi.HTTPException(status_code=403, detail="API key is not allowed to administer the service")
+    return auth_info
+
+
+@app.get(
+    "/admin/dead-letters",
+    response_model=DeadLetterList,
+    description="List sign requests and webhook deliveries given up after their last attempt, oldest first",
+)
+async def list_dead_letters(
+    authorization: Annotated[str, fastapi.Header(description="API Key")],
+    offset: Annotated[int, fastapi.Query(ge=0)] = 0,
+    limit: Annotated[int, fastapi.Query(ge=1, le=1000)] = 100,
+) -> DeadLetterList:
+    await authenticate_admin(authorization)
+    if not app_state.dead_letters:
+        raise fastapi.HTTPException(status_code=500, detail="Service not initialized")
+
+    depth, dead_letter_ids = await asyncio.gather(
+        app_state.dead_letters.depth(),
+        app_state.dead_letters.ids(offset, limit),
+    )
+    items = await app_state.dead_letters.get_many(dead_letter_ids)
+    return DeadLetterList(depth=depth, items=[dict(item) for item in items])
+
+
+@app.post(
+    "/admin/dead-letters/replay",
+    response_model=DeadLetterReplayResponse,
+    status_code=202,
+    description="Replay dead letters in the background, requests are paced to a share of the upstream budget",
+)
+async def replay_dead_letters(
+    replay: DeadLetterReplayRequest,
+    authorization: Annotated[str, fastapi.Header(description="API Key")],
+) -> DeadLetterReplayResponse:
+    await authenticate_admin(authorization)
+    if not app_state.dead_letters or not app_state.dead_letter_replayer:
+        raise fastapi.HTTPException(status_code=500, detail="Service not initialized")
+
+    dead_letter_ids = replay.ids if replay.ids is not None else await app_state.dead_letters.ids(limit=replay.limit)
+    app_state.dead_letter_replayer.replay(dead_letter_ids)
+    return DeadLetterReplayResponse(replaying=len(dead_letter_ids))
 
 
 if __name__ == "__main__":
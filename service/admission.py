@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import math
+
+from fastapi import HTTPException, status
+from prometheus_client import Counter
+
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_SHED = Counter(
+    "sign_requests_shed_total",
+    "Sign requests rejected before queueing because the backlog is over its threshold, by scope global or user",
+    ("scope",),
+)
+
+
+class AdmissionController:
+    # decides whether requests may still be queued and estimates when they complete, from the live backlog
+    # and the upstream budget. past the thresholds requests are shed with Retry-After instead of queued for hours
+    def __init__(
+        self,
+        queue: RequestProcessingQueue,
+        rate_limiter: RateLimiter,
+        max_depth: int = 0,
+        max_user_depth: int = 0,
+        user_rate: float = 0,
+    ) -> None:
+        self._queue = queue
+        self._rate_limiter = rate_limiter
+        # queued requests in total and per user, 0 disables the threshold
+        self._max_depth = max_depth
+        self._max_user_depth = max_user_depth
+        # per user cap in calls per second, 0 if users are only limited by the global budget
+        self._user_rate = user_rate
+
+    async def admit(self, user_id: str, count: int = 1) -> list[float]:
+        # raises 503 over the global and 429 over the user threshold, otherwise returns the estimated
+        # seconds until each of the count requests is completed
+        (depth, user_depth, users), rate = await asyncio.gather(
+            self._queue.backlog(user_id),
+            self._rate_limiter.rate(),
+        )
+        # seconds per upstream call
+        interval = 1 / max(rate, 1e-9)
+        if self._max_depth > 0 and depth + count > self._max_depth:
+            ADMISSION_SHED.labels("global").inc(count)
+            retry_after = (depth + count - self._max_depth) * interval
+            logger.debug("Queue backlog of %d requests is over %d, shedding %d requests", depth, self._max_depth, count)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Signing backlog is full, retry later",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+        # a new user starts a sub-queue of its own
+        users = max(1, users if user_depth > 0 else users + 1)
+        if self._max_user_depth > 0 and user_depth + count > self._max_user_depth:
+            ADMISSION_SHED.labels("user").inc(count)
+            # the user's sub-queue drains at a fair share of the budget
+            retry_after = (user_depth + count - self._max_user_depth) * self._user_interval(interval, users)
+            logger.debug("User %s has %d queued requests, shedding %d requests", user_id, user_depth, count)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many queued requests for this user, retry later",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+        return [self._eta(depth + position, user_depth + position, users, interval) for position in range(1, count + 1)]
+
+    def _eta(self, position: int, user_position: int, users: int, interval: float) -> float:
+        # fair scheduling serves the user's sub-queue in turn with the other users, so a request waits for
+        # the user's earlier requests times the number of users, but never longer than for the whole queue
+        eta = min(position, user_position * users) * interval
+        if self._user_rate > 0:
+            eta = max(eta, user_position / self._user_rate)
+        return eta
+
+    def _user_interval(self, interval: float, users: int) -> float:
+        # seconds per call of a single user's sub-queue
+        return max(interval * users, 1 / self._user_rate if self._user_rate > 0 else 0)
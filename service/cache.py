@@ -0,0 +1,119 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import math
+import time
+
+from prometheus_client import Counter
+from redis.asyncio.client import Redis
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = Counter(
+    "signature_cache_lookups_total",
+    "Signature cache lookups by result, local_hit, redis_hit or miss",
+    ("result",),
+)
+
+
+def message_key(message: str) -> str:
+    # fixed size key, so long messages don't bloat memory of local and redis tiers
+    return hashlib.sha256(message.encode("utf-8")).hexdigest()
+
+
+class SignatureCache:
+    def __init__(
+        self,
+        redis_client: Redis,
+        ttl: float = 180,
+        local_size: int = 1024,
+        local_ttl: float = 30,
+        tracked: bool = False,
+    ) -> None:
+        self._redis_client = redis_client
+        self.prefix = "signature:"
+        # redis tier is shared by all replicas and expires entries server side
+        self._ttl = ttl
+        # small per process LRU in front of redis, entries never outlive the redis entry
+        self._local: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._local_size = local_size
+        self._local_ttl = local_ttl
+        # redis invalidates local entries through client tracking, so they may live as long as the redis entry
+        self._tracked = tracked
+        # bumped on every invalidation, a lookup racing with one doesn't fill the local tier
+        self._invalidations = 0
+
+    def _get_local(self, key: str) -> str | None:
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        signature, expires_at = entry
+        if expires_at <= time.time():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return signature
+
+    def _set_local(self, key: str, signature: str, ttl: float) -> None:
+        self._local[key] = (signature, time.time() + (ttl if self._tracked else min(ttl, self._local_ttl)))
+        self._local.move_to_end(key)
+        while len(self._local) > self._local_size:
+            self._local.popitem(last=False)
+
+    async def get(self, message: str) -> str | None:
+        return (await self.get_many([message]))[0]
+
+    async def get_many(self, messages: list[str]) -> list[str | None]:
+        # local tier first, the remaining messages are looked up in redis in a single round trip
+        keys = [message_key(message) for message in messages]
+        signatures = [self._get_local(key) for key in keys]
+        missing = [index for index, signature in enumerate(signatures) if signature is None]
+        CACHE_LOOKUPS.labels("local_hit").inc(len(keys) - len(missing))
+        if not missing:
+            return signatures
+        invalidations = self._invalidations
+        pipeline = self._redis_client.pipeline()
+        for index in missing:
+            pipeline.get(f"{self.prefix}{keys[index]}")
+            pipeline.pttl(f"{self.prefix}{keys[index]}")
+        results = await pipeline.execute()
+        for position, index in enumerate(missing):
+            signature, ttl_ms = results[2 * position], results[2 * position + 1]
+            if signature is None:
+                CACHE_LOOKUPS.labels("miss").inc()
+                continue
+            CACHE_LOOKUPS.labels("redis_hit").inc()
+            signature = signature.decode("utf-8") if isinstance(signature, bytes) else signature
+            if ttl_ms > 0 and invalidations == self._invalidations:
+                self._set_local(keys[index], signature, ttl_ms / 1000)
+            signatures[index] = signature
+        return signatures
+
+    async def set(self, message: str, signature: str) -> None:
+        key = message_key(message)
+        await self._redis_client.set(f"{self.prefix}{key}", signature, px=int(self._ttl * 1000))
+        self._set_local(key, signature, self._ttl)
+
+    async def ttls(self, messages: list[str]) -> list[float]:
+        # seconds until the redis entries of the messages expire, 0 for messages not cached
+        pipeline = self._redis_client.pipeline()
+        for message in messages:
+            pipeline.pttl(f"{self.prefix}{message_key(message)}")
+        return [math.inf if ttl_ms == -1 else max(0, ttl_ms) / 1000 for ttl_ms in await pipeline.execute()]
+
+    async def lock_refresh(self, message: str, ttl: float) -> bool:
+        # only one process signs a message again ahead of its expiry
+        return bool(await self._redis_client.set(f"refresh:{message_key(message)}", 1, nx=True, px=int(ttl * 1000)))
+
+    async def unlock_refresh(self, message: str) -> None:
+        # the refresh didn't happen, another process may take it over
+        await self._redis_client.delete(f"refresh:{message_key(message)}")
+
+    def invalidate(self, key: str | None) -> None:
+        # redis key changed or expired, None drops the whole local tier
+        self._invalidations += 1
+        if key is None:
+            self._local.clear()
+        else:
+            self._local.pop(key.removeprefix(self.prefix), None)
@@ -0,0 +1,230 @@
+import redis.asyncio as redis
+
+from configs.config import (
+    AuthConfig,
+    CacheConfig,
+    DeadLetterConfig,
+    PrefetchConfig,
+    QueueConfig,
+    RateLimiterConfig,
+    RedisConfig,
+    SynthesiaAPIConfig,
+    WebhookConfig,
+)
+from service.cache import SignatureCache
+from service.dead_letters import DeadLetterQueue
+from service.prefetcher import Prefetcher
+from service.queue import QueueProcessor, RequestProcessingQueue
+from service.rate_limiter import RateLimiter, UserRateLimiter
+from service.replay import DeadLetterReplayer
+from service.results import ResultStore
+from service.scheduler import FairScheduler
+from service.verifier import SignatureVerifier
+from service.webhook_manager import WebhookManager, WebhookOutbox, WebhookProducer
+from upstream.synthesia_api import SynthesiaAPI
+from utils.auth import ApiKeyRegistry
+from utils.codec import get_codec
+from utils.invalidation import InvalidationListener
+
+
+# wiring shared by the api process (server.py) and the standalone queue worker (worker.py)
+
+
+def create_redis(redis_config: RedisConfig) -> redis.Redis:
+    # the client owns the pool and closes it on shutdown
+    return redis.Redis.from_pool(
+        redis.BlockingConnectionPool.from_url(
+            redis_config.url,
+            max_connections=redis_config.max_connections,
+            timeout=redis_config.pool_timeout,
+            socket_timeout=redis_config.socket_timeout,
+            socket_connect_timeout=redis_config.socket_connect_timeout,
+            retry_on_timeout=redis_config.retry_on_timeout,
+            health_check_interval=redis_config.health_check_interval,
+        )
+    )
+
+
+def create_rate_limiter(redis_client: redis.Redis) -> RateLimiter:
+    rate_limiter_config = RateLimiterConfig()
+    return RateLimiter(
+        redis_client,
+        limit=rate_limiter_config.limit,
+        window=rate_limiter_config.window,
+        min_limit=rate_limiter_config.min_limit,
+        increase=rate_limiter_config.increase,
+        decrease_factor=rate_limiter_config.decrease_factor,
+    )
+
+
+def create_cache(redis_client: redis.Redis, redis_config: RedisConfig) -> SignatureCache:
+    cache_config = CacheConfig()
+    return SignatureCache(
+        redis_client,
+        ttl=cache_config.ttl,
+        local_size=cache_config.local_size,
+        local_ttl=cache_config.local_ttl,
+        tracked=redis_config.client_tracking,
+    )
+
+
+def create_prefetcher(
+    queue: RequestProcessingQueue,
+    upstream_api: SynthesiaAPI,
+    rate_limiter: RateLimiter,
+    cache: SignatureCache,
+) -> Prefetcher | None:
+    prefetch_config = PrefetchConfig()
+    if not prefetch_config.enabled:
+        return None
+    return Prefetcher(
+        queue,
+        upstream_api,
+        rate_limiter,
+        cache,
+        capacity=prefetch_config.tracked_messages,
+        min_hits=prefetch_config.min_hits,
+        refresh_before=prefetch_config.refresh_before,
+        headroom=prefetch_config.headroom,
+        interval=prefetch_config.interval,
+        decay_interval=prefetch_config.decay_interval,
+    )
+
+
+def create_verifier(
+    redis_client: redis.Redis,
+    cache: SignatureCache,
+    upstream_api: SynthesiaAPI,
+    rate_limiter: RateLimiter,
+    synthesia_config: SynthesiaAPIConfig,
+) -> SignatureVerifier:
+    return SignatureVerifier(
+        redis_client,
+        cache,
+        upstream_api,
+        rate_limiter,
+        public_key=synthesia_config.public_key,
+        ttl=CacheConfig().verified_ttl,
+    )
+
+
+def create_dead_letters(redis_client: redis.Redis, queue_config: QueueConfig) -> DeadLetterQueue:
+    return DeadLetterQueue(DeadLetterConfig().name, redis_client, codec=get_codec(queue_config.codec))
+
+
+def create_dead_letter_replayer(
+    redis_client: redis.Redis,
+    dead_letters: DeadLetterQueue,
+    queue: RequestProcessingQueue,
+    results: ResultStore,
+    rate_limiter: RateLimiter,
+) -> DeadLetterReplayer:
+    return DeadLetterReplayer(
+        dead_letters,
+        queue,
+        WebhookOutbox(WebhookConfig().name, redis_client),
+        results,
+        rate_limiter,
+        redis_client,
+        window=RateLimiterConfig().window,
+        share=DeadLetterConfig().replay_share,
+    )
+
+
+def create_webhook_producer(redis_client: redis.Redis) -> WebhookProducer:
+    # enqueues webhooks only, for api processes whose webhooks are sent by worker.py
+    webhook_config = WebhookConfig()
+    return WebhookProducer(
+        WebhookOutbox(webhook_config.name, redis_client),
+        batch_flush_window=webhook_config.batch_flush_window,
+    )
+
+
+def create_webhook_manager(
+    redis_client: redis.Redis,
+    redis_config: RedisConfig,
+    dead_letters: DeadLetterQueue | None = None,
+) -> WebhookManager:
+    webhook_config = WebhookConfig()
+    return WebhookManager(
+        WebhookOutbox(webhook_config.name, redis_client),
+        senders=webhook_config.senders,
+        per_host_limit=webhook_config.per_host_limit,
+        timeout=webhook_config.timeout,
+        max_retries=webhook_config.max_retries,
+        backoff_base=webhook_config.backoff_base,
+        backoff_max=webhook_config.backoff_max,
+        max_idle_wait=redis_config.max_block,
+        batch_flush_window=webhook_config.batch_flush_window,
+        batch_max_size=webhook_config.batch_max_size,
+        dead_letters=dead_letters,
+    )
+
+
+def create_api_keys(
+    redis_client: redis.Redis,
+    scheduler: FairScheduler,
+    queue_config: QueueConfig,
+    legacy_key: str | None,
+) -> ApiKeyRegistry:
+    auth_config = AuthConfig()
+
+    def update_user_weights(api_keys: ApiKeyRegistry) -> None:
+        # weights of key priority classes, explicitly configured user weights take precedence
+        scheduler.update_weights({**api_keys.user_weights(auth_config.priority_weights), **queue_config.user_weights})
+
+    return ApiKeyRegistry(
+        redis_client,
+        redis_key=auth_config.redis_key,
+        file_path=auth_config.api_keys_file,
+        legacy_key=legacy_key if auth_config.allow_legacy_key else None,
+        default_quota=auth_config.default_quota,
+        quota_window=auth_config.quota_window,
+        refresh_interval=auth_config.refresh_interval,
+        on_load=update_user_weights,
+    )
+
+
+def create_queue_processor(
+    redis_client: redis.Redis,
+    redis_config: RedisConfig,
+    queue_config: QueueConfig,
+    queue: RequestProcessingQueue,
+    upstream_api: SynthesiaAPI,
+    rate_limiter: RateLimiter,
+    cache: SignatureCache,
+    webhook_manager: WebhookProducer,
+    results: ResultStore,
+    scheduler: FairScheduler,
+    dead_letters: DeadLetterQueue | None = None,
+) -> QueueProcessor:
+    return QueueProcessor(
+        queue,
+        upstream_api,
+        rate_limiter,
+        cache,
+        webhook_manager,
+        results,
+        upstream_api_max_retries=queue_config.upstream_api_max_retries,
+        workers=queue_config.workers,
+        visibility_timeout=queue_config.visibility_timeout,
+        max_idle_wait=redis_config.max_block,
+        scheduler=scheduler,
+        user_rate_limiter=(
+            UserRateLimiter(redis_client, queue_config.per_user_rate_limit)
+            if queue_config.per_user_rate_limit > 0
+            else None
+        ),
+        dead_letters=dead_letters,
+    )
+
+
+def create_invalidation_listener(
+    redis_client: redis.Redis,
+    cache: SignatureCache,
+    api_keys: ApiKeyRegistry,
+) -> InvalidationListener:
+    invalidation = InvalidationListener(redis_client)
+    invalidation.register(cache.prefix, cache.invalidate)
+    invalidation.register(AuthConfig().redis_key, api_keys.invalidate)
+    return invalidation
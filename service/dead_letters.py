@@ -0,0 +1,95 @@
+from typing import Any, TypedDict
+import time
+import uuid
+
+from prometheus_client import Counter, Gauge
+from redis.asyncio.client import Redis
+
+from utils.codec import Codec, get_codec, loads
+
+
+DEAD_LETTERS = Counter("dead_letters_total", "Sign requests and webhook deliveries given up, by kind", ("kind",))
+DEAD_LETTER_DEPTH = Gauge("dead_letter_depth", "Dead letters waiting for inspection or replay")
+
+# kinds of dead letters
+REQUEST = "request"
+WEBHOOK = "webhook"
+
+
+class DeadLetter(TypedDict):
+    dead_letter_id: str
+    # REQUEST payload is a SignRequest including its subscribers, WEBHOOK payload a WebhookDelivery
+    kind: str
+    payload: dict[str, Any]
+    # error of the last attempt
+    reason: str
+    # [time, error] of every failed attempt
+    history: list[list[Any]]
+    dead_at: float
+
+
+class DeadLetterQueue:
+    # requests and webhook deliveries that ran out of attempts, kept until replayed
+    def __init__(self, name: str, redis_client: Redis, codec: Codec | None = None) -> None:
+        self.name = name
+        self._redis_client = redis_client
+        # dead letter ids ordered by time of death, the dead letters themselves are fields of a single hash
+        self._items_key = f"{name}:items"
+        self._codec = codec or get_codec("json")
+
+    async def add(self, kind: str, payload: dict[str, Any], reason: str, history: list[list[Any]]) -> str:
+        dead_letter = DeadLetter(
+            dead_letter_id=uuid.uuid4().hex,
+            kind=kind,
+            payload=payload,
+            reason=reason,
+            history=history,
+            dead_at=time.time(),
+        )
+        pipeline = self._redis_client.pipeline()
+        pipeline.hset(self._items_key, dead_letter["dead_letter_id"], self._codec.dumps(dead_letter))
+        pipeline.zadd(self.name, {dead_letter["dead_letter_id"]: dead_letter["dead_at"]})
+        await pipeline.execute()
+        DEAD_LETTERS.labels(kind).inc()
+        return dead_letter["dead_letter_id"]
+
+    async def depth(self) -> int:
+        return await self._redis_client.zcard(self.name)
+
+    async def collect_metrics(self) -> None:
+        DEAD_LETTER_DEPTH.set(await self.depth())
+
+    async def ids(self, offset: int = 0, limit: int = 100) -> list[str]:
+        # oldest first
+        ids = await self._redis_client.zrange(self.name, offset, offset + limit - 1)
+        return [
+            dead_letter_id.decode("utf-8") if isinstance(dead_letter_id, bytes) else dead_letter_id
+            for dead_letter_id in ids
+        ]
+
+    async def get_many(self, dead_letter_ids: list[str]) -> list[DeadLetter]:
+        if not dead_letter_ids:
+            return []
+        values = await self._redis_client.hmget(self._items_key, dead_letter_ids)
+        return [DeadLetter(**loads(value)) for value in values if value is not None]
+
+    async def get(self, dead_letter_id: str) -> DeadLetter | None:
+        value = await self._redis_client.hget(self._items_key, dead_letter_id)
+        return None if value is None else DeadLetter(**loads(value))
+
+    async def take(self, dead_letter_id: str) -> DeadLetter | None:
+        # removes and returns the dead letter, None if it was taken by a concurrent replay
+        pipeline = self._redis_client.pipeline()
+        pipeline.hget(self._items_key, dead_letter_id)
+        pipeline.hdel(self._items_key, dead_letter_id)
+        pipeline.zrem(self.name, dead_letter_id)
+        value, removed, _ = await pipeline.execute()
+        if not removed:
+            return None
+        return DeadLetter(**loads(value))
+
+    async def put_back(self, dead_letter: DeadLetter) -> None:
+        pipeline = self._redis_client.pipeline()
+        pipeline.hset(self._items_key, dead_letter["dead_letter_id"], self._codec.dumps(dead_letter))
+        pipeline.zadd(self.name, {dead_letter["dead_letter_id"]: dead_letter["dead_at"]})
+        await pipeline.execute()
@@ -1,7 +1,45 @@
-from pydantic import BaseModel
+from typing import Any
+
+from pydantic import BaseModel, Field, HttpUrl
 
 
 class CryptoSignResponse(BaseModel):
     request_id: str
     status: int
     signature: str | None = None
+    message: str | None = None
+    # estimated seconds until a queued request is completed
+    eta: float | None = None
+
+
+class CryptoVerifyResponse(BaseModel):
+    request_id: str
+    valid: bool
+
+
+class CryptoSignBatchRequest(BaseModel):
+    messages: list[str] = Field(min_length=1)
+    webhook_url: HttpUrl | None = None
+    webhook_batch: bool = False
+
+
+class CryptoSignBatchResponse(BaseModel):
+    # one item per message in request order, repeated messages share the request id
+    items: list[CryptoSignResponse]
+
+
+class DeadLetterList(BaseModel):
+    # dead letters in total and the requested page of them, oldest first
+    depth: int
+    items: list[dict[str, Any]]
+
+
+class DeadLetterReplayRequest(BaseModel):
+    # dead letters to replay, the limit oldest ones if not given
+    ids: list[str] | None = None
+    limit: int = Field(default=100, ge=1, le=10000)
+
+
+class DeadLetterReplayResponse(BaseModel):
+    # dead letters handed to the background replay
+    replaying: int
@@ -0,0 +1,176 @@
+from typing import Any
+import asyncio
+import logging
+import math
+import time
+
+from prometheus_client import Counter
+
+from service.cache import SignatureCache, message_key
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+from upstream.synthesia_api import SynthesiaAPI, SynthesiaRateLimitError, SynthesiaSignRequest
+
+
+logger = logging.getLogger(__name__)
+
+PREFETCHES = Counter(
+    "signature_prefetches_total",
+    "Hot messages re-signed ahead of their cache expiry with spare upstream budget, by result",
+    ("result",),
+)
+
+
+class HeavyHitters:
+    # space saving sketch, counts requests of at most capacity messages. a new message replaces the least
+    # counted one and inherits its count as error, so every message requested more than total / capacity
+    # times is tracked, and count - error is a lower bound of its requests
+    def __init__(self, capacity: int = 1000) -> None:
+        self.capacity = capacity
+        # message key -> [message, count, error]
+        self._counters: dict[str, list[Any]] = {}
+        # stream summary, count -> keys with that count, so add finds the least counted message in O(1)
+        self._buckets: dict[int, dict[str, None]] = {}
+        self._min_count = 0
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    def add(self, message: str) -> None:
+        key = message_key(message)
+        counter = self._counters.get(key)
+        if counter is not None:
+            self._move(key, counter[1], counter[1] + 1)
+            counter[1] += 1
+            return
+        if len(self._counters) < self.capacity:
+            self._counters[key] = [message, 1, 0]
+            self._buckets.setdefault(1, {})[key] = None
+            self._min_count = 1
+            return
+        min_count = self._min_count
+        min_bucket = self._buckets[min_count]
+        min_key = next(iter(min_bucket))
+        del self._counters[min_key]
+        self._counters[key] = [message, min_count + 1, min_count]
+        self._move(min_key, min_count, min_count + 1, key)
+
+    def _move(self, key: str, count: int, new_count: int, new_key: str | None = None) -> None:
+        # moves key to the bucket of new_count, or replaces it there by new_key
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+            if self._min_count == count:
+                self._min_count = new_count
+        self._buckets.setdefault(new_count, {})[key if new_key is None else new_key] = None
+
+    def top(self, limit: int, min_count: int = 1) -> list[tuple[str, int]]:
+        # hottest messages with their guaranteed request count, most requested first
+        guaranteed = [(message, count - error) for message, count, error in self._counters.values()]
+        guaranteed = [(message, count) for message, count in guaranteed if count >= min_count]
+        return sorted(guaranteed, key=lambda item: item[1], reverse=True)[:limit]
+
+    def decay(self) -> None:
+        # halves all counts, so messages that stopped being requested cool down and make room
+        self._buckets = {}
+        for key in list(self._counters):
+            counter = self._counters[key]
+            counter[1] //= 2
+            counter[2] //= 2
+            if counter[1] == 0:
+                del self._counters[key]
+            else:
+                self._buckets.setdefault(counter[1], {})[key] = None
+        self._min_count = min(self._buckets, default=0)
+
+
+class Prefetcher:
+    # turns upstream budget that would go unused while the queue is idle into cache hits. hot messages whose
+    # cached signature is about to expire are signed again, always leaving headroom of the budget to live requests
+    def __init__(
+        self,
+        queue: RequestProcessingQueue,
+        upstream_api: SynthesiaAPI,
+        rate_limiter: RateLimiter,
+        cache: SignatureCache,
+        capacity: int = 1000,
+        min_hits: int = 3,
+        refresh_before: float = 30,
+        headroom: float = 0.3,
+        interval: float = 5,
+        decay_interval: float = 300,
+    ) -> None:
+        self._queue = queue
+        self._upstream_api = upstream_api
+        self._rate_limiter = rate_limiter
+        self._cache = cache
+        self._hits = HeavyHitters(capacity)
+        # messages requested less often are not worth an upstream call
+        self._min_hits = min_hits
+        # cached signatures expiring within this many seconds are refreshed
+        self._refresh_before = refresh_before
+        # share of the budget that is never used for prefetching
+        self._headroom = headroom
+        self._interval = interval
+        self._decay_interval = decay_interval
+
+    def record(self, message: str) -> None:
+        self._hits.add(message)
+
+    async def run(self) -> None:
+        logger.info(f"Starting signature prefetcher for {self._hits.capacity} hot messages")
+        decayed_at = time.monotonic()
+        while True:
+            try:
+                await asyncio.sleep(self._interval)
+                if time.monotonic() - decayed_at >= self._decay_interval:
+                    self._hits.decay()
+                    decayed_at = time.monotonic()
+                await self._prefetch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error in signature prefetcher: {e}")
+
+    async def _spare_calls(self) -> int:
+        # calls left in the window once the headroom is kept back, 0 while queued requests are due
+        next_due_in = await self._queue.next_due_in()
+        if next_due_in is not None and next_due_in <= 0:
+            return 0
+        budget, window_calls = await asyncio.gather(self._rate_limiter.budget(), self._rate_limiter.window_calls())
+        return max(0, math.floor(budget * (1 - self._headroom)) - window_calls)
+
+    async def _prefetch(self) -> None:
+        if await self._spare_calls() <= 0:
+            return
+        hot = [message for message, _ in self._hits.top(len(self._hits), self._min_hits)]
+        if not hot:
+            return
+        ttls = await self._cache.ttls(hot)
+        expiring = [message for message, ttl in zip(hot, ttls, strict=True) if ttl < self._refresh_before]
+        for message in expiring:
+            # re-checked before every call, live requests may have taken the spare calls meanwhile
+            if await self._spare_calls() <= 0:
+                return
+            if not await self._cache.lock_refresh(message, self._refresh_before):
+                # another process refreshes it
+                continue
+            if not await self._rate_limiter.is_request_allowed(f"prefetch:{message_key(message)}"):
+                # the message is still to be refreshed, by the next round or another process
+                await self._cache.unlock_refresh(message)
+                return
+            try:
+                result = await self._upstream_api.sign_message(SynthesiaSignRequest(message=message))
+            except SynthesiaRateLimitError as e:
+                await self._rate_limiter.on_rate_limited(e.retry_after)
+                PREFETCHES.labels("rate_limited").inc()
+                return
+            except Exception as e:
+                logger.warning(f"Prefetching signature failed: {e}")
+                PREFETCHES.labels("error").inc()
+                return
+            await self._rate_limiter.on_success(result.retry_after)
+            await self._cache.set(message, result.signature)
+            PREFETCHES.labels("refreshed").inc()
+            logger.debug("Prefetched signature of hot message of length %d", len(message))
@@ -1,74 +1,530 @@
-from collections import deque
-from typing import TypedDict
+from typing import Any, NotRequired, TypedDict
 import asyncio
-import json
 import logging
 import time
+import uuid
 
 from fastapi import status
-from pydantic import HttpUrl
+from prometheus_client import Counter, Gauge, Histogram
 from redis.asyncio.client import Redis
 
+from service.cache import SignatureCache, message_key
+from service.dead_letters import REQUEST, DeadLetterQueue
 from service.models import CryptoSignResponse
-from service.rate_limiter import RateLimiter
-from service.webhook_manager import process_webhook
-from upstream.synthesia_api import SynthesiaAPI, SynthesiaSignRequest
+from service.rate_limiter import RateLimiter, UserRateLimiter
+from service.results import ResultStore
+from service.scheduler import FairScheduler
+from service.webhook_manager import WebhookProducer
+from upstream.synthesia_api import SynthesiaAPI, SynthesiaRateLimitError, SynthesiaSignRequest
+from utils.codec import Codec, get_codec, loads
+from utils.metrics import DURATION_BUCKETS
 
 
 logger = logging.getLogger(__name__)
 
+# add a request, or merge it into a queued, not yet claimed request for the same message.
+# merged requests are stored as subscribers of the queued one and share its result.
+# requests of a user are also indexed in the user's sub-queue for fair scheduling.
+# KEYS: queue, notify list, pending index, users set. ARGV: request id, data, due time, message key,
+# subscriber, request key prefix, user id, user queue prefix. returns id of the request the subscriber was added to
+ADD_SCRIPT = """
+local pending = redis.call("HGET", KEYS[3], ARGV[4])
+if pending then
+    local pending_key = ARGV[6] .. pending
+    if redis.call("EXISTS", pending_key) == 1 and not redis.call("HGET", pending_key, "lease") then
+        redis.call("RPUSH", pending_key .. ":subscribers", ARGV[5])
+        return pending
+    end
+end
+redis.call("HSET", ARGV[6] .. ARGV[1], "d", ARGV[2], "key", ARGV[4])
+redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1])
+if ARGV[7] ~= "" then
+    redis.call("HSET", ARGV[6] .. ARGV[1], "user", ARGV[7])
+    redis.call("ZADD", ARGV[8] .. ARGV[7], ARGV[3], ARGV[1])
+    redis.call("SADD", KEYS[4], ARGV[7])
+end
+redis.call("HSET", KEYS[3], ARGV[4], ARGV[1])
+redis.call("LPUSH", KEYS[2], 1)
+redis.call("LTRIM", KEYS[2], 0, 0)
+return ARGV[1]
+"""
+
+# users with at least one due request in their sub-queue, drops users without requests. only a random
+# sample of the users is checked, so the cost of a call doesn't grow with the number of queued users.
+# KEYS: users set. ARGV: now, user queue prefix, sample size
+DUE_USERS_SCRIPT = """
+local due = {}
+for _, user in ipairs(redis.call("SRANDMEMBER", KEYS[1], tonumber(ARGV[3]))) do
+    local user_queue = ARGV[2] .. user
+    if redis.call("EXISTS", user_queue) == 0 then
+        redis.call("SREM", KEYS[1], user)
+    elseif #redis.call("ZRANGEBYSCORE", user_queue, "-inf", ARGV[1], "LIMIT", 0, 1) > 0 then
+        table.insert(due, user)
+    end
+end
+return due
+"""
+
+# claim due requests by moving their score to the lease expiry, so a request
+# claimed by a crashed worker becomes due again once the visibility timeout passes.
+# requests are taken from the source queue, either a user sub-queue or the whole queue.
+# claimed requests leave the pending index, so new requests are not merged into work in flight.
+# returns id, data, retries, user and subscribers of claimed requests, so a batch is fetched in a single round trip.
+# data is read from the legacy "data" field for requests not migrated yet.
+# KEYS: queue, notify list, pending index, source queue.
+# ARGV: now, lease expiry, limit, lease token, request key prefix, user queue prefix
+CLAIM_SCRIPT = """
+local ids = redis.call("ZRANGEBYSCORE", KEYS[4], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[3]))
+local claimed = {}
+for _, id in ipairs(ids) do
+    local key = ARGV[5] .. id
+    local fields = redis.call("HMGET", key, "d", "data", "r", "user", "key")
+    local data = fields[1] or fields[2]
+    if data then
+        redis.call("ZADD", KEYS[1], ARGV[2], id)
+        local user = fields[4]
+        if user then
+            redis.call("ZADD", ARGV[6] .. user, ARGV[2], id)
+        end
+        redis.call("HSET", key, "lease", ARGV[4])
+        local message_key = fields[5]
+        if message_key and redis.call("HGET", KEYS[3], message_key) == id then
+            redis.call("HDEL", KEYS[3], message_key)
+        end
+        local subscribers = redis.call("LRANGE", key .. ":subscribers", 0, -1)
+        table.insert(claimed, {id, data, fields[3] or "0", user or "", subscribers})
+    else
+        redis.call("ZREM", KEYS[1], id)
+        redis.call("ZREM", KEYS[4], id)
+    end
+end
+if #claimed > 0 and #redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, 1) > 0 then
+    -- more requests are due, pass the wakeup on to another worker
+    redis.call("LPUSH", KEYS[2], 1)
+    redis.call("LTRIM", KEYS[2], 0, 0)
+end
+return claimed
+"""
+
+# remove a completed request unless another worker holds the lease, acking twice is a no-op.
+# KEYS: queue, request hash, subscribers list, pending index, users set, attempt history list.
+# ARGV: request id, lease token, user queue prefix
+ACK_SCRIPT = """
+local lease = redis.call("HGET", KEYS[2], "lease")
+if lease and lease ~= ARGV[2] then
+    return 0
+end
+local message_key = redis.call("HGET", KEYS[2], "key")
+if message_key and redis.call("HGET", KEYS[4], message_key) == ARGV[1] then
+    redis.call("HDEL", KEYS[4], message_key)
+end
+local user = redis.call("HGET", KEYS[2], "user")
+if user then
+    redis.call("ZREM", ARGV[3] .. user, ARGV[1])
+    if redis.call("EXISTS", ARGV[3] .. user) == 0 then
+        redis.call("SREM", KEYS[5], user)
+    end
+end
+redis.call("DEL", KEYS[2], KEYS[3], KEYS[6])
+redis.call("ZREM", KEYS[1], ARGV[1])
+return 1
+"""
+
+# put a claimed request back to the queue with a new due time, retries are counted in place
+# and the error of a failed attempt is appended to the attempt history.
+# it accepts merged requests again unless a newer request for the message is pending.
+# KEYS: queue, request hash, notify list, pending index, attempt history list.
+# ARGV: request id, lease token, retries increment, due time, user queue prefix, attempt
+RELEASE_SCRIPT = """
+if redis.call("HGET", KEYS[2], "lease") ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] ~= "0" then
+    redis.call("HINCRBY", KEYS[2], "r", ARGV[3])
+end
+if ARGV[6] ~= "" then
+    redis.call("RPUSH", KEYS[5], ARGV[6])
+end
+redis.call("HDEL", KEYS[2], "lease")
+redis.call("ZADD", KEYS[1], ARGV[4], ARGV[1])
+local user = redis.call("HGET", KEYS[2], "user")
+if user then
+    redis.call("ZADD", ARGV[5] .. user, ARGV[4], ARGV[1])
+end
+local message_key = redis.call("HGET", KEYS[2], "key")
+if message_key then
+    redis.call("HSETNX", KEYS[4], message_key, ARGV[1])
+end
+redis.call("LPUSH", KEYS[3], 1)
+redis.call("LTRIM", KEYS[3], 0, 0)
+return 1
+"""
+
+# convert a request stored as a single JSON "data" blob to the compact layout, unless it changed meanwhile.
+# KEYS: request hash. ARGV: legacy data, data, retries
+MIGRATE_RECORD_SCRIPT = """
+if redis.call("HGET", KEYS[1], "data") ~= ARGV[1] then
+    return 0
+end
+redis.call("HSET", KEYS[1], "d", ARGV[2])
+if ARGV[3] ~= "0" then
+    redis.call("HINCRBY", KEYS[1], "r", ARGV[3])
+end
+redis.call("HDEL", KEYS[1], "data")
+return 1
+"""
+
 
 class RequestMetadata(TypedDict):
     request_id: str
     created_at: float
     retries: int
     updated_at: float
+    # requests queued before per user sub-queues have no user
+    user_id: NotRequired[str]
+
+
+class Subscriber(TypedDict):
+    request_id: str
+    # None for clients polling the result store
+    webhook_url: str | None
+    webhook_batch: NotRequired[bool]
+    # enqueue time of the merged request, for end to end latency
+    created_at: NotRequired[float]
+    # user of the merged request, subscribers stored before it was recorded have none
+    user_id: NotRequired[str]
 
 
 class SignRequest(TypedDict):
     message: str
-    webhook_url: HttpUrl
+    webhook_url: str | None
     metadata: RequestMetadata
+    # webhook receiver accepts batched results
+    webhook_batch: NotRequired[bool]
+    # requests for the same message merged into this one, filled in on claim
+    subscribers: NotRequired[list[Subscriber]]
+
+
+QUEUE_DEPTH = Gauge("sign_queue_depth", "Queued sign requests including the ones leased by workers")
+QUEUE_OLDEST_DUE_AGE = Gauge("sign_queue_oldest_due_age_seconds", "Seconds the longest waiting due request is overdue")
+QUEUE_DURATION = Histogram(
+    "sign_request_queue_duration_seconds",
+    "Time from enqueueing a sign request to its result being stored, by result status",
+    ("status",),
+    buckets=DURATION_BUCKETS,
+)
+QUEUE_RESCHEDULED = Counter(
+    "sign_requests_rescheduled_total",
+    "Queued sign requests handed back to the queue, by reason",
+    ("reason",),
+)
+
+# sub-queue of requests without user, f.e. queued before per user sub-queues existed
+DEFAULT_USER_ID = "default"
 
 
 class RequestProcessingQueue:
-    def __init__(self, name: str, redis_client: Redis) -> None:
+    def __init__(
+        self,
+        name: str,
+        redis_client: Redis,
+        codec: Codec | None = None,
+        scheduling_sample: int = 100,
+    ) -> None:
         self.name = name
         self._redis_client = redis_client
+        # requests and subscribers are stored as compact tagged arrays, any codec's values can be read back
+        self._codec = codec or get_codec("json")
+        # single token list used to wake up processors blocked in wait()
+        self._notify_key = f"{name}:notify"
+        # message key -> id of the queued request new requests for the message are merged into
+        self._pending_key = f"{name}:pending"
+        # users with queued requests and their sub-queues, used for fair scheduling between users
+        self._users_key = f"{name}:users"
+        self._user_queue_prefix = f"{name}:user:"
+        # set once requests queued before sub-queues and the compact layout were migrated
+        self._migrated_key = f"{name}:migrated"
+        # most users checked for due requests per scheduling decision
+        self._scheduling_sample = scheduling_sample
+        self._request_key_prefix = "request:"
+        self._add_script = redis_client.register_script(ADD_SCRIPT)
+        self._due_users_script = redis_client.register_script(DUE_USERS_SCRIPT)
+        self._claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self._ack_script = redis_client.register_script(ACK_SCRIPT)
+        self._release_script = redis_client.register_script(RELEASE_SCRIPT)
+        self._migrate_record_script = redis_client.register_script(MIGRATE_RECORD_SCRIPT)
+
+    def _request_key(self, request_id: str) -> str:
+        return f"{self._request_key_prefix}{request_id}"
+
+    def _encode(self, request: SignRequest) -> bytes:
+        # only the fields that never change, request id is part of the key, retries and user are hash fields
+        # and subscribers are kept in a separate list, so they can be appended atomically
+        return self._codec.dumps(
+            [
+                request["message"],
+                request["webhook_url"],
+                request.get("webhook_batch", False),
+                request["metadata"]["created_at"],
+            ]
+        )
 
-    async def add(self, request: SignRequest) -> None:
+    @staticmethod
+    def _decode(request_id: str, data: bytes, retries: int, user_id: str) -> SignRequest:
+        record = loads(data)
+        if isinstance(record, dict):
+            # JSON blob of a request not migrated yet, retries since then are counted in place
+            request = SignRequest(**record)
+            request["metadata"]["retries"] += retries
+            return request
+        message, webhook_url, webhook_batch, created_at = record
+        metadata = RequestMetadata(
+            request_id=request_id, created_at=created_at, retries=retries, updated_at=time.time()
+        )
+        if user_id:
+            metadata["user_id"] = user_id
+        return SignRequest(message=message, webhook_url=webhook_url, webhook_batch=webhook_batch, metadata=metadata)
+
+    @staticmethod
+    def _decode_subscriber(data: bytes) -> Subscriber:
+        subscriber = loads(data)
+        if isinstance(subscriber, dict):
+            return Subscriber(**subscriber)
+        request_id, webhook_url, webhook_batch, created_at, *user_id = subscriber
+        decoded = Subscriber(
+            request_id=request_id,
+            webhook_url=webhook_url,
+            webhook_batch=webhook_batch,
+            created_at=created_at,
+        )
+        if user_id:
+            decoded["user_id"] = user_id[0]
+        return decoded
+
+    def _add_args(self, request: SignRequest) -> tuple[list[str], list[str | bytes | float]]:
+        subscriber = [
+            request["metadata"]["request_id"],
+            request["webhook_url"],
+            request.get("webhook_batch", False),
+            request["metadata"]["created_at"],
+            request["metadata"].get("user_id", DEFAULT_USER_ID),
+        ]
+        return [self.name, self._notify_key, self._pending_key, self._users_key], [
+            request["metadata"]["request_id"],
+            self._encode(request),
+            request["metadata"]["updated_at"],
+            message_key(request["message"]),
+            self._codec.dumps(subscriber),
+            self._request_key_prefix,
+            request["metadata"].get("user_id", DEFAULT_USER_ID),
+            self._user_queue_prefix,
+        ]
+
+    @staticmethod
+    def _queued_request_id(request: SignRequest, queued_request_id: str | bytes) -> str:
+        if isinstance(queued_request_id, bytes):
+            queued_request_id = queued_request_id.decode("utf-8")
         request_id = request["metadata"]["request_id"]
-        request["webhook_url"] = str(request["webhook_url"])
-        await self._redis_client.hset(
-            f"request:{request_id}",
-            mapping={"data": json.dumps(request)},
+        if queued_request_id != request_id:
+            logger.debug("Request %s merged into queued request %s", request_id, queued_request_id)
+        return queued_request_id
+
+    async def add(self, request: SignRequest) -> str:
+        # returns id of the queued request this one is processed with
+        keys, args = self._add_args(request)
+        return self._queued_request_id(request, await self._add_script(keys=keys, args=args))
+
+    async def add_many(self, requests: list[SignRequest]) -> list[str]:
+        # add requests in a single transaction and round trip, returns the queued request ids in order
+        if not requests:
+            return []
+        pipeline = self._redis_client.pipeline()
+        for request in requests:
+            keys, args = self._add_args(request)
+            await self._add_script(keys=keys, args=args, client=pipeline)
+        queued_request_ids = await pipeline.execute()
+        return [
+            self._queued_request_id(request, queued_request_id)
+            for request, queued_request_id in zip(requests, queued_request_ids, strict=True)
+        ]
+
+    async def migrate(self, chunk_size: int = 500) -> int:
+        # index requests queued before per user sub-queues into the default sub-queue, otherwise fair scheduling
+        # never picks them up, and convert JSON blobs to the compact layout. the queue is scanned once, a marker
+        # key skips the scan on later startups. requests an older release adds afterwards are still claimed
+        if await self._redis_client.exists(self._migrated_key):
+            return 0
+        migrated = 0
+        converted = 0
+        chunk: list[tuple[str, float]] = []
+        async for request_id, updated_at in self._redis_client.zscan_iter(self.name, count=chunk_size):
+            chunk.append((request_id.decode("utf-8") if isinstance(request_id, bytes) else request_id, updated_at))
+            if len(chunk) >= chunk_size:
+                chunk_migrated, chunk_converted = await self._migrate_chunk(chunk)
+                migrated, converted, chunk = migrated + chunk_migrated, converted + chunk_converted, []
+        if chunk:
+            chunk_migrated, chunk_converted = await self._migrate_chunk(chunk)
+            migrated, converted = migrated + chunk_migrated, converted + chunk_converted
+        await self._redis_client.set(self._migrated_key, 1)
+        if migrated:
+            logger.info(f"Migrated {migrated} requests in queue {self.name} to per user sub-queues")
+        if converted:
+            logger.info(f"Converted {converted} requests in queue {self.name} to the compact layout")
+        return migrated + converted
+
+    async def _migrate_chunk(self, chunk: list[tuple[str, float]]) -> tuple[int, int]:
+        # reads the requests of the chunk in one round trip and writes their migrations in another
+        pipeline = self._redis_client.pipeline()
+        for request_id, _ in chunk:
+            pipeline.hmget(self._request_key(request_id), ["user", "data"])
+        records = await pipeline.execute()
+        migrated = 0
+        # positions of the record conversions in the pipeline, each returns 1 if the request was converted
+        conversions = []
+        pipeline = self._redis_client.pipeline()
+        for (request_id, updated_at), (user, legacy_data) in zip(chunk, records, strict=True):
+            request_key = self._request_key(request_id)
+            if user is None:
+                pipeline.hset(request_key, "user", DEFAULT_USER_ID)
+                pipeline.zadd(f"{self._user_queue_prefix}{DEFAULT_USER_ID}", {request_id: updated_at})
+                pipeline.sadd(self._users_key, DEFAULT_USER_ID)
+                migrated += 1
+            if legacy_data is not None:
+                request = loads(legacy_data)
+                conversions.append(len(pipeline))
+                await self._migrate_record_script(
+                    keys=[request_key],
+                    args=[legacy_data, self._encode(request), request["metadata"]["retries"]],
+                    client=pipeline,
+                )
+        if not len(pipeline):
+            return 0, 0
+        results = await pipeline.execute()
+        return migrated, sum(results[position] for position in conversions)
+
+    async def next_due_in(self) -> float | None:
+        # seconds until the earliest request becomes due, None if queue is empty
+        earliest = await self._redis_client.zrange(self.name, 0, 0, withscores=True)
+        if not earliest:
+            return None
+        _, updated_at = earliest[0]
+        return max(0.0, updated_at - time.time())
+
+    async def wait(self, timeout: float) -> None:
+        # block until add() signals a new request or timeout expires.
+        # BLPOP timeout 0 means block forever, so keep a small lower bound
+        await self._redis_client.blpop([self._notify_key], timeout=max(timeout, 0.01))
+
+    async def depth(self) -> int:
+        # number of queued requests including the ones leased by workers
+        return await self._redis_client.zcard(self.name)
+
+    async def oldest_due(self) -> float | None:
+        # due time of the request waiting the longest, None if nothing is due
+        oldest = await self._redis_client.zrangebyscore(self.name, "-inf", time.time(), start=0, num=1, withscores=True)
+        if not oldest:
+            return None
+        _, updated_at = oldest[0]
+        return updated_at
+
+    async def collect_metrics(self) -> None:
+        QUEUE_DEPTH.set(await self.depth())
+        oldest_due = await self.oldest_due()
+        QUEUE_OLDEST_DUE_AGE.set(0 if oldest_due is None else max(0.0, time.time() - oldest_due))
+
+    async def due_users(self) -> list[str]:
+        # users with at least one due request in their sub-queue, of a random sample when there are many
+        users = await self._due_users_script(
+            keys=[self._users_key],
+            args=[time.time(), self._user_queue_prefix, self._scheduling_sample],
         )
-        await self._redis_client.zadd(self.name, {request_id: request["metadata"]["updated_at"]})
+        return [user.decode("utf-8") if isinstance(user, bytes) else user for user in users]
 
-    async def get(self) -> list[SignRequest] | None:
-        # get the request within the current time window
+    async def user_depth(self, user_id: str) -> int:
+        return await self._redis_client.zcard(f"{self._user_queue_prefix}{user_id}")
+
+    async def backlog(self, user_id: str) -> tuple[int, int, int]:
+        # queue depth, depth of the user's sub-queue and number of users with queued requests, in one round trip
+        pipeline = self._redis_client.pipeline()
+        pipeline.zcard(self.name)
+        pipeline.zcard(f"{self._user_queue_prefix}{user_id}")
+        pipeline.scard(self._users_key)
+        depth, user_depth, users = await pipeline.execute()
+        return depth, user_depth, users
+
+    async def claim(
+        self,
+        lease_token: str,
+        visibility_timeout: float,
+        limit: int = 1,
+        user_id: str | None = None,
+    ) -> list[SignRequest]:
+        # atomically lease at most `limit` due requests of the user, or of any user if user_id is None.
+        # they are re-delivered to another worker if not acked or released within visibility_timeout
         now = time.time()
-        next_requests = await self._redis_client.zrangebyscore(self.name, 0, now)
-        logger.info(f"Found {next_requests} requests in queue")
-        if not next_requests:
-            return None
+        source = self.name if user_id is None else f"{self._user_queue_prefix}{user_id}"
+        claimed = await self._claim_script(
+            keys=[self.name, self._notify_key, self._pending_key, source],
+            args=[now, now + visibility_timeout, limit, lease_token, self._request_key_prefix, self._user_queue_prefix],
+        )
         result = []
-        for next_request in next_requests:
-            logger.info(f"Processing request from Redis: {next_request}")
-            if isinstance(next_request, bytes):
-                request_id = next_request.decode("utf-8")
-            else:
-                request_id = str(next_request)
-            request_data = await self._redis_client.hget(f"request:{request_id}", "data")
-            if request_data:
-                request_dict = json.loads(request_data)
-                request_dict["webhook_url"] = HttpUrl(request_dict["webhook_url"])
-                result.append(SignRequest(**request_dict))
-        return result if result else None
+        for request_id, request_data, retries, user, subscribers in claimed:
+            request = self._decode(
+                request_id.decode("utf-8") if isinstance(request_id, bytes) else request_id,
+                request_data,
+                int(retries),
+                user.decode("utf-8") if isinstance(user, bytes) else user,
+            )
+            request["subscribers"] = [self._decode_subscriber(subscriber) for subscriber in subscribers]
+            result.append(request)
+        return result
+
+    async def ack(self, request_id: str, lease_token: str) -> bool:
+        # complete the request, returns False if the lease was lost to another worker
+        request_key = self._request_key(request_id)
+        return bool(
+            await self._ack_script(
+                keys=[
+                    self.name,
+                    request_key,
+                    f"{request_key}:subscribers",
+                    self._pending_key,
+                    self._users_key,
+                    f"{request_key}:history",
+                ],
+                args=[request_id, lease_token, self._user_queue_prefix],
+            )
+        )
+
+    async def release(
+        self,
+        request_id: str,
+        lease_token: str,
+        due_at: float,
+        retry: bool = False,
+        error: str | None = None,
+    ) -> bool:
+        # return a claimed request to the queue due at due_at, retry counts one more failed attempt
+        request_key = self._request_key(request_id)
+        attempt = self._codec.dumps([time.time(), error]) if retry else b""
+        return bool(
+            await self._release_script(
+                keys=[self.name, request_key, self._notify_key, self._pending_key, f"{request_key}:history"],
+                args=[request_id, lease_token, 1 if retry else 0, due_at, self._user_queue_prefix, attempt],
+            )
+        )
+
+    async def history(self, request_id: str) -> list[list[Any]]:
+        # [time, error] of every failed attempt of the request, oldest first
+        attempts = await self._redis_client.lrange(f"{self._request_key(request_id)}:history", 0, -1)
+        return [loads(attempt) for attempt in attempts]
 
     async def remove(self, request_id: str) -> None:
-        await self._redis_client.delete(f"request:{request_id}")
-        await self._redis_client.zrem(self.name, request_id)
+        request_key = self._request_key(request_id)
+        pipeline = self._redis_client.pipeline()
+        pipeline.delete(request_key, f"{request_key}:subscribers", f"{request_key}:history")
+        pipeline.zrem(self.name, request_id)
+        await pipeline.execute()
 
 
 class QueueProcessor:
@@ -77,40 +533,42 @@ class QueueProcessor:
         queue: RequestProcessingQueue,
         upstream_api: SynthesiaAPI,
         rate_limiter: RateLimiter,
+        cache: SignatureCache,
+        webhook_manager: WebhookProducer,
+        results: ResultStore,
         upstream_api_max_retries: int = 3,
+        max_idle_wait: float = 60,
+        workers: int = 1,
+        visibility_timeout: float = 300,
+        scheduler: FairScheduler | None = None,
+        user_rate_limiter: UserRateLimiter | None = None,
+        dead_letters: DeadLetterQueue | None = None,
     ) -> None:
         self._queue = queue
         self._upstream_api = upstream_api
         self._upstream_api_max_retries = upstream_api_max_retries
         self._rate_limiter = rate_limiter
+        self._cache = cache
+        self._webhook_manager = webhook_manager
+        self._results = results
+        # upper bound for blocking wait, so processor periodically re-checks queue
+        self._max_idle_wait = max_idle_wait
+        # workers of all processes share the same redis based rate limiter budget
+        self._workers = workers
+        # should cover upstream timeout plus webhook delivery, otherwise request is processed twice
+        self._visibility_timeout = visibility_timeout
+        # picks whose sub-queue is served next, so one user's burst can't starve the others
+        self._scheduler = scheduler or FairScheduler()
+        self._user_rate_limiter = user_rate_limiter
+        # requests out of retries are kept here for inspection and replay instead of being dropped
+        self._dead_letters = dead_letters
 
     async def process(self) -> None:
-        logger.info(f"Starting queue processor for queue {self._queue.name}")
+        logger.info(f"Starting {self._workers} queue workers for queue {self._queue.name}")
         try:
-            while True:
-                try:
-                    next_requests = await self._queue.get()
-                    if next_requests is None:
-                        logger.info(f"No requests found in queue {self._queue.name}, sleeping for 10 seconds")
-                        await asyncio.sleep(10)
-                        continue
-                    logger.info(f"Processing {len(next_requests)} requests from queue {self._queue.name}")
-                    # hack: convert list to queue to handle rate limiting
-                    next_requests = deque(next_requests)
-                    while next_requests:
-                        next_request = next_requests[0]
-                        is_request_allowed = await self._rate_limiter.is_request_allowed(
-                            next_request["metadata"]["request_id"]
-                        )
-                        if not is_request_allowed:
-                            logger.info("Upstream API is rate limited, sleeping for 10 seconds")
-                            await asyncio.sleep(10)
-                            continue
-                        next_requests.popleft()
-                        await self._process_request(next_request)
-                except Exception as e:
-                    logger.exception(f"Error in queue processor main loop: {e}")
-                    await asyncio.sleep(10)  # Sleep before retrying to prevent tight error loop
+            async with asyncio.TaskGroup() as task_group:
+                for worker_id in range(self._workers):
+                    task_group.create_task(self._worker(worker_id))
         except asyncio.CancelledError:
             logger.info("Queue processor cancelled")
             raise
@@ -118,59 +576,171 @@ class QueueProcessor:
             logger.exception(f"Fatal error in queue processor: {e}")
             raise
 
-    async def _process_request(self, next_request: SignRequest) -> None:
-        logger.info(f"Processing next request {next_request['metadata']['request_id']} from queue {self._queue.name}")
-        if next_request["webhook_url"] is None:
-            # avoid processing requests without webhook URL
-            logger.warning(f"Request {next_request['metadata']['request_id']} has no webhook URL, skipping")
-            await self._queue.remove(next_request["metadata"]["request_id"])
-            return
-        try:
-            result = await self._upstream_api.sign_message(SynthesiaSignRequest(message=next_request["message"]))
-            response = CryptoSignResponse(
+    async def _worker(self, worker_id: int) -> None:
+        while True:
+            try:
+                next_due_in = await self._queue.next_due_in()
+                if next_due_in is None or next_due_in > 0:
+                    await self._wait_for_requests(next_due_in)
+                    continue
+                next_slot_in = await self._rate_limiter.time_until_next_slot()
+                if next_slot_in > 0:
+                    logger.debug("Upstream API is rate limited, worker %d sleeping for %.3fs", worker_id, next_slot_in)
+                    await asyncio.sleep(next_slot_in)
+                    continue
+                due_users = await self._queue.due_users()
+                eligible_users, next_user_slot_in = await self._eligible_users(due_users)
+                if due_users and not eligible_users:
+                    logger.debug("No due user is under their rate cap, worker %d waiting", worker_id)
+                    await self._queue.wait(min(next_user_slot_in, self._max_idle_wait))
+                    continue
+                # no sampled user has a due request, the sample missed them or nothing is due anymore. the whole
+                # queue is served in due order, if it's empty too next_due_in sleeps until the next due request
+                user_id = self._scheduler.pick(eligible_users) if eligible_users else None
+                lease_token = uuid.uuid4().hex
+                claimed = await self._queue.claim(lease_token, self._visibility_timeout, user_id=user_id)
+                if not claimed:
+                    continue
+                next_request = claimed[0]
+                request_id = next_request["metadata"]["request_id"]
+                user_id = next_request["metadata"].get("user_id", DEFAULT_USER_ID)
+                # message might have been signed since it was queued, cache hits don't need a rate limit slot
+                signature = await self._cache.get(next_request["message"])
+                if signature is None and not await self._acquire_slot(request_id, user_id):
+                    # another worker took the free slot first or the user is capped, hand the request back
+                    logger.debug("Worker %d lost rate limit slot, releasing request %s", worker_id, request_id)
+                    await self._queue.release(request_id, lease_token, time.time() + await self._user_slot_in(user_id))
+                    QUEUE_RESCHEDULED.labels("lost_rate_limit_slot").inc()
+                    continue
+                await self._process_request(next_request, lease_token, signature)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error in queue worker {worker_id} main loop: {e}")
+                await asyncio.sleep(10)  # Sleep before retrying to prevent tight error loop
+
+    async def _eligible_users(self, users: list[str]) -> tuple[list[str], float]:
+        # users not over their own rate cap, and seconds until the first capped user frees up
+        if self._user_rate_limiter is None:
+            return users, 0.0
+        eligible = []
+        next_slot_in = self._max_idle_wait
+        for user_id in users:
+            user_slot_in = await self._user_slot_in(user_id)
+            if user_slot_in > 0:
+                next_slot_in = min(next_slot_in, user_slot_in)
+            else:
+                eligible.append(user_id)
+        return eligible, next_slot_in
+
+    async def _user_slot_in(self, user_id: str) -> float:
+        if self._user_rate_limiter is None:
+            return 0.0
+        return await self._user_rate_limiter.for_user(user_id).time_until_next_slot()
+
+    async def _acquire_slot(self, request_id: str, user_id: str) -> bool:
+        # global slot is taken first, it is the one workers race for. the user cap was checked when the user
+        # was picked, so losing it afterwards and wasting the global slot is rare
+        if not await self._rate_limiter.is_request_allowed(request_id):
+            return False
+        if self._user_rate_limiter is None:
+            return True
+        return await self._user_rate_limiter.for_user(user_id).is_request_allowed(request_id)
+
+    async def _wait_for_requests(self, next_due_in: float | None) -> None:
+        # sleep until either a new request is added or the earliest retry becomes due
+        timeout = self._max_idle_wait if next_due_in is None else min(next_due_in, self._max_idle_wait)
+        logger.debug("No requests due in queue %s, waiting up to %.3f seconds", self._queue.name, timeout)
+        await self._queue.wait(timeout)
+
+    async def _notify_subscribers(
+        self,
+        next_request: SignRequest,
+        status_code: int,
+        signature: str | None = None,
+        message: str | None = None,
+    ) -> None:
+        # fan a single result out to the request and all requests merged into it. results are stored
+        # for polling clients and webhooks are handed off to the outbox, so workers can take the next rate slot
+        subscribers = [
+            Subscriber(
                 request_id=next_request["metadata"]["request_id"],
-                status=status.HTTP_200_OK,
-                signature=result.signature,
-            )
-            await process_webhook(
-                webhook_url=str(next_request["webhook_url"]),
-                data=response.model_dump(),
+                webhook_url=next_request["webhook_url"],
+                webhook_batch=next_request.get("webhook_batch", False),
+                created_at=next_request["metadata"]["created_at"],
+            ),
+            *next_request.get("subscribers", []),
+        ]
+        responses = [
+            CryptoSignResponse(
+                request_id=subscriber["request_id"],
+                status=status_code,
+                signature=signature,
+                message=message,
             )
-            await self._queue.remove(next_request["metadata"]["request_id"])
+            for subscriber in subscribers
+        ]
+        await self._results.set_many(responses)
+        now = time.time()
+        for subscriber in subscribers:
+            if "created_at" in subscriber:
+                QUEUE_DURATION.labels(str(status_code)).observe(now - subscriber["created_at"])
+        await self._webhook_manager.send_many(
+            [
+                (
+                    subscriber["webhook_url"],
+                    response.model_dump(),
+                    subscriber.get("webhook_batch", False),
+                    subscriber.get("created_at"),
+                )
+                for subscriber, response in zip(subscribers, responses, strict=True)
+                if subscriber["webhook_url"] is not None
+            ]
+        )
+
+    async def _process_request(
+        self,
+        next_request: SignRequest,
+        lease_token: str,
+        signature: str | None = None,
+    ) -> None:
+        request_id = next_request["metadata"]["request_id"]
+        logger.debug("Processing next request %s from queue %s", request_id, self._queue.name)
+        try:
+            if signature is None:
+                result = await self._upstream_api.sign_message(SynthesiaSignRequest(message=next_request["message"]))
+                await self._rate_limiter.on_success(result.retry_after)
+                signature = result.signature
+                await self._cache.set(next_request["message"], signature)
+            await self._notify_subscribers(next_request, status.HTTP_200_OK, signature=signature)
+            await self._queue.ack(request_id, lease_token)
+        except SynthesiaRateLimitError as e:
+            # upstream quota is exhausted, which is not the request's fault. shrink the budget and
+            # reschedule the request for the next free slot without spending one of its retries
+            await self._rate_limiter.on_rate_limited(e.retry_after)
+            next_slot_in = await self._rate_limiter.time_until_next_slot()
+            logger.info("Request %s rate limited by upstream, rescheduling in %.3f seconds", request_id, next_slot_in)
+            await self._queue.release(request_id, lease_token, time.time() + next_slot_in)
+            QUEUE_RESCHEDULED.labels("upstream_rate_limited").inc()
         except Exception as e:
-            logger.exception(f"Error processing request {next_request['metadata']['request_id']}: {e}")
+            logger.exception(f"Error processing request {request_id}: {e}")
+            error = str(e) or type(e).__name__
             if next_request["metadata"]["retries"] >= self._upstream_api_max_retries:
-                logger.info(
-                    f"Request {next_request['metadata']['request_id']} failed after "
-                    f"{self._upstream_api_max_retries} retries, giving up"
-                )
-                await self._queue.remove(next_request["metadata"]["request_id"])
-                await process_webhook(
-                    webhook_url=str(next_request["webhook_url"]),
-                    data=CryptoSignResponse(
-                        request_id=next_request["metadata"]["request_id"],
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        message="Error signing message.",
-                    ).model_dump(),
+                logger.info(f"Request {request_id} failed after {self._upstream_api_max_retries} retries, giving up")
+                if self._dead_letters is not None:
+                    history = [*await self._queue.history(request_id), [time.time(), error]]
+                    await self._dead_letters.add(REQUEST, dict(next_request), error, history)
+                await self._queue.ack(request_id, lease_token)
+                await self._notify_subscribers(
+                    next_request,
+                    status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    message="Error signing message.",
                 )
             else:
                 # retry with exponential backoff
                 retries = next_request["metadata"]["retries"] + 1
                 backoff = min(180, 30 * (2**retries))  # max of 3 minutes
                 next_attempt = time.time() + backoff
-                logger.info(
-                    f"Adding request {next_request['metadata']['request_id']} to queue "
-                    f"to retry with exponential backoff {backoff} seconds"
-                )
-                await self._queue.add(
-                    SignRequest(
-                        message=next_request["message"],
-                        webhook_url=next_request["webhook_url"],
-                        metadata=RequestMetadata(
-                            request_id=next_request["metadata"]["request_id"],
-                            created_at=next_request["metadata"]["created_at"],
-                            retries=retries,
-                            updated_at=next_attempt,
-                        ),
-                    )
-                )
+                logger.info(f"Adding request {request_id} to queue to retry with exponential backoff {backoff} seconds")
+                QUEUE_RESCHEDULED.labels("retry").inc()
+                await self._queue.release(request_id, lease_token, next_attempt, retry=True, error=error)
@@ -1,37 +1,223 @@
+import asyncio
+import logging
+import math
 import time
+import uuid
 
+from prometheus_client import Counter, Gauge
 from redis.asyncio.client import Redis
 
 
+logger = logging.getLogger(__name__)
+
+RATE_LIMITER_ACQUISITIONS = Counter(
+    "rate_limiter_acquisitions_total",
+    "Rate limit slot reservations by limiter scope and result",
+    ("scope", "result"),
+)
+RATE_LIMITER_FEEDBACK = Counter(
+    "rate_limiter_upstream_feedback_total",
+    "Upstream call outcomes fed into the adaptive budget",
+    ("outcome",),
+)
+RATE_LIMITER_BUDGET = Gauge("rate_limiter_budget", "Adaptive upstream budget in calls per window")
+RATE_LIMITER_WINDOW_CALLS = Gauge("rate_limiter_window_calls", "Upstream calls in the current sliding window")
+RATE_LIMITER_UTILISATION = Gauge("rate_limiter_utilisation", "Share of the adaptive budget used in the current window")
+
+# trim the sliding window, count it and reserve slots in one atomic step,
+# so concurrent callers can never go over the limit.
+# the limit is the adaptive budget learned from upstream, capped by the configured one,
+# and no slot is handed out while upstream asked to pause.
+# returns {allowed, seconds until enough slots free}, floats are returned
+# as strings because lua numbers are truncated to integers in the reply.
+# a count above the limit is never allowed, callers reject it up front.
+# KEYS: window sorted set, budget hash. ARGV: now, window, limit, member, reserve flag, count
+SLIDING_WINDOW_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local paused_until = tonumber(redis.call("HGET", KEYS[2], "paused_until") or "0")
+if paused_until > now then
+    return {0, tostring(paused_until - now)}
+end
+local limit = tonumber(ARGV[3])
+local budget = redis.call("HGET", KEYS[2], "limit")
+if budget then
+    limit = math.max(1, math.min(limit, math.floor(tonumber(budget))))
+end
+local count = tonumber(ARGV[6])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - window)
+local calls = redis.call("ZCARD", KEYS[1])
+if calls + count <= limit then
+    if ARGV[5] == "1" then
+        for i = 1, count do
+            redis.call("ZADD", KEYS[1], now, ARGV[4] .. ":" .. i)
+        end
+        redis.call("EXPIRE", KEYS[1], math.ceil(window) + 3)
+    end
+    return {1, "0"}
+end
+-- enough slots are free once the oldest calls over the limit left the window
+local index = math.max(0, math.min(calls, calls + count - limit) - 1)
+local oldest = redis.call("ZRANGE", KEYS[1], index, index, "WITHSCORES")
+if #oldest == 0 then
+    return {0, tostring(window)}
+end
+return {0, tostring(math.max(0, tonumber(oldest[2]) + window - now))}
+"""
+
+# AIMD budget update from the outcome of an upstream call. a 429 cuts the budget by the
+# decrease factor and pauses for Retry-After, or for one slot of the new budget if upstream
+# didn't say. all calls in flight when upstream starts rejecting get a 429, so the budget is cut
+# only once per pause. each success adds increase / budget, so a full window of successes
+# grows the budget by increase slots, up to the configured limit.
+# returns the new budget as string.
+# KEYS: budget hash. ARGV: now, window, limit, min limit, increase, decrease factor, outcome, pause
+BUDGET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ceiling = tonumber(ARGV[3])
+local limit = math.min(ceiling, tonumber(redis.call("HGET", KEYS[1], "limit") or ARGV[3]))
+local paused_until = tonumber(redis.call("HGET", KEYS[1], "paused_until") or "0")
+local pause = tonumber(ARGV[8]) or 0
+if ARGV[7] == "rate_limited" then
+    if paused_until <= now then
+        limit = math.max(tonumber(ARGV[4]), limit * tonumber(ARGV[6]))
+    end
+    if ARGV[8] == "" then
+        pause = tonumber(ARGV[2]) / limit
+    end
+elseif limit < ceiling then
+    limit = math.min(ceiling, limit + tonumber(ARGV[5]) / limit)
+end
+paused_until = math.max(paused_until, now + pause)
+redis.call("HSET", KEYS[1], "limit", tostring(limit), "paused_until", tostring(paused_until))
+return tostring(limit)
+"""
+
+
 class RateLimiter:
     def __init__(
         self,
         redis_client: Redis,
         limit: int = 10,
-        window: int = 60,  # default arguments based on task description. todo(move such variables to configuration)
+        window: float = 60,
+        name: str = "rate_limiter",
+        scope: str = "global",
+        min_limit: int = 1,
+        increase: float = 1,
+        decrease_factor: float = 0.5,
     ) -> None:
         self._redis_client = redis_client
+        # configured upstream quota, the adaptive budget never goes above it
         self._limit = limit
         self._window = window
-        self._name = "rate_limiter"
+        self._name = name
+        # metrics label, per user limiters share one, so label cardinality doesn't grow with users
+        self._scope = scope
+        self._budget_key = f"{name}:budget"
+        self._min_limit = min_limit
+        self._increase = increase
+        self._decrease_factor = decrease_factor
+        self._script = redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+        self._budget_script = redis_client.register_script(BUDGET_SCRIPT)
+
+    async def _check(self, request_id: str, reserve: bool, count: int = 1) -> tuple[bool, float]:
+        # one sliding window per limiter name, the default one guards the global upstream
+        # quota and per user caps use their own windows, see UserRateLimiter
+        # member is made unique, so retries of the same request take their own slot
+        member = f"{request_id}:{uuid.uuid4().hex}"
+        allowed, retry_after = await self._script(
+            keys=[self._name, self._budget_key],
+            args=[time.time(), self._window, self._limit, member, int(reserve), count],
+        )
+        if reserve:
+            RATE_LIMITER_ACQUISITIONS.labels(self._scope, "allowed" if allowed else "denied").inc()
+        return bool(allowed), float(retry_after)
+
+    async def try_acquire(self, request_id: str, count: int = 1) -> tuple[bool, float]:
+        # reserve count slots if they are free, otherwise return seconds until enough slots free
+        return await self._check(request_id, reserve=True, count=count)
 
     async def is_request_allowed(self, request_id: str) -> bool:
-        # lets do for now general rate limiter not user based
-        # for task simplicity. todo: can be extended to add granularity
-        # f.e. per user
-        now = time.time()
-        window_start = now - self._window
-
-        pipeline = self._redis_client.pipeline()
-        pipeline.zremrangebyscore(self._name, 0, window_start)
-        pipeline.zcard(self._name)
-        _, current_count = await pipeline.execute()
-
-        if current_count < self._limit:
-            pipeline = self._redis_client.pipeline()
-            pipeline.zadd(self._name, {request_id: now})
-            pipeline.expire(self._name, self._window + 3)
-            await pipeline.execute()
-            return True
-        else:
-            return False
+        allowed, _ = await self.try_acquire(request_id)
+        return allowed
+
+    async def acquire(self, request_id: str, timeout: float) -> bool:
+        # wait for a free slot without polling, gives up if it can't be taken within timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            allowed, retry_after = await self.try_acquire(request_id)
+            if allowed:
+                return True
+            if retry_after > deadline - time.monotonic():
+                return False
+            await asyncio.sleep(retry_after)
+
+    async def time_until_next_slot(self) -> float:
+        # seconds until a slot frees in the sliding window, 0 if one is free now
+        _, retry_after = await self._check("", reserve=False)
+        return retry_after
+
+    async def _update_budget(self, outcome: str, retry_after: float | None) -> float:
+        RATE_LIMITER_FEEDBACK.labels(outcome).inc()
+        budget = await self._budget_script(
+            keys=[self._budget_key],
+            args=[
+                time.time(),
+                self._window,
+                self._limit,
+                self._min_limit,
+                self._increase,
+                self._decrease_factor,
+                outcome,
+                "" if retry_after is None else retry_after,
+            ],
+        )
+        return float(budget)
+
+    async def on_success(self, retry_after: float | None = None) -> None:
+        # upstream accepted a call, probe the budget back up. retry_after is set when
+        # upstream reported its quota as exhausted, the budget is paused until then
+        await self._update_budget("success", retry_after)
+
+    async def on_rate_limited(self, retry_after: float | None = None) -> None:
+        budget = await self._update_budget("rate_limited", retry_after)
+        logger.warning(f"Upstream rate limited, budget of {self._name} is {budget:.2f} calls per {self._window}s")
+
+    async def budget(self) -> float:
+        budget = await self._redis_client.hget(self._budget_key, "limit")
+        return self._limit if budget is None else min(self._limit, float(budget))
+
+    async def rate(self) -> float:
+        # calls per second the current budget allows
+        return await self.budget() / self._window
+
+    async def window_calls(self) -> int:
+        return await self._redis_client.zcount(self._name, time.time() - self._window, "+inf")
+
+    async def collect_metrics(self) -> None:
+        budget = await self.budget()
+        window_calls = await self.window_calls()
+        RATE_LIMITER_BUDGET.set(budget)
+        RATE_LIMITER_WINDOW_CALLS.set(window_calls)
+        RATE_LIMITER_UTILISATION.set(window_calls / max(1, math.floor(budget)))
+
+
+class UserRateLimiter:
+    # optional per user cap on top of the global upstream limit, one sliding window per user
+    def __init__(self, redis_client: Redis, limit: int, window: int = 60) -> None:
+        self._redis_client = redis_client
+        self._limit = limit
+        self._window = window
+        self._limiters: dict[str, RateLimiter] = {}
+
+    def for_user(self, user_id: str) -> RateLimiter:
+        limiter = self._limiters.get(user_id)
+        if limiter is None:
+            limiter = self._limiters[user_id] = RateLimiter(
+                self._redis_client,
+                limit=self._limit,
+                window=self._window,
+                name=f"rate_limiter:user:{user_id}",
+                scope="user",
+            )
+        return limiter
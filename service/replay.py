@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import math
+import time
+
+from prometheus_client import Counter
+from redis.asyncio.client import Redis
+
+from service.dead_letters import REQUEST, DeadLetterQueue
+from service.queue import DEFAULT_USER_ID, RequestMetadata, RequestProcessingQueue, SignRequest
+from service.rate_limiter import RateLimiter
+from service.results import ResultStore
+from service.webhook_manager import WebhookDelivery, WebhookOutbox
+
+
+logger = logging.getLogger(__name__)
+
+DEAD_LETTERS_REPLAYED = Counter("dead_letters_replayed_total", "Dead letters handed back for processing", ("kind",))
+
+
+class DeadLetterReplayer:
+    # hands dead letters back for processing in the background. replayed requests take upstream calls, so they
+    # are paced by a separate rate limiter sized to a share of the current upstream budget and live traffic
+    # keeps the rest. webhook deliveries don't use upstream budget and go back to the outbox right away
+    def __init__(
+        self,
+        dead_letters: DeadLetterQueue,
+        queue: RequestProcessingQueue,
+        outbox: WebhookOutbox,
+        results: ResultStore,
+        rate_limiter: RateLimiter,
+        redis_client: Redis,
+        window: float = 60,
+        share: float = 0.2,
+    ) -> None:
+        self._dead_letters = dead_letters
+        self._queue = queue
+        self._outbox = outbox
+        self._results = results
+        self._rate_limiter = rate_limiter
+        self._redis_client = redis_client
+        self._window = window
+        self._share = share
+        self._pacer: RateLimiter | None = None
+        self._pacer_limit = 0
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def replaying(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def replay(self, dead_letter_ids: list[str]) -> None:
+        task = asyncio.create_task(self._replay(dead_letter_ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _replay(self, dead_letter_ids: list[str]) -> None:
+        logger.info(f"Replaying {len(dead_letter_ids)} dead letters")
+        replayed = 0
+        for dead_letter_id in dead_letter_ids:
+            # dead letters are only taken once a slot is free, so a cancelled replay leaves the rest in place
+            dead_letter = await self._dead_letters.get(dead_letter_id)
+            if dead_letter is None:
+                continue
+            if dead_letter["kind"] == REQUEST:
+                await self._pace(dead_letter_id)
+            dead_letter = await self._dead_letters.take(dead_letter_id)
+            if dead_letter is None:
+                continue
+            try:
+                if dead_letter["kind"] == REQUEST:
+                    await self._replay_request(SignRequest(**dead_letter["payload"]))
+                else:
+                    await self._replay_webhook(WebhookDelivery(**dead_letter["payload"]))
+            except Exception as e:
+                logger.exception(f"Failed to replay dead letter {dead_letter_id}, putting it back: {e}")
+                await self._dead_letters.put_back(dead_letter)
+                continue
+            DEAD_LETTERS_REPLAYED.labels(dead_letter["kind"]).inc()
+            replayed += 1
+        logger.info(f"Replayed {replayed} of {len(dead_letter_ids)} dead letters")
+
+    async def _pace(self, dead_letter_id: str) -> None:
+        # the pacer follows the adaptive budget, so replays slow down together with the upstream
+        limit = max(1, math.floor(self._share * await self._rate_limiter.budget()))
+        if self._pacer is None or self._pacer_limit != limit:
+            self._pacer_limit = limit
+            self._pacer = RateLimiter(
+                self._redis_client,
+                limit=limit,
+                window=self._window,
+                name="rate_limiter:replay",
+                scope="replay",
+            )
+        await self._pacer.acquire(dead_letter_id, timeout=math.inf)
+
+    async def _replay_request(self, request: SignRequest) -> None:
+        # the request and every request merged into it start over, they are merged again when queued together.
+        # each keeps its own user, so only that user may read its result
+        now = time.time()
+        user_id = request["metadata"].get("user_id", DEFAULT_USER_ID)
+        requests = [request, *self._subscriber_requests(request)]
+        for replayed in requests:
+            replayed["metadata"]["retries"] = 0
+            replayed["metadata"]["updated_at"] = now
+            replayed["metadata"].setdefault("user_id", user_id)
+            replayed.pop("subscribers", None)
+        await self._results.set_pending_many(
+            {replayed["metadata"]["request_id"]: replayed["metadata"]["user_id"] for replayed in requests}
+        )
+        await self._queue.add_many(requests)
+
+    @staticmethod
+    def _subscriber_requests(request: SignRequest) -> list[SignRequest]:
+        requests = []
+        for subscriber in request.get("subscribers", []):
+            metadata = RequestMetadata(
+                request_id=subscriber["request_id"],
+                created_at=subscriber.get("created_at", request["metadata"]["created_at"]),
+                retries=0,
+                updated_at=0,
+            )
+            if "user_id" in subscriber:
+                metadata["user_id"] = subscriber["user_id"]
+            requests.append(
+                SignRequest(
+                    message=request["message"],
+                    webhook_url=subscriber["webhook_url"],
+                    webhook_batch=subscriber.get("webhook_batch", False),
+                    metadata=metadata,
+                )
+            )
+        return requests
+
+    async def _replay_webhook(self, delivery: WebhookDelivery) -> None:
+        delivery["attempts"] = 0
+        delivery.pop("history", None)
+        await self._outbox.add_many([(delivery, time.time())])
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+from fastapi import status
+from redis.asyncio.client import Redis
+
+from service.models import CryptoSignResponse
+
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore:
+    def __init__(self, redis_client: Redis, ttl: float = 3600) -> None:
+        self._redis_client = redis_client
+        self._prefix = "result:"
+        # completed request ids are published, so long polling clients are woken up in every api process
+        self._channel = "results"
+        self._ttl = ttl
+        # request id -> futures of long polling clients in this process
+        self._waiters: dict[str, set[asyncio.Future[None]]] = {}
+
+    def _key(self, request_id: str) -> str:
+        return f"{self._prefix}{request_id}"
+
+    def _user_key(self, request_id: str) -> str:
+        # user the request belongs to, only that user's keys may read the result
+        return f"{self._prefix}{request_id}:user"
+
+    async def set_pending(self, request_id: str, user_id: str) -> None:
+        await self.set_pending_many({request_id: user_id})
+
+    async def set_pending_many(self, users: dict[str, str]) -> None:
+        # request id -> user id of the request
+        pipeline = self._redis_client.pipeline()
+        for request_id, user_id in users.items():
+            response = CryptoSignResponse(
+                request_id=request_id,
+                status=status.HTTP_202_ACCEPTED,
+                message="Your request is being processed asynchronously.",
+            )
+            pipeline.set(self._key(request_id), response.model_dump_json(), px=int(self._ttl * 1000))
+            pipeline.set(self._user_key(request_id), user_id, px=int(self._ttl * 1000))
+        await pipeline.execute()
+
+    async def set_many(self, responses: list[CryptoSignResponse]) -> None:
+        # the user stored with the pending result is kept as long as the result
+        if not responses:
+            return
+        pipeline = self._redis_client.pipeline()
+        for response in responses:
+            pipeline.set(self._key(response.request_id), response.model_dump_json(), px=int(self._ttl * 1000))
+            pipeline.pexpire(self._user_key(response.request_id), int(self._ttl * 1000))
+            pipeline.publish(self._channel, response.request_id)
+        await pipeline.execute()
+
+    async def get(self, request_id: str, user_id: str | None = None) -> CryptoSignResponse | None:
+        # with user_id, results of other users and results without user are treated as not found
+        data, owner = await self._redis_client.mget(self._key(request_id), self._user_key(request_id))
+        if data is None:
+            return None
+        if user_id is not None:
+            owner = owner.decode("utf-8") if isinstance(owner, bytes) else owner
+            if owner != user_id:
+                return None
+        return CryptoSignResponse.model_validate_json(data)
+
+    async def wait(self, request_id: str, timeout: float, user_id: str | None = None) -> CryptoSignResponse | None:
+        # long poll: returns as soon as the request completes or timeout expires
+        response = await self.get(request_id, user_id)
+        if response is None or response.status != status.HTTP_202_ACCEPTED or timeout <= 0:
+            return response
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(request_id, set()).add(future)
+        try:
+            # result might have been stored before the waiter was registered
+            response = await self.get(request_id, user_id)
+            if response is not None and response.status != status.HTTP_202_ACCEPTED:
+                return response
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                pass
+            return await self.get(request_id, user_id)
+        finally:
+            waiters = self._waiters.get(request_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self._waiters[request_id]
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Result channel {self._channel} interrupted, resubscribing: {e}")
+            # results published while unsubscribed were missed, long polls return so clients poll again
+            self._wake_all()
+            await asyncio.sleep(1)
+
+    async def _listen(self) -> None:
+        pubsub = self._redis_client.pubsub()
+        try:
+            await pubsub.subscribe(self._channel)
+            logger.info(f"Listening for results on channel {self._channel}")
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                request_id = message["data"]
+                if isinstance(request_id, bytes):
+                    request_id = request_id.decode("utf-8")
+                for future in self._waiters.get(request_id, ()):
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            await pubsub.aclose()
+
+    def _wake_all(self) -> None:
+        for waiters in self._waiters.values():
+            for future in waiters:
+                if not future.done():
+                    future.set_result(None)
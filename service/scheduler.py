@@ -0,0 +1,38 @@
+from collections import deque
+
+
+class FairScheduler:
+    # deficit round robin over users with due requests, every request costs one unit.
+    # a user with weight 2 is served twice as often as a user with weight 1 while both have work
+    def __init__(self, weights: dict[str, float] | None = None, default_weight: float = 1) -> None:
+        self._weights = weights or {}
+        self._default_weight = default_weight
+        self._order: deque[str] = deque()
+        self._deficits: dict[str, float] = {}
+
+    def update_weights(self, weights: dict[str, float]) -> None:
+        self._weights = weights
+
+    def weight(self, user_id: str) -> float:
+        return self._weights.get(user_id, self._default_weight)
+
+    def pick(self, users: list[str]) -> str | None:
+        if not users:
+            return None
+        active = set(users)
+        # users without due requests lose their deficit, so idle time can't be saved up for a burst
+        for user_id in [user_id for user_id in self._order if user_id not in active]:
+            self._order.remove(user_id)
+            del self._deficits[user_id]
+        for user_id in users:
+            if user_id not in self._deficits:
+                self._order.append(user_id)
+                self._deficits[user_id] = 0
+        while True:
+            user_id = self._order[0]
+            if self._deficits[user_id] >= 1:
+                self._deficits[user_id] -= 1
+                return user_id
+            self._order.rotate(-1)
+            next_user_id = self._order[0]
+            self._deficits[next_user_id] += max(self.weight(next_user_id), 1e-3)
@@ -1,20 +1,33 @@
+import asyncio
 import logging
 import time
+import uuid
 
 from fastapi import BackgroundTasks
+from prometheus_client import Counter
 from pydantic import HttpUrl
 import fastapi
 
+from service.admission import AdmissionController
+from service.cache import SignatureCache, message_key
 from service.models import CryptoSignResponse
+from service.prefetcher import Prefetcher
 from service.queue import RequestMetadata, RequestProcessingQueue, SignRequest
 from service.rate_limiter import RateLimiter
-from service.webhook_manager import process_webhook
-from upstream.synthesia_api import SynthesiaAPI, SynthesiaSignRequest
+from service.results import ResultStore
+from service.webhook_manager import WebhookProducer
+from upstream.synthesia_api import SynthesiaAPI, SynthesiaRateLimitError, SynthesiaSignRequest
 from utils.helpers import RequestHeaders
 
 
 logger = logging.getLogger(__name__)
 
+SIGN_REQUESTS = Counter(
+    "sign_requests_total",
+    "Sign requests by how they were answered, cached, coalesced, signed, detached, queued or error",
+    ("outcome",),
+)
+
 
 class Service:
     def __init__(
@@ -22,12 +35,120 @@ class Service:
         queue: RequestProcessingQueue,
         upstream_api: SynthesiaAPI,
         rate_limiter: RateLimiter,
+        cache: SignatureCache,
+        webhook_manager: WebhookProducer,
+        results: ResultStore,
+        deadline_reserve: float = 0.2,
+        admission: AdmissionController | None = None,
+        prefetcher: Prefetcher | None = None,
     ) -> None:
         self._queue = queue
         self._upstream_api = upstream_api
         self._rate_limiter = rate_limiter
-        # simple cache for illustrative purposes, production should use # Redis or something similar
-        self._cache: dict[str, tuple[CryptoSignResponse, float]] = {}
+        self._cache = cache
+        self._webhook_manager = webhook_manager
+        self._results = results
+        # message key -> result of the upstream call in flight for that message
+        self._in_flight: dict[str, asyncio.Future[str]] = {}
+        # part of a request deadline kept back to answer with 202 in time
+        self._deadline_reserve = deadline_reserve
+        # upstream calls that outlived their request deadline, finished in the background
+        self._detached: set[asyncio.Task[None]] = set()
+        # sheds requests while the backlog is too deep and estimates completion of queued ones
+        self._admission = admission
+        # counts requested messages, so hot ones are signed again before their cached signature expires
+        self._prefetcher = prefetcher
+
+    async def close(self, timeout: float = 10) -> None:
+        # give detached calls a chance to finish, the rest is handed over to the queue
+        if not self._detached:
+            return
+        _, pending = await asyncio.wait(set(self._detached), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _record_requested(self, messages: list[str]) -> None:
+        if self._prefetcher is not None:
+            for message in messages:
+                self._prefetcher.record(message)
+
+    def _time_left(self, deadline: float | None) -> float | None:
+        # seconds a stage may take, deadline is in event loop time
+        if deadline is None:
+            return None
+        return max(0.0, deadline - self._deadline_reserve - asyncio.get_running_loop().time())
+
+    async def _lookup(self, message: str, key: str) -> tuple[str | None, str, asyncio.Future[str] | None]:
+        # returns the cached or coalesced signature and the outcome, or makes the request the leader of the
+        # message's single flight and returns its future, which other requests for the message wait for
+        signature = await self._cache.get(message)
+        if signature is not None:
+            return signature, "cached", None
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            # no await since the lookup, so concurrent requests for the message find this future
+            leader = self._in_flight[key] = asyncio.get_running_loop().create_future()
+            return None, "leader", leader
+        # same message is being signed by another request, wait for its result instead of spending
+        # rate budget. on timeout the in flight call still fills the cache the queued request checks
+        try:
+            signature = await asyncio.shield(in_flight)
+        except Exception as e:
+            logger.info(f"Coalesced signing failed, queueing the request: {e}")
+        return signature, "coalesced", None
+
+    def _release_single_flight(self, key: str, future: asyncio.Future[str], error: BaseException) -> None:
+        # waiters must not be cancelled together with the leader, they queue their requests instead
+        if not future.done():
+            future.set_exception(
+                error if isinstance(error, Exception) else RuntimeError("Signing request was cancelled")
+            )
+            future.exception()  # mark as retrieved, there might be no waiters
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+
+    async def _sign_single_flight(self, message: str, future: asyncio.Future[str]) -> str:
+        key = message_key(message)
+        try:
+            try:
+                result = await self._upstream_api.sign_message(SynthesiaSignRequest(message=message))
+            except SynthesiaRateLimitError as e:
+                await self._rate_limiter.on_rate_limited(e.retry_after)
+                raise
+            await self._rate_limiter.on_success(result.retry_after)
+            await self._cache.set(message, result.signature)
+            future.set_result(result.signature)
+            return result.signature
+        except BaseException as e:
+            self._release_single_flight(key, future, e)
+            raise
+        finally:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _signed_response(
+        self,
+        request_headers: RequestHeaders,
+        signature: str,
+        background_tasks: BackgroundTasks,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+    ) -> CryptoSignResponse:
+        response = CryptoSignResponse(
+            request_id=request_headers.request_id,
+            status=fastapi.status.HTTP_200_OK,
+            signature=signature,
+        )
+        if webhook_url is not None:
+            logger.debug("Notifying webhook %s", webhook_url)
+            background_tasks.add_task(
+                self._webhook_manager.send,
+                webhook_url=str(webhook_url),
+                data=response.model_dump(),
+                batch=webhook_batch,
+            )
+        return response
 
     async def sign_message(
         self,
@@ -35,89 +156,238 @@ class Service:
         message: str,
         background_tasks: BackgroundTasks,
         webhook_url: HttpUrl | None,
+        webhook_batch: bool = False,
+        deadline: float | None = None,
     ) -> CryptoSignResponse | None:
-        logger.info(f"Signing message: {message}")
-        if message in self._cache:
-            response, timestamp = self._cache[message]
-            if time.time() - timestamp < 180:  # 3 minutes hardcoded for simplicity
-                logger.info(f"Returning cached response for message: {message}")
-                if webhook_url is not None:
-                    logger.info(f"Notifying webhook {webhook_url}")
-                    background_tasks.add_task(
-                        process_webhook,
-                        webhook_url=str(webhook_url),
-                        data=response.model_dump(),
-                    )
-                return response
-            else:
-                logger.info(f"Removing cached response for message: {message} as expired")
-                del self._cache[message]
-        request_allowed = await self._rate_limiter.is_request_allowed(request_headers.request_id)
-        if not request_allowed and webhook_url is None:
-            logger.error(
-                f"Request {request_headers.request_id} is rate limited."
-                f"No webhook URL provided. Returning too many requests response."
-            )
-            return CryptoSignResponse(
-                request_id=request_headers.request_id,
-                status=fastapi.status.HTTP_429_TOO_MANY_REQUESTS,
-                message="Too many requests. Please provide webhook URL "
-                "to receive a response when the signature is ready.",
+        # every stage uses what is left of the deadline, once it is spent the request is answered with 202
+        logger.debug("Signing message of length %d for request %s", len(message), request_headers.request_id)
+        self._record_requested([message])
+        key = message_key(message)
+        leader: asyncio.Future[str] | None = None
+        request_allowed = False
+        try:
+            async with asyncio.timeout(self._time_left(deadline)):
+                signature, outcome, leader = await self._lookup(message, key)
+                if leader is not None:
+                    request_allowed = await self._rate_limiter.is_request_allowed(request_headers.request_id)
+        except BaseException as e:
+            if leader is not None:
+                self._release_single_flight(key, leader, e)
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            logger.warning(f"Request {request_headers.request_id} ran out of its deadline, queueing it")
+            return await self._enqueue(request_headers, message, webhook_url, webhook_batch)
+        if signature is not None:
+            logger.debug("Returning %s response for request %s", outcome, request_headers.request_id)
+            SIGN_REQUESTS.labels(outcome).inc()
+            return self._signed_response(request_headers, signature, background_tasks, webhook_url, webhook_batch)
+        if leader is not None and not request_allowed:
+            # requests waiting for this one queue theirs as well, the queue merges them into one upstream call
+            self._release_single_flight(key, leader, RuntimeError("No rate limit slot for the message"))
+        elif leader is not None:
+            response = await self._sign_as_leader(
+                request_headers, message, leader, background_tasks, webhook_url, webhook_batch, deadline
             )
-        if request_allowed:
-            try:
-                result = await self._upstream_api.sign_message(SynthesiaSignRequest(message=message))
-                response = CryptoSignResponse(
-                    request_id=request_headers.request_id,
-                    status=fastapi.status.HTTP_200_OK,
-                    signature=result.signature,
-                )
-                if webhook_url is not None:
-                    logger.info(f"Notifying webhook {webhook_url}")
-                    background_tasks.add_task(
-                        process_webhook,
-                        webhook_url=str(webhook_url),
-                        data=response.model_dump(),
-                    )
-                self._cache[message] = (response, time.time())
+            if response is not None:
                 return response
-            except Exception as e:
-                logger.exception(f"Error signing message: {e}")
+        return await self._enqueue(request_headers, message, webhook_url, webhook_batch)
 
-        if webhook_url is None:
-            logger.error(
-                f"Request {request_headers.request_id} failed.No webhook URL provided. Returning error response."
-            )
-            return CryptoSignResponse(
-                request_id=request_headers.request_id,
-                status=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
-                message="Error signing message.",
+    async def _sign_as_leader(
+        self,
+        request_headers: RequestHeaders,
+        message: str,
+        leader: asyncio.Future[str],
+        background_tasks: BackgroundTasks,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+        deadline: float | None,
+    ) -> CryptoSignResponse | None:
+        # signs with the rate slot taken, None if the upstream call failed and the request is to be queued
+        sign_task = asyncio.create_task(self._sign_single_flight(message, leader))
+        try:
+            done, _ = await asyncio.wait({sign_task}, timeout=self._time_left(deadline))
+        except asyncio.CancelledError:
+            # client went away, the rate slot is already spent, so the result is still stored and sent
+            self._detach(sign_task, request_headers, message, webhook_url, webhook_batch)
+            raise
+        if not done:
+            logger.info(
+                "Upstream call of request %s exceeded its deadline, finishing it in the background",
+                request_headers.request_id,
             )
-        enqueued_time = time.time()
+            SIGN_REQUESTS.labels("detached").inc()
+            await self._results.set_pending(request_headers.request_id, request_headers.user_id)
+            self._detach(sign_task, request_headers, message, webhook_url, webhook_batch)
+            return self._queued_response(request_headers.request_id)
+        try:
+            signature = sign_task.result()
+        except Exception as e:
+            logger.exception(f"Error signing message: {e}")
+            return None
+        SIGN_REQUESTS.labels("signed").inc()
+        return self._signed_response(request_headers, signature, background_tasks, webhook_url, webhook_batch)
+
+    def _detach(
+        self,
+        sign_task: asyncio.Task[str],
+        request_headers: RequestHeaders,
+        message: str,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+    ) -> None:
+        task = asyncio.create_task(
+            self._complete_detached(sign_task, request_headers, message, webhook_url, webhook_batch)
+        )
+        self._detached.add(task)
+        task.add_done_callback(self._detached.discard)
+
+    async def _complete_detached(
+        self,
+        sign_task: asyncio.Task[str],
+        request_headers: RequestHeaders,
+        message: str,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+    ) -> None:
+        # the signature is cached by the single flight call, the result is stored for polling and sent to the webhook
+        try:
+            signature = await sign_task
+        except asyncio.CancelledError:
+            logger.warning(f"Detached signing of request {request_headers.request_id} cancelled, queueing it")
+            await self._enqueue(request_headers, message, webhook_url, webhook_batch, admit=False)
+            raise
+        except Exception as e:
+            logger.error(f"Detached signing of request {request_headers.request_id} failed, queueing it: {e}")
+            await self._enqueue(request_headers, message, webhook_url, webhook_batch, admit=False)
+            return
+        response = CryptoSignResponse(
+            request_id=request_headers.request_id,
+            status=fastapi.status.HTTP_200_OK,
+            signature=signature,
+        )
+        await self._results.set_many([response])
+        if webhook_url is not None:
+            await self._webhook_manager.send(str(webhook_url), response.model_dump(), batch=webhook_batch)
+
+    async def _enqueue(
+        self,
+        request_headers: RequestHeaders,
+        message: str,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+        admit: bool = True,
+    ) -> CryptoSignResponse:
+        # shedding raises before anything is stored. requests that were already answered are always queued
+        eta = None
+        if admit and self._admission is not None:
+            (eta,) = await self._admission.admit(request_headers.user_id)
         try:
-            # add to queue only if webhook_url is provided
-            logger.info(f"Adding request {request_headers.request_id} to queue.")
+            # requests without webhook are queued as well, clients poll the result store for them
+            logger.debug("Adding request %s to queue.", request_headers.request_id)
+            await self._results.set_pending(request_headers.request_id, request_headers.user_id)
             await self._queue.add(
-                SignRequest(
-                    message=message,
-                    webhook_url=webhook_url,
-                    metadata=RequestMetadata(
-                        request_id=request_headers.request_id,
-                        created_at=enqueued_time,
-                        retries=0,
-                        updated_at=enqueued_time,
-                    ),
-                ),
-            )
-            return CryptoSignResponse(
-                request_id=request_headers.request_id,
-                status=fastapi.status.HTTP_202_ACCEPTED,
-                message="Your request is being processed asynchronously.",
+                self._sign_request(request_headers.request_id, request_headers, message, webhook_url, webhook_batch)
             )
+            SIGN_REQUESTS.labels("queued").inc()
+            return self._queued_response(request_headers.request_id, eta)
         except Exception as queue_error:
             logger.error(f"Failed to queue request: {queue_error}")
-            return CryptoSignResponse(
-                request_id=request_headers.request_id,
-                status=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
-                message="Error processing your request.",
+            SIGN_REQUESTS.labels("error").inc()
+            return self._error_response(request_headers.request_id)
+
+    async def sign_batch(
+        self,
+        request_headers: RequestHeaders,
+        messages: list[str],
+        background_tasks: BackgroundTasks,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool = False,
+    ) -> list[CryptoSignResponse]:
+        # cache hits are answered right away and the rest is queued in one transaction. batches don't take
+        # synchronous rate slots, so a large batch can't use up the budget of interactive requests
+        unique_messages = list(dict.fromkeys(messages))
+        self._record_requested(messages)
+        logger.debug(
+            "Signing batch %s of %d messages, %d unique",
+            request_headers.request_id,
+            len(messages),
+            len(unique_messages),
+        )
+        responses: dict[str, CryptoSignResponse] = {}
+        queued: list[SignRequest] = []
+        for message, signature in zip(unique_messages, await self._cache.get_many(unique_messages), strict=True):
+            request_id = str(uuid.uuid4())
+            if signature is not None:
+                responses[message] = CryptoSignResponse(
+                    request_id=request_id,
+                    status=fastapi.status.HTTP_200_OK,
+                    signature=signature,
+                )
+            else:
+                responses[message] = self._queued_response(request_id)
+                queued.append(self._sign_request(request_id, request_headers, message, webhook_url, webhook_batch))
+        signed = [response for response in responses.values() if response.signature is not None]
+        if queued and self._admission is not None:
+            # the whole batch is shed if its queued part doesn't fit
+            for request, eta in zip(
+                queued, await self._admission.admit(request_headers.user_id, len(queued)), strict=True
+            ):
+                responses[request["message"]].eta = eta
+        SIGN_REQUESTS.labels("cached").inc(len(signed))
+        if queued:
+            try:
+                await self._results.set_pending_many(
+                    {request["metadata"]["request_id"]: request_headers.user_id for request in queued}
+                )
+                await self._queue.add_many(queued)
+                SIGN_REQUESTS.labels("queued").inc(len(queued))
+            except Exception as queue_error:
+                logger.error(f"Failed to queue batch {request_headers.request_id}: {queue_error}")
+                SIGN_REQUESTS.labels("error").inc(len(queued))
+                for request in queued:
+                    responses[request["message"]] = self._error_response(request["metadata"]["request_id"])
+        if webhook_url is not None and signed:
+            background_tasks.add_task(
+                self._webhook_manager.send_many,
+                [(str(webhook_url), response.model_dump(), webhook_batch, None) for response in signed],
             )
+        return [responses[message] for message in messages]
+
+    @staticmethod
+    def _sign_request(
+        request_id: str,
+        request_headers: RequestHeaders,
+        message: str,
+        webhook_url: HttpUrl | None,
+        webhook_batch: bool,
+    ) -> SignRequest:
+        enqueued_time = time.time()
+        return SignRequest(
+            message=message,
+            webhook_url=str(webhook_url) if webhook_url is not None else None,
+            webhook_batch=webhook_batch,
+            metadata=RequestMetadata(
+                request_id=request_id,
+                created_at=enqueued_time,
+                retries=0,
+                updated_at=enqueued_time,
+                user_id=request_headers.user_id,
+            ),
+        )
+
+    @staticmethod
+    def _queued_response(request_id: str, eta: float | None = None) -> CryptoSignResponse:
+        return CryptoSignResponse(
+            request_id=request_id,
+            status=fastapi.status.HTTP_202_ACCEPTED,
+            message=f"Your request is being processed asynchronously. Poll /crypto/sign/{request_id} for the result.",
+            eta=eta,
+        )
+
+    @staticmethod
+    def _error_response(request_id: str) -> CryptoSignResponse:
+        return CryptoSignResponse(
+            request_id=request_id,
+            status=fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR,
+            message="Error processing your request.",
+        )
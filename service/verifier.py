@@ -0,0 +1,139 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import logging
+import math
+
+from fastapi import HTTPException, status
+from prometheus_client import Counter
+from redis.asyncio.client import Redis
+
+from service.cache import SignatureCache
+from service.rate_limiter import RateLimiter
+from upstream.synthesia_api import SynthesiaAPI, SynthesiaRateLimitError, SynthesiaVerifyRequest
+
+
+# optional, pip install cryptography
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519, padding, rsa
+except ImportError:
+    serialization = None
+
+logger = logging.getLogger(__name__)
+
+VERIFY_REQUESTS = Counter(
+    "verify_requests_total",
+    "Verify requests by how they were answered, cached, issued, local or upstream",
+    ("outcome",),
+)
+
+
+def pair_key(message: str, signature: str) -> str:
+    # the message length keeps apart pairs that concatenate to the same string
+    return hashlib.sha256(f"{len(message)}:{message}{signature}".encode("utf-8")).hexdigest()
+
+
+def _decode_signature(signature: str) -> bytes:
+    try:
+        return base64.b64decode(signature, validate=True)
+    except binascii.Error:
+        return base64.urlsafe_b64decode(signature + "=" * (-len(signature) % 4))
+
+
+class PublicKey:
+    # verifies signatures of the upstream signing key locally, RSA PKCS#1 v1.5, ECDSA or Ed25519 over SHA-256
+    def __init__(self, pem: str) -> None:
+        if serialization is None:
+            raise RuntimeError("cryptography package is not installed")
+        self._key = serialization.load_pem_public_key(pem.encode("utf-8"))
+        if not isinstance(self._key, (rsa.RSAPublicKey, ec.EllipticCurvePublicKey, ed25519.Ed25519PublicKey)):
+            raise ValueError(f"Unsupported public key type {type(self._key).__name__}")
+
+    def verify(self, message: str, signature: str) -> bool:
+        try:
+            raw_signature = _decode_signature(signature)
+        except (binascii.Error, ValueError):
+            return False
+        data = message.encode("utf-8")
+        try:
+            if isinstance(self._key, rsa.RSAPublicKey):
+                self._key.verify(raw_signature, data, padding.PKCS1v15(), hashes.SHA256())
+            elif isinstance(self._key, ec.EllipticCurvePublicKey):
+                self._key.verify(raw_signature, data, ec.ECDSA(hashes.SHA256()))
+            else:
+                self._key.verify(raw_signature, data)
+        except InvalidSignature:
+            return False
+        return True
+
+
+class SignatureVerifier:
+    # answers verify requests without spending upstream budget whenever possible: from earlier results of the
+    # same pair, from signatures this service issued, or locally with the upstream public key. only without a
+    # public key unknown pairs are verified upstream, through the shared rate limiter
+    def __init__(
+        self,
+        redis_client: Redis,
+        cache: SignatureCache,
+        upstream_api: SynthesiaAPI,
+        rate_limiter: RateLimiter,
+        public_key: str | None = None,
+        ttl: float = 86400,
+    ) -> None:
+        self._redis_client = redis_client
+        self._cache = cache
+        self._upstream_api = upstream_api
+        self._rate_limiter = rate_limiter
+        self._prefix = "verified:"
+        self._ttl = ttl
+        self._public_key: PublicKey | None = None
+        if public_key:
+            if serialization is None:
+                logger.warning("Public key configured but cryptography is not installed, verifying upstream")
+            else:
+                self._public_key = PublicKey(public_key)
+
+    async def verify(self, request_id: str, message: str, signature: str, timeout: float) -> bool:
+        # raises 429 if upstream verification can't get a rate limit slot within timeout
+        key = f"{self._prefix}{pair_key(message, signature)}"
+        verified, issued_signature = await asyncio.gather(self._redis_client.get(key), self._cache.get(message))
+        if verified is not None:
+            VERIFY_REQUESTS.labels("cached").inc()
+            return verified in (b"1", "1")
+        if issued_signature == signature:
+            # signed by upstream for this service
+            outcome, valid = "issued", True
+        elif self._public_key is not None:
+            outcome, valid = "local", self._public_key.verify(message, signature)
+        else:
+            outcome, valid = "upstream", await self._verify_upstream(request_id, message, signature, timeout)
+        VERIFY_REQUESTS.labels(outcome).inc()
+        logger.debug("Request %s verified %s: %s", request_id, outcome, valid)
+        await self._redis_client.set(key, "1" if valid else "0", px=int(self._ttl * 1000))
+        return valid
+
+    async def _verify_upstream(self, request_id: str, message: str, signature: str, timeout: float) -> bool:
+        if not await self._rate_limiter.acquire(request_id, timeout):
+            raise self._rate_limited(await self._rate_limiter.time_until_next_slot())
+        try:
+            result = await self._upstream_api.verify_signature(
+                SynthesiaVerifyRequest(message=message, signature=signature)
+            )
+        except SynthesiaRateLimitError as e:
+            await self._rate_limiter.on_rate_limited(e.retry_after)
+            raise self._rate_limited(e.retry_after or await self._rate_limiter.time_until_next_slot()) from e
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Upstream verification failed") from e
+        await self._rate_limiter.on_success(result.retry_after)
+        return result.valid
+
+    @staticmethod
+    def _rate_limited(retry_after: float) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Upstream verification is rate limited, retry later",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
@@ -1,29 +1,616 @@
-from typing import Any
+from collections import OrderedDict
+from typing import Any, NotRequired, TypedDict
+from urllib.parse import urlsplit
 import asyncio
+import hashlib
+import json
 import logging
+import random
+import time
+import uuid
 
+from prometheus_client import Counter, Gauge, Histogram
+from redis.asyncio.client import Redis
 import httpx
 
+from service.dead_letters import WEBHOOK, DeadLetterQueue
+from utils.metrics import DURATION_BUCKETS
+
 
 logger = logging.getLogger(__name__)
 
+WEBHOOK_REQUEST_DURATION = Histogram(
+    "webhook_request_duration_seconds",
+    "Duration of webhook posts by response status",
+    ("status",),
+    buckets=DURATION_BUCKETS,
+)
+WEBHOOK_RETRIES = Counter("webhook_retries_total", "Webhook deliveries rescheduled after a failed attempt")
+WEBHOOK_FAILURES = Counter("webhook_failures_total", "Webhook deliveries given up after the last attempt")
+WEBHOOK_OUTBOX_DEPTH = Gauge("webhook_outbox_depth", "Webhook deliveries waiting in the outbox")
+END_TO_END_DURATION = Histogram(
+    "sign_request_end_to_end_seconds",
+    "Time from enqueueing a sign request to its webhook being delivered",
+    buckets=DURATION_BUCKETS,
+)
+
+# batch deliveries wait in a set per url, which has a single group entry in the outbox. the group is due
+# at the earliest due time of its deliveries, so the first delivery for a url opens the flush window and
+# the following ones join it.
+# KEYS: outbox, url set, delivery hash, notify list, groups set.
+# ARGV: delivery id, due time, group entry, data, url hash
+ADD_BATCH_SCRIPT = """
+redis.call("HSET", KEYS[3], "data", ARGV[4], "group", ARGV[5])
+redis.call("ZADD", KEYS[2], ARGV[2], ARGV[1])
+redis.call("SADD", KEYS[5], ARGV[5])
+local due = redis.call("ZSCORE", KEYS[1], ARGV[3])
+if not due or tonumber(due) > tonumber(ARGV[2]) then
+    redis.call("ZADD", KEYS[1], ARGV[2], ARGV[3])
+end
+redis.call("LPUSH", KEYS[4], 1)
+redis.call("LTRIM", KEYS[4], 0, 0)
+"""
+
+# lease due deliveries, same visibility timeout semantics as the request queue. a due group entry leases
+# up to group limit due deliveries of its url at once, they stay in the outbox under their own id until acked.
+# retries waiting out their backoff stay in the url set, the group entry is due again at the earliest of them.
+# a batch delivery whose lease expired goes back to its url set, so it is sent with the next batch. that
+# doesn't count against the limit, the due range is read again to pick up its group.
+# KEYS: outbox, notify list, groups set.
+# ARGV: now, lease expiry, limit, lease token, delivery key prefix, url set prefix, group limit
+CLAIM_SCRIPT = """
+local limit, group_limit = tonumber(ARGV[3]), tonumber(ARGV[7])
+local claimed = {}
+local units = 0
+local function lease(id)
+    local key = ARGV[5] .. id
+    local data = redis.call("HGET", key, "data")
+    if data then
+        redis.call("ZADD", KEYS[1], ARGV[2], id)
+        redis.call("HSET", key, "lease", ARGV[4])
+        table.insert(claimed, data)
+    end
+    return data
+end
+for _ = 1, 3 do
+    local ids = redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, limit - units + group_limit)
+    if #ids == 0 then
+        break
+    end
+    for _, id in ipairs(ids) do
+        if units >= limit then
+            break
+        end
+        if string.sub(id, 1, 6) == "batch:" then
+            local group = string.sub(id, 7)
+            local url_set = ARGV[6] .. group
+            local leased = 0
+            for _, batch_id in ipairs(redis.call("ZRANGEBYSCORE", url_set, "-inf", ARGV[1], "LIMIT", 0, group_limit)) do
+                redis.call("ZREM", url_set, batch_id)
+                if lease(batch_id) then
+                    leased = leased + 1
+                end
+            end
+            local next_due = redis.call("ZRANGE", url_set, 0, 0, "WITHSCORES")
+            if #next_due > 0 then
+                redis.call("ZADD", KEYS[1], next_due[2], id)
+            else
+                redis.call("ZREM", KEYS[1], id)
+                redis.call("SREM", KEYS[3], group)
+            end
+            if leased > 0 then
+                units = units + 1
+            end
+        else
+            local group = redis.call("HGET", ARGV[5] .. id, "group")
+            if group then
+                redis.call("ZREM", KEYS[1], id)
+                redis.call("HDEL", ARGV[5] .. id, "lease")
+                redis.call("ZADD", ARGV[6] .. group, ARGV[1], id)
+                redis.call("ZADD", KEYS[1], ARGV[1], "batch:" .. group)
+                redis.call("SADD", KEYS[3], group)
+            elseif lease(id) then
+                units = units + 1
+            else
+                redis.call("ZREM", KEYS[1], id)
+            end
+        end
+    end
+    if units >= limit then
+        break
+    end
+end
+if #claimed > 0 and #redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[1], "LIMIT", 0, 1) > 0 then
+    redis.call("LPUSH", KEYS[2], 1)
+    redis.call("LTRIM", KEYS[2], 0, 0)
+end
+return claimed
+"""
+
+# KEYS: outbox, delivery hash. ARGV: delivery id, lease token
+ACK_SCRIPT = """
+local lease = redis.call("HGET", KEYS[2], "lease")
+if lease and lease ~= ARGV[2] then
+    return 0
+end
+redis.call("DEL", KEYS[2])
+redis.call("ZREM", KEYS[1], ARGV[1])
+return 1
+"""
+
+# batch deliveries are rescheduled to their url set, so retries are batched as well.
+# KEYS: outbox, delivery hash, notify list, groups set.
+# ARGV: delivery id, lease token, data, due time, url set prefix
+RESCHEDULE_SCRIPT = """
+if redis.call("HGET", KEYS[2], "lease") ~= ARGV[2] then
+    return 0
+end
+redis.call("HSET", KEYS[2], "data", ARGV[3])
+redis.call("HDEL", KEYS[2], "lease")
+local group = redis.call("HGET", KEYS[2], "group")
+if group then
+    local entry = "batch:" .. group
+    redis.call("ZREM", KEYS[1], ARGV[1])
+    redis.call("ZADD", ARGV[5] .. group, ARGV[4], ARGV[1])
+    redis.call("SADD", KEYS[4], group)
+    local due = redis.call("ZSCORE", KEYS[1], entry)
+    if not due or tonumber(due) > tonumber(ARGV[4]) then
+        redis.call("ZADD", KEYS[1], ARGV[4], entry)
+    end
+else
+    redis.call("ZADD", KEYS[1], ARGV[4], ARGV[1])
+end
+redis.call("LPUSH", KEYS[3], 1)
+redis.call("LTRIM", KEYS[3], 0, 0)
+return 1
+"""
+
+
+# deliveries in the outbox, batch deliveries are counted in their url sets instead of their group entry.
+# KEYS: outbox, groups set. ARGV: url set prefix
+DEPTH_SCRIPT = """
+local depth = redis.call("ZCARD", KEYS[1])
+for _, group in ipairs(redis.call("SMEMBERS", KEYS[2])) do
+    local pending = redis.call("ZCARD", ARGV[1] .. group)
+    if pending > 0 then
+        depth = depth - 1 + pending
+    end
+end
+return depth
+"""
+
+
+class WebhookDelivery(TypedDict):
+    delivery_id: str
+    webhook_url: str
+    data: dict[str, Any]
+    attempts: int
+    created_at: float
+    # receiver accepts several results for the url as one JSON array
+    batch: NotRequired[bool]
+    # enqueue time of the sign request the result belongs to
+    enqueued_at: NotRequired[float]
+    # [time, error] of every failed attempt
+    history: NotRequired[list[list[Any]]]
+
+
+class WebhookOutbox:
+    # redis persisted deliveries ordered by next attempt time, survive restarts
+    def __init__(self, name: str, redis_client: Redis) -> None:
+        self.name = name
+        self._redis_client = redis_client
+        self._notify_key = f"{name}:notify"
+        self._delivery_key_prefix = f"{name}:delivery:"
+        # batch deliveries waiting for their url's flush window, keyed by url hash
+        self._url_set_prefix = f"{name}:batch:"
+        self._groups_key = f"{name}:groups"
+        self._add_batch_script = redis_client.register_script(ADD_BATCH_SCRIPT)
+        self._claim_script = redis_client.register_script(CLAIM_SCRIPT)
+        self._ack_script = redis_client.register_script(ACK_SCRIPT)
+        self._reschedule_script = redis_client.register_script(RESCHEDULE_SCRIPT)
+        self._depth_script = redis_client.register_script(DEPTH_SCRIPT)
+
+    def _delivery_key(self, delivery_id: str) -> str:
+        return f"{self._delivery_key_prefix}{delivery_id}"
+
+    @staticmethod
+    def _url_hash(webhook_url: str) -> str:
+        return hashlib.sha256(webhook_url.encode("utf-8")).hexdigest()[:32]
+
+    async def add_many(self, deliveries: list[tuple[WebhookDelivery, float]]) -> None:
+        # enqueue (delivery, due time) pairs in a single round trip
+        if not deliveries:
+            return
+        pipeline = self._redis_client.pipeline()
+        for delivery, due_at in deliveries:
+            delivery_id = delivery["delivery_id"]
+            if delivery.get("batch"):
+                url_hash = self._url_hash(delivery["webhook_url"])
+                await self._add_batch_script(
+                    keys=[
+                        self.name,
+                        f"{self._url_set_prefix}{url_hash}",
+                        self._delivery_key(delivery_id),
+                        self._notify_key,
+                        self._groups_key,
+                    ],
+                    args=[delivery_id, due_at, f"batch:{url_hash}", json.dumps(delivery), url_hash],
+                    client=pipeline,
+                )
+                continue
+            pipeline.hset(self._delivery_key(delivery_id), mapping={"data": json.dumps(delivery)})
+            pipeline.zadd(self.name, {delivery_id: due_at})
+        pipeline.lpush(self._notify_key, 1)
+        pipeline.ltrim(self._notify_key, 0, 0)
+        await pipeline.execute()
+
+    async def depth(self) -> int:
+        return await self._depth_script(keys=[self.name, self._groups_key], args=[self._url_set_prefix])
+
+    async def next_due_in(self) -> float | None:
+        earliest = await self._redis_client.zrange(self.name, 0, 0, withscores=True)
+        if not earliest:
+            return None
+        _, next_attempt = earliest[0]
+        return max(0.0, next_attempt - time.time())
+
+    async def wait(self, timeout: float) -> None:
+        await self._redis_client.blpop([self._notify_key], timeout=max(timeout, 0.01))
+
+    async def claim(
+        self,
+        lease_token: str,
+        visibility_timeout: float,
+        limit: int = 1,
+        group_limit: int = 100,
+    ) -> list[WebhookDelivery]:
+        # leases limit due entries, a single delivery or up to group_limit batch deliveries of one url each
+        now = time.time()
+        claimed = await self._claim_script(
+            keys=[self.name, self._notify_key, self._groups_key],
+            args=[
+                now,
+                now + visibility_timeout,
+                limit,
+                lease_token,
+                self._delivery_key_prefix,
+                self._url_set_prefix,
+                group_limit,
+            ],
+        )
+        return [json.loads(delivery_data) for delivery_data in claimed]
+
+    async def ack(self, delivery_id: str, lease_token: str) -> bool:
+        return bool(
+            await self._ack_script(
+                keys=[self.name, self._delivery_key(delivery_id)],
+                args=[delivery_id, lease_token],
+            )
+        )
+
+    async def reschedule(self, delivery: WebhookDelivery, lease_token: str, next_attempt: float) -> bool:
+        return (await self.reschedule_many([delivery], lease_token, next_attempt))[0]
+
+    async def reschedule_many(
+        self,
+        deliveries: list[WebhookDelivery],
+        lease_token: str,
+        next_attempt: float,
+    ) -> list[bool]:
+        # hands leased deliveries back in a single round trip
+        pipeline = self._redis_client.pipeline()
+        for delivery in deliveries:
+            delivery_id = delivery["delivery_id"]
+            await self._reschedule_script(
+                keys=[self.name, self._delivery_key(delivery_id), self._notify_key, self._groups_key],
+                args=[delivery_id, lease_token, json.dumps(delivery), next_attempt, self._url_set_prefix],
+                client=pipeline,
+            )
+        return [bool(rescheduled) for rescheduled in await pipeline.execute()]
+
+
+class HostLimiter:
+    # limits concurrent deliveries to each receiver host. a host's semaphore only lives while deliveries
+    # use it, so the state doesn't grow with every host ever delivered to
+    def __init__(self, limit: int) -> None:
+        self._limit = limit
+        # host -> semaphore and number of deliveries holding or waiting for it
+        self._hosts: dict[str, tuple[asyncio.Semaphore, int]] = {}
 
-async def process_webhook(
-    webhook_url: str,
-    data: dict[str, Any],
-    timeout: float = 10,
-    max_retries: int = 3,
-) -> None:
-    async with httpx.AsyncClient() as client:
-        for attempt in range(max_retries):
+    def __len__(self) -> int:
+        return len(self._hosts)
+
+    async def acquire(self, host: str, timeout: float) -> bool:
+        # takes a slot of the host, False if none freed within timeout
+        semaphore, users = self._hosts.get(host, (asyncio.Semaphore(self._limit), 0))
+        self._hosts[host] = (semaphore, users + 1)
+        try:
+            async with asyncio.timeout(max(0.0, timeout)):
+                await semaphore.acquire()
+            return True
+        except TimeoutError:
+            self._leave(host)
+            return False
+        except BaseException:
+            self._leave(host)
+            raise
+
+    def release(self, host: str) -> None:
+        self._hosts[host][0].release()
+        self._leave(host)
+
+    def _leave(self, host: str) -> None:
+        semaphore, users = self._hosts[host]
+        if users == 1:
+            del self._hosts[host]
+        else:
+            self._hosts[host] = (semaphore, users - 1)
+
+
+class WebhookProducer:
+    # hands results to the outbox, processes that only accept requests need nothing else. the senders of a
+    # WebhookManager, in the same or another process, deliver them
+    def __init__(self, outbox: WebhookOutbox, batch_flush_window: float = 2) -> None:
+        self._outbox = outbox
+        # batch deliveries are held back for the flush window, so results for the same url are sent together
+        self._batch_flush_window = batch_flush_window
+
+    async def send(
+        self,
+        webhook_url: str,
+        data: dict[str, Any],
+        batch: bool = False,
+        enqueued_at: float | None = None,
+    ) -> None:
+        await self.send_many([(webhook_url, data, batch, enqueued_at)])
+
+    async def send_many(self, deliveries: list[tuple[str, dict[str, Any], bool, float | None]]) -> None:
+        # enqueue (webhook_url, data, batch, enqueued_at) results in a single round trip
+        now = time.time()
+        outbox_deliveries = []
+        for webhook_url, data, batch, enqueued_at in deliveries:
+            delivery = WebhookDelivery(
+                delivery_id=uuid.uuid4().hex,
+                webhook_url=webhook_url,
+                data=data,
+                attempts=0,
+                created_at=now,
+                batch=batch,
+            )
+            if enqueued_at is not None:
+                delivery["enqueued_at"] = enqueued_at
+            outbox_deliveries.append((delivery, now + self._batch_flush_window if batch else now))
+        await self._outbox.add_many(outbox_deliveries)
+
+    async def collect_metrics(self) -> None:
+        WEBHOOK_OUTBOX_DEPTH.set(await self._outbox.depth())
+
+    async def close(self) -> None:
+        # nothing to release, the outbox uses the shared redis client
+        pass
+
+
+class WebhookManager(WebhookProducer):
+    def __init__(
+        self,
+        outbox: WebhookOutbox,
+        senders: int = 10,
+        per_host_limit: int = 4,
+        timeout: float = 10,
+        max_retries: int = 3,
+        backoff_base: float = 1,
+        backoff_max: float = 60,
+        max_idle_wait: float = 60,
+        batch_flush_window: float = 2,
+        batch_max_size: int = 100,
+        batch_unsupported_ttl: float = 3600,
+        batch_unsupported_size: int = 10000,
+        dead_letters: DeadLetterQueue | None = None,
+    ) -> None:
+        super().__init__(outbox, batch_flush_window)
+        self._senders = senders
+        # limits concurrent deliveries to one receiver, so a slow host can't take all senders
+        self._per_host_limit = per_host_limit
+        self._hosts = HostLimiter(per_host_limit)
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._max_idle_wait = max_idle_wait
+        self._batch_max_size = batch_max_size
+        # url -> time until which results are delivered one by one, receiver rejected a batch. least recently
+        # rejected urls are dropped beyond batch_unsupported_size, they are tried with a batch again
+        self._batch_unsupported: OrderedDict[str, float] = OrderedDict()
+        self._batch_unsupported_ttl = batch_unsupported_ttl
+        self._batch_unsupported_size = batch_unsupported_size
+        # deliveries out of retries are kept here for inspection and replay instead of being dropped
+        self._dead_letters = dead_letters
+        # lease must outlive a single delivery attempt
+        self._visibility_timeout = timeout * 3
+        # posts queue here rather than in the connection pool, where waiting counts against the timeout
+        self._connections = asyncio.Semaphore(senders)
+        self._client = httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=senders, max_keepalive_connections=senders),
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def process(self) -> None:
+        logger.info(f"Starting {self._senders} webhook senders for outbox {self._outbox.name}")
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                for sender_id in range(self._senders):
+                    task_group.create_task(self._sender(sender_id))
+        except asyncio.CancelledError:
+            logger.info("Webhook manager cancelled")
+            raise
+
+    async def _sender(self, sender_id: int) -> None:
+        while True:
             try:
-                response = await client.post(webhook_url, json=data, timeout=timeout)
-                response.raise_for_status()
-                logger.info(f"Webhook sent to {webhook_url}, status: {response.status_code}")
+                next_due_in = await self._outbox.next_due_in()
+                if next_due_in is None or next_due_in > 0:
+                    timeout = self._max_idle_wait if next_due_in is None else min(next_due_in, self._max_idle_wait)
+                    await self._outbox.wait(timeout)
+                    continue
+                lease_token = uuid.uuid4().hex
+                lease_expires_at = time.monotonic() + self._visibility_timeout
+                # a single delivery or the batch deliveries of one url, so a sender posts one request at a time
+                claimed = await self._outbox.claim(
+                    lease_token, self._visibility_timeout, group_limit=self._batch_max_size
+                )
+                if claimed:
+                    await self._deliver_group(claimed, lease_token, lease_expires_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Error in webhook sender {sender_id} main loop: {e}")
+                await asyncio.sleep(1)
+
+    def _accepts_batch(self, webhook_url: str) -> bool:
+        unsupported_until = self._batch_unsupported.get(webhook_url)
+        if unsupported_until is None:
+            return True
+        if unsupported_until < time.time():
+            del self._batch_unsupported[webhook_url]
+            return True
+        return False
+
+    def _reject_batches(self, webhook_url: str) -> None:
+        self._batch_unsupported[webhook_url] = time.time() + self._batch_unsupported_ttl
+        self._batch_unsupported.move_to_end(webhook_url)
+        while len(self._batch_unsupported) > self._batch_unsupported_size:
+            self._batch_unsupported.popitem(last=False)
+
+    def _backoff(self, attempts: int) -> float:
+        # full jitter, so retries to a recovering receiver are spread out
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2**attempts))
+
+    async def _deliver_group(
+        self,
+        deliveries: list[WebhookDelivery],
+        lease_token: str,
+        lease_expires_at: float,
+    ) -> None:
+        webhook_url = deliveries[0]["webhook_url"]
+        batch = deliveries[0].get("batch", False)
+        if batch and not self._accepts_batch(webhook_url):
+            if len(deliveries) > 1:
+                # receiver rejected batches, post as many results one by one as the host may take concurrently
+                # and hand the rest back to the other senders
+                await self._outbox.reschedule_many(deliveries[self._per_host_limit :], lease_token, time.time())
+                await asyncio.gather(
+                    *(
+                        self._deliver_group([delivery], lease_token, lease_expires_at)
+                        for delivery in deliveries[: self._per_host_limit]
+                    )
+                )
                 return
-            except Exception:
-                # todo: update any monitoring metrics
-                logger.exception(f"Error sending webhook to {webhook_url}.")
-                if attempt < max_retries - 1:
-                    logger.info(f"Retrying webhook to {webhook_url} in {2**attempt} seconds")
-                    await asyncio.sleep(2**attempt)
+            batch = False
+        # a saturated host is waited for as long as the lease leaves room for the post, senders don't claim
+        # and hand back the same deliveries while its slots are taken
+        host = urlsplit(webhook_url).netloc
+        if not await self._hosts.acquire(host, lease_expires_at - self._timeout - time.monotonic()):
+            logger.info("Webhook host of %s stayed saturated, handing %d deliveries back", webhook_url, len(deliveries))
+            await self._outbox.reschedule_many(deliveries, lease_token, time.time() + self._backoff(0))
+            return
+        try:
+            if batch:
+                delivered, failed, error = await self._deliver_batch(webhook_url, deliveries, lease_token)
+            else:
+                response, error = await self._post(webhook_url, deliveries[0]["data"])
+                failed = deliveries if response is None or response.is_error else []
+                delivered = [] if failed else deliveries
+        finally:
+            self._hosts.release(host)
+        for delivery in delivered:
+            await self._outbox.ack(delivery["delivery_id"], lease_token)
+            if "enqueued_at" in delivery:
+                END_TO_END_DURATION.observe(time.time() - delivery["enqueued_at"])
+        for delivery in failed:
+            await self._retry(delivery, lease_token, error)
+
+    async def _post(
+        self,
+        webhook_url: str,
+        data: dict[str, Any] | list[dict[str, Any]],
+    ) -> tuple[httpx.Response | None, str | None]:
+        # returns the response, None if the post failed, and the error recorded in the attempt history
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self._connections:
+                start = time.perf_counter()
+                response = await self._client.post(webhook_url, json=data)
+            status = str(response.status_code)
+            response.raise_for_status()
+            logger.debug("Webhook sent to %s, status: %d", webhook_url, response.status_code)
+            return response, None
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Webhook to {webhook_url} rejected with status {e.response.status_code}")
+            error = f"status {e.response.status_code}"
+            return (e.response if self._rejects_batch(e.response) else None), error
+        except Exception as e:
+            logger.exception(f"Error sending webhook to {webhook_url}.")
+            return None, str(e) or type(e).__name__
+        finally:
+            WEBHOOK_REQUEST_DURATION.labels(status).observe(time.perf_counter() - start)
+
+    @staticmethod
+    def _rejects_batch(response: httpx.Response) -> bool:
+        return response.status_code in (
+            httpx.codes.BAD_REQUEST,
+            httpx.codes.NOT_FOUND,
+            httpx.codes.METHOD_NOT_ALLOWED,
+            httpx.codes.REQUEST_ENTITY_TOO_LARGE,
+            httpx.codes.UNSUPPORTED_MEDIA_TYPE,
+            httpx.codes.UNPROCESSABLE_ENTITY,
+        )
+
+    async def _deliver_batch(
+        self,
+        webhook_url: str,
+        deliveries: list[WebhookDelivery],
+        lease_token: str,
+    ) -> tuple[list[WebhookDelivery], list[WebhookDelivery], str | None]:
+        # posts results as one JSON array, returns delivered and failed deliveries and the error of the post.
+        # receiver may acknowledge a subset by responding {"acknowledged": [request_id, ...]}
+        response, error = await self._post(webhook_url, [delivery["data"] for delivery in deliveries])
+        if response is None:
+            return [], deliveries, error
+        if response.is_error:
+            # receiver doesn't understand batches, deliver the results one by one without spending an attempt
+            logger.warning(f"Webhook {webhook_url} does not accept batches, falling back to single delivery")
+            self._reject_batches(webhook_url)
+            await self._outbox.reschedule_many(deliveries, lease_token, time.time())
+            return [], [], None
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, dict) or not isinstance(body.get("acknowledged"), list):
+            return deliveries, [], None
+        acknowledged = set(body["acknowledged"])
+        delivered = [delivery for delivery in deliveries if delivery["data"].get("request_id") in acknowledged]
+        failed = [delivery for delivery in deliveries if delivery["data"].get("request_id") not in acknowledged]
+        return delivered, failed, None
+
+    async def _retry(self, delivery: WebhookDelivery, lease_token: str, error: str | None) -> None:
+        webhook_url = delivery["webhook_url"]
+        delivery["attempts"] += 1
+        # a batch the receiver did not acknowledge in full has no error of its own
+        error = error or "not acknowledged"
+        delivery.setdefault("history", []).append([time.time(), error])
+        if delivery["attempts"] >= self._max_retries:
+            logger.error(f"Webhook to {webhook_url} failed after {delivery['attempts']} attempts, giving up")
+            WEBHOOK_FAILURES.inc()
+            if self._dead_letters is not None:
+                await self._dead_letters.add(WEBHOOK, dict(delivery), error, delivery["history"])
+            await self._outbox.ack(delivery["delivery_id"], lease_token)
+            return
+        backoff = self._backoff(delivery["attempts"])
+        WEBHOOK_RETRIES.inc()
+        logger.info("Retrying webhook to %s in %.3f seconds", webhook_url, backoff)
+        await self._outbox.reschedule(delivery, lease_token, time.time() + backoff)
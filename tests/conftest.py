@@ -0,0 +1,115 @@
+from collections.abc import AsyncIterator, Callable
+import asyncio
+import json
+
+import fakeredis
+import httpx
+import pytest
+
+from configs.config import SynthesiaAPIConfig
+from service.webhook_manager import WebhookManager, WebhookOutbox
+from upstream.synthesia_api import SynthesiaAPI
+
+
+@pytest.fixture
+async def redis_client() -> AsyncIterator[fakeredis.FakeAsyncRedis]:
+    # scripts run on the Lua runtime of fakeredis, pip install fakeredis[lua]
+    client = fakeredis.FakeAsyncRedis()
+    yield client
+    await client.flushall()
+    await client.aclose()
+
+
+@pytest.fixture
+async def running() -> AsyncIterator[list[asyncio.Task]]:
+    # background tasks of a test, cancelled when it ends
+    tasks: list[asyncio.Task] = []
+    yield tasks
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        # fakeredis doesn't always hand a cancelled blocking command back, such tasks end with the event loop
+        await asyncio.wait(tasks, timeout=1)
+
+
+class FakeUpstream:
+    # answers like the Synthesia API, the signature of a message is "sig-<message>"
+    def __init__(self) -> None:
+        self.calls: list[httpx.Request] = []
+        self.status = 200
+        self.headers: dict[str, str] = {}
+        self.delay = 0.0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append(request)
+        await asyncio.sleep(self.delay)
+        message = request.url.params["message"]
+        if request.url.path == "/crypto/verify":
+            text = "true" if request.url.params["signature"] == f"sig-{message}" else "false"
+        else:
+            text = f"sig-{message}"
+        return httpx.Response(self.status, text=text, headers=self.headers)
+
+
+@pytest.fixture
+def fake_upstream() -> FakeUpstream:
+    return FakeUpstream()
+
+
+@pytest.fixture
+async def upstream_api(monkeypatch: pytest.MonkeyPatch, fake_upstream: FakeUpstream) -> AsyncIterator[SynthesiaAPI]:
+    monkeypatch.setenv("SYNTHESIA_API_KEY", "test")
+    api = SynthesiaAPI(SynthesiaAPIConfig())
+    await api.close()
+    api._client = httpx.AsyncClient(base_url="http://upstream", transport=httpx.MockTransport(fake_upstream.handle))
+    yield api
+    await api.close()
+
+
+class WebhookReceiver:
+    # records posted webhook bodies, responds with status, or batch_status to arrays, after delay
+    def __init__(self) -> None:
+        self.posts: list[tuple[str, object]] = []
+        self.status = 200
+        self.batch_status: int | None = None
+        self.json: object = None
+        self.delay = 0.0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        self.posts.append((str(request.url), body))
+        await asyncio.sleep(self.delay)
+        status = self.batch_status if isinstance(body, list) and self.batch_status is not None else self.status
+        if self.json is not None:
+            return httpx.Response(status, json=self.json)
+        return httpx.Response(status)
+
+
+@pytest.fixture
+def webhook_receiver() -> WebhookReceiver:
+    return WebhookReceiver()
+
+
+@pytest.fixture
+async def make_webhook_manager(
+    redis_client: fakeredis.FakeAsyncRedis,
+    webhook_receiver: WebhookReceiver,
+) -> AsyncIterator[Callable[..., WebhookManager]]:
+    managers: list[WebhookManager] = []
+
+    def make(**kwargs: object) -> WebhookManager:
+        kwargs.setdefault("senders", 2)
+        kwargs.setdefault("max_idle_wait", 1)
+        manager = WebhookManager(WebhookOutbox("webhooks", redis_client), **kwargs)
+        manager._client = httpx.AsyncClient(transport=httpx.MockTransport(webhook_receiver.handle))
+        managers.append(manager)
+        return manager
+
+    yield make
+    for manager in managers:
+        await manager.close()
+
+
+@pytest.fixture
+def webhook_manager(make_webhook_manager: Callable[..., WebhookManager]) -> WebhookManager:
+    return make_webhook_manager()
@@ -0,0 +1,24 @@
+import time
+
+from service.queue import RequestMetadata, SignRequest
+
+
+def make_request(
+    request_id: str,
+    message: str = "hello",
+    user_id: str = "1",
+    due_at: float | None = None,
+    webhook_url: str | None = None,
+) -> SignRequest:
+    now = time.time()
+    return SignRequest(
+        message=message,
+        webhook_url=webhook_url,
+        metadata=RequestMetadata(
+            request_id=request_id,
+            created_at=now,
+            retries=0,
+            updated_at=now if due_at is None else due_at,
+            user_id=user_id,
+        ),
+    )
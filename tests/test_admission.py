@@ -0,0 +1,64 @@
+from fastapi import HTTPException, status
+from redis.asyncio.client import Redis
+import pytest
+
+from service.admission import AdmissionController
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+from tests.helpers import make_request
+
+
+@pytest.fixture
+def queue(redis_client: Redis) -> RequestProcessingQueue:
+    return RequestProcessingQueue("q", redis_client)
+
+
+@pytest.fixture
+def rate_limiter(redis_client: Redis) -> RateLimiter:
+    # one call per second
+    return RateLimiter(redis_client, limit=60, window=60)
+
+
+async def test_eta_follows_queue_position(queue: RequestProcessingQueue, rate_limiter: RateLimiter) -> None:
+    admission = AdmissionController(queue, rate_limiter)
+    await queue.add_many([make_request("r1", "a", user_id="1"), make_request("r2", "b", user_id="1")])
+
+    assert await admission.admit("1", count=2) == [3, 4]
+
+
+async def test_eta_interleaves_users(queue: RequestProcessingQueue, rate_limiter: RateLimiter) -> None:
+    admission = AdmissionController(queue, rate_limiter)
+    await queue.add_many([make_request(f"r{i}", f"m{i}", user_id="1") for i in range(5)])
+
+    # a new user takes turns with user 1 instead of waiting for its whole backlog
+    assert await admission.admit("2", count=2) == [2, 4]
+
+
+async def test_eta_respects_user_rate(queue: RequestProcessingQueue, rate_limiter: RateLimiter) -> None:
+    admission = AdmissionController(queue, rate_limiter, user_rate=0.5)
+
+    assert await admission.admit("1", count=2) == [2, 4]
+
+
+async def test_sheds_over_global_threshold(queue: RequestProcessingQueue, rate_limiter: RateLimiter) -> None:
+    admission = AdmissionController(queue, rate_limiter, max_depth=3)
+    await queue.add_many([make_request(f"r{i}", f"m{i}", user_id=str(i)) for i in range(3)])
+
+    with pytest.raises(HTTPException) as e:
+        await admission.admit("9", count=2)
+
+    assert e.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert e.value.headers == {"Retry-After": "2"}
+
+
+async def test_sheds_over_user_threshold(queue: RequestProcessingQueue, rate_limiter: RateLimiter) -> None:
+    admission = AdmissionController(queue, rate_limiter, max_depth=100, max_user_depth=2)
+    await queue.add_many([make_request("r1", "a", user_id="1"), make_request("r2", "b", user_id="2")])
+
+    assert await admission.admit("1") == [3]
+    with pytest.raises(HTTPException) as e:
+        await admission.admit("1", count=2)
+
+    assert e.value.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    # the user's sub-queue drains at half the budget while user 2 has requests queued
+    assert e.value.headers == {"Retry-After": "2"}
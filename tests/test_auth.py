@@ -0,0 +1,124 @@
+import json
+
+from fastapi import HTTPException
+from redis.asyncio.client import Redis
+import pytest
+
+from utils.auth import ApiKey, ApiKeyRegistry, hash_key
+
+
+async def test_keys_from_file_redis_and_environment(redis_client: Redis, tmp_path: pytest.TempPathFactory) -> None:
+    path = tmp_path / "keys.json"
+    path.write_text(
+        json.dumps(
+            {
+                "keys": [
+                    {"key": "file-key", "user_id": "2", "priority": "high"},
+                    {"key_hash": hash_key("hashed-key"), "user_id": "3"},
+                    {"user_id": "4"},
+                ]
+            }
+        )
+    )
+    await redis_client.hset("api_keys", hash_key("redis-key"), ApiKey(user_id="5", admin=True).model_dump_json())
+    registry = ApiKeyRegistry(redis_client, file_path=str(path), legacy_key="legacy-key")
+
+    await registry.load()
+
+    assert (await registry.authenticate("legacy-key")).model_dump() == {
+        "user_id": "1",
+        "priority": "normal",
+        "admin": False,
+    }
+    assert (await registry.authenticate("file-key")).priority == "high"
+    assert (await registry.authenticate("hashed-key")).user_id == "3"
+    assert (await registry.authenticate("redis-key")).admin
+    with pytest.raises(HTTPException) as e:
+        await registry.authenticate("unknown-key")
+    assert e.value.status_code == 401
+
+
+async def test_invalid_entries_are_skipped(redis_client: Redis) -> None:
+    await redis_client.hset("api_keys", hash_key("broken-key"), "{}")
+    registry = ApiKeyRegistry(redis_client)
+
+    await registry.load()
+
+    with pytest.raises(HTTPException):
+        await registry.authenticate("broken-key")
+
+
+async def test_invalidation_reloads_keys(redis_client: Redis) -> None:
+    registry = ApiKeyRegistry(redis_client)
+    await registry.load()
+    await redis_client.hset("api_keys", hash_key("new-key"), ApiKey(user_id="7").model_dump_json())
+
+    registry.invalidate("other")
+    assert registry._reload_task is None
+    registry.invalidate("api_keys")
+    await registry._reload_task
+
+    assert (await registry.authenticate("new-key")).user_id == "7"
+
+
+async def test_user_weights_use_highest_priority(redis_client: Redis) -> None:
+    for key, priority in (("low-key", "low"), ("high-key", "high")):
+        await redis_client.hset("api_keys", hash_key(key), ApiKey(user_id="1", priority=priority).model_dump_json())
+    registry = ApiKeyRegistry(redis_client)
+    await registry.load()
+
+    assert registry.user_weights({"low": 0.5, "high": 4}) == {"1": 4}
+
+
+async def test_quota_rejects_with_retry_after(redis_client: Redis) -> None:
+    registry = ApiKeyRegistry(redis_client, legacy_key="legacy-key", default_quota=2, quota_window=60)
+    await registry.load()
+
+    await registry.authenticate("legacy-key")
+    await registry.authenticate("legacy-key")
+    with pytest.raises(HTTPException) as e:
+        await registry.authenticate("legacy-key")
+
+    assert e.value.status_code == 429
+    assert int(e.value.headers["Retry-After"]) > 0
+    # polling and admin calls are free
+    await registry.authenticate("legacy-key", cost=0)
+
+
+async def test_quota_is_shared_by_api_processes(redis_client: Redis) -> None:
+    registries = [ApiKeyRegistry(redis_client, legacy_key="legacy-key", default_quota=3) for _ in range(2)]
+    for registry in registries:
+        await registry.load()
+
+    await registries[0].authenticate("legacy-key", cost=2)
+    await registries[1].authenticate("legacy-key")
+    with pytest.raises(HTTPException) as e:
+        await registries[1].authenticate("legacy-key")
+
+    assert e.value.status_code == 429
+
+
+async def test_batch_is_charged_whole_or_not_at_all(redis_client: Redis) -> None:
+    await redis_client.hset("api_keys", hash_key("key"), ApiKey(user_id="2", quota=5).model_dump_json())
+    registry = ApiKeyRegistry(redis_client, quota_window=0.2)
+    await registry.load()
+
+    await registry.authenticate("key", cost=3)
+    with pytest.raises(HTTPException) as e:
+        await registry.authenticate("key", cost=3)
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "1"}
+    # the rejected batch took nothing
+    await registry.authenticate("key", cost=2)
+
+
+async def test_batch_over_whole_quota_is_rejected(redis_client: Redis) -> None:
+    await redis_client.hset("api_keys", hash_key("key"), ApiKey(user_id="2", quota=5).model_dump_json())
+    registry = ApiKeyRegistry(redis_client)
+    await registry.load()
+
+    with pytest.raises(HTTPException) as e:
+        await registry.authenticate("key", cost=6)
+
+    assert e.value.status_code == 413
+    await registry.authenticate("key", cost=5)
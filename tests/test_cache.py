@@ -0,0 +1,108 @@
+import asyncio
+import math
+
+from redis.asyncio.client import Redis
+
+from service.cache import SignatureCache, message_key
+
+
+async def test_set_then_get(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client)
+
+    await cache.set("hello", "sig")
+
+    assert await cache.get("hello") == "sig"
+    assert await cache.get("other") is None
+    assert await redis_client.get(f"signature:{message_key('hello')}") == b"sig"
+
+
+async def test_local_tier_answers_without_redis(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client)
+    await cache.set("hello", "sig")
+
+    await redis_client.flushall()
+
+    assert await cache.get("hello") == "sig"
+
+
+async def test_redis_hit_fills_local_tier(redis_client: Redis) -> None:
+    writer = SignatureCache(redis_client)
+    reader = SignatureCache(redis_client)
+    await writer.set("hello", "sig")
+
+    assert await reader.get("hello") == "sig"
+    await redis_client.flushall()
+
+    assert await reader.get("hello") == "sig"
+
+
+async def test_local_entries_expire_after_local_ttl(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client, local_ttl=0.05)
+    await cache.set("hello", "sig")
+    await redis_client.flushall()
+
+    await asyncio.sleep(0.1)
+
+    assert await cache.get("hello") is None
+
+
+async def test_tracked_local_entries_live_as_long_as_redis_entry(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client, ttl=60, local_ttl=0.05, tracked=True)
+    await cache.set("hello", "sig")
+    await redis_client.flushall()
+
+    await asyncio.sleep(0.1)
+
+    # nothing invalidated the entry
+    assert await cache.get("hello") == "sig"
+
+
+async def test_local_tier_is_bounded(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client, local_size=2)
+    for message in ("a", "b", "c"):
+        await cache.set(message, f"sig-{message}")
+    await redis_client.flushall()
+
+    assert await cache.get_many(["a", "b", "c"]) == [None, "sig-b", "sig-c"]
+
+
+async def test_get_many_mixes_tiers(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client)
+    await cache.set("local", "sig-local")
+    await SignatureCache(redis_client).set("remote", "sig-remote")
+
+    assert await cache.get_many(["local", "missing", "remote"]) == ["sig-local", None, "sig-remote"]
+
+
+async def test_invalidate_drops_local_copies(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client)
+    await cache.set("a", "sig-a")
+    await cache.set("b", "sig-b")
+    await redis_client.flushall()
+
+    cache.invalidate(f"signature:{message_key('a')}")
+    assert await cache.get_many(["a", "b"]) == [None, "sig-b"]
+
+    cache.invalidate(None)
+    assert await cache.get("b") is None
+
+
+async def test_ttls(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client, ttl=60)
+    await cache.set("cached", "sig")
+    await redis_client.set(f"signature:{message_key('forever')}", "sig")
+
+    cached, forever, missing = await cache.ttls(["cached", "forever", "missing"])
+
+    assert 59 < cached <= 60
+    assert forever == math.inf
+    assert missing == 0
+
+
+async def test_lock_refresh_is_taken_once(redis_client: Redis) -> None:
+    cache = SignatureCache(redis_client)
+
+    assert await cache.lock_refresh("hello", 0.05)
+    assert not await cache.lock_refresh("hello", 0.05)
+    await asyncio.sleep(0.1)
+    assert await cache.lock_refresh("hello", 0.05)
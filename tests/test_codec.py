@@ -0,0 +1,52 @@
+import pytest
+
+from utils import codec
+from utils.codec import Codec, JsonCodec, get_codec, loads
+
+
+def test_json_values_are_tagged() -> None:
+    data = JsonCodec().dumps(["hello", 1])
+
+    assert data.startswith(b"j1")
+    assert loads(data) == ["hello", 1]
+    assert loads(data.decode("utf-8")) == ["hello", 1]
+
+
+def test_untagged_json_objects_stay_readable() -> None:
+    assert loads(b'{"message": "hello"}') == {"message": "hello"}
+
+
+def test_unknown_tag_is_rejected() -> None:
+    with pytest.raises(ValueError, match="Unknown codec tag"):
+        loads(b"x1[]")
+
+
+def test_unknown_codec_name_is_rejected() -> None:
+    with pytest.raises(ValueError, match="Unknown codec"):
+        get_codec("xml")
+
+
+def test_codec_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        Codec()
+
+
+def test_msgpack_falls_back_to_json_without_msgpack(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(codec, "msgpack", None)
+
+    assert get_codec("msgpack").tag == JsonCodec.tag
+
+
+def test_msgpack_values_without_msgpack_fail_clearly(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delitem(codec._DECODERS, codec.MsgpackCodec.tag, raising=False)
+
+    with pytest.raises(RuntimeError, match="msgpack is not installed"):
+        loads(b"m1\x90")
+
+
+@pytest.mark.skipif(codec.msgpack is None, reason="msgpack is not installed")
+def test_msgpack_round_trip() -> None:
+    data = get_codec("msgpack").dumps(["hello", 1])
+
+    assert data.startswith(b"m1")
+    assert loads(data) == ["hello", 1]
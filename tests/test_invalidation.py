@@ -0,0 +1,54 @@
+import asyncio
+
+from redis.asyncio.client import Redis
+
+from utils.invalidation import InvalidationListener
+
+
+def test_invalidate_calls_callbacks_by_prefix(redis_client: Redis) -> None:
+    listener = InvalidationListener(redis_client)
+    signatures: list[str | None] = []
+    keys: list[str | None] = []
+    listener.register("signature:", signatures.append)
+    listener.register("apikeys", keys.append)
+
+    listener._invalidate(["signature:a", "apikeys", "other"])
+    listener._invalidate(None)
+
+    assert signatures == ["signature:a", None]
+    assert keys == ["apikeys", None]
+
+
+def test_failing_callback_does_not_stop_others(redis_client: Redis) -> None:
+    listener = InvalidationListener(redis_client)
+    invalidated: list[str | None] = []
+
+    def fail(key: str | None) -> None:
+        raise RuntimeError("boom")
+
+    listener.register("a:", fail)
+    listener.register("b:", invalidated.append)
+
+    listener._invalidate(["a:1", "b:1"])
+
+    assert invalidated == ["b:1"]
+
+
+async def test_lost_tracking_drops_local_copies(redis_client: Redis, running: list[asyncio.Task]) -> None:
+    listener = InvalidationListener(redis_client)
+    invalidated: list[str | None] = []
+    listener.register("signature:", invalidated.append)
+    attempts = 0
+
+    async def lose_tracking() -> None:
+        nonlocal attempts
+        attempts += 1
+        raise ConnectionError("gone")
+
+    listener._listen = lose_tracking
+    running.append(asyncio.create_task(listener.listen()))
+    await asyncio.sleep(0.05)
+
+    # changes made while tracking was off were missed
+    assert attempts == 1
+    assert invalidated == [None]
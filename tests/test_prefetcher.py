@@ -0,0 +1,136 @@
+from collections.abc import Callable
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.cache import SignatureCache
+from service.prefetcher import HeavyHitters, Prefetcher
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+from tests.conftest import FakeUpstream
+from tests.helpers import make_request
+from upstream.synthesia_api import SynthesiaAPI
+
+
+def test_heavy_hitters_count_messages() -> None:
+    hits = HeavyHitters(capacity=3)
+    for message in ["a", "b", "a", "c", "a", "b"]:
+        hits.add(message)
+
+    assert hits.top(2) == [("a", 3), ("b", 2)]
+    assert hits.top(10, min_count=2) == [("a", 3), ("b", 2)]
+
+
+def test_heavy_hitters_replace_least_counted() -> None:
+    hits = HeavyHitters(capacity=2)
+    for message in ["a", "a", "a", "b", "c"]:
+        hits.add(message)
+
+    assert len(hits) == 2
+    # c took over the count of b, so none of its requests are guaranteed
+    assert hits.top(2) == [("a", 3), ("c", 1)]
+    assert hits._counters[next(key for key, counter in hits._counters.items() if counter[0] == "c")][1:] == [2, 1]
+
+
+def test_heavy_hitters_decay() -> None:
+    hits = HeavyHitters(capacity=3)
+    for message in ["a", "a", "a", "a", "b"]:
+        hits.add(message)
+
+    hits.decay()
+
+    assert hits.top(3) == [("a", 2)]
+    hits.add("c")
+    hits.add("d")
+    assert len(hits) == 3
+
+
+PrefetcherParts = tuple[Prefetcher, SignatureCache, RequestProcessingQueue]
+
+
+@pytest.fixture
+def make_prefetcher(redis_client: Redis, upstream_api: SynthesiaAPI) -> Callable[..., PrefetcherParts]:
+    def make(limit: int = 10, **kwargs: object) -> PrefetcherParts:
+        queue = RequestProcessingQueue("q", redis_client)
+        cache = SignatureCache(redis_client, ttl=10)
+        rate_limiter = RateLimiter(redis_client, limit=limit, window=60)
+        kwargs.setdefault("min_hits", 2)
+        kwargs.setdefault("headroom", 0)
+        return Prefetcher(queue, upstream_api, rate_limiter, cache, **kwargs), cache, queue
+
+    return make
+
+
+async def test_prefetch_refreshes_expiring_hot_messages(
+    make_prefetcher: Callable[..., PrefetcherParts], fake_upstream: FakeUpstream
+) -> None:
+    prefetcher, cache, _ = make_prefetcher(refresh_before=30)
+    for message in ["hot", "hot", "cold"]:
+        prefetcher.record(message)
+
+    await prefetcher._prefetch()
+
+    assert [call.url.params["message"] for call in fake_upstream.calls] == ["hot"]
+    assert await cache.get("hot") == "sig-hot"
+    assert await cache.get("cold") is None
+
+
+async def test_prefetch_skips_fresh_entries(
+    make_prefetcher: Callable[..., PrefetcherParts], fake_upstream: FakeUpstream
+) -> None:
+    prefetcher, cache, _ = make_prefetcher(refresh_before=5)
+    await cache.set("hot", "sig")
+    prefetcher.record("hot")
+    prefetcher.record("hot")
+
+    await prefetcher._prefetch()
+
+    assert fake_upstream.calls == []
+
+
+async def test_prefetch_waits_while_requests_are_due(
+    make_prefetcher: Callable[..., PrefetcherParts],
+    fake_upstream: FakeUpstream,
+) -> None:
+    prefetcher, _, queue = make_prefetcher()
+    await queue.add(make_request("r1"))
+    prefetcher.record("hot")
+    prefetcher.record("hot")
+
+    await prefetcher._prefetch()
+
+    assert fake_upstream.calls == []
+
+
+async def test_prefetch_keeps_headroom(
+    make_prefetcher: Callable[..., PrefetcherParts], fake_upstream: FakeUpstream
+) -> None:
+    prefetcher, _, _ = make_prefetcher(limit=4, headroom=0.5)
+    for message in ["a", "a", "b", "b", "c", "c"]:
+        prefetcher.record(message)
+
+    await prefetcher._prefetch()
+
+    assert len(fake_upstream.calls) == 2
+
+
+async def test_prefetch_without_rate_slot_releases_refresh_lock(
+    make_prefetcher: Callable[..., PrefetcherParts],
+    fake_upstream: FakeUpstream,
+) -> None:
+    prefetcher, cache, _ = make_prefetcher(limit=10)
+    prefetcher.record("hot")
+    prefetcher.record("hot")
+    denied = True
+
+    async def is_request_allowed(request_id: str) -> bool:
+        return not denied
+
+    prefetcher._rate_limiter.is_request_allowed = is_request_allowed
+    await prefetcher._prefetch()
+    assert fake_upstream.calls == []
+
+    # the next round refreshes the message instead of waiting out the lock
+    denied = False
+    await prefetcher._prefetch()
+    assert await cache.get("hot") == "sig-hot"
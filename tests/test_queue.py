@@ -0,0 +1,156 @@
+import asyncio
+import json
+import time
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.queue import DEFAULT_USER_ID, RequestProcessingQueue
+from tests.helpers import make_request
+
+
+@pytest.fixture
+def queue(redis_client: Redis) -> RequestProcessingQueue:
+    return RequestProcessingQueue("q", redis_client)
+
+
+async def test_claim_leases_request(queue: RequestProcessingQueue) -> None:
+    await queue.add(make_request("r1"))
+
+    claimed = await queue.claim("lease-1", visibility_timeout=30)
+
+    assert [request["metadata"]["request_id"] for request in claimed] == ["r1"]
+    assert claimed[0]["message"] == "hello"
+    assert claimed[0]["metadata"]["user_id"] == "1"
+    assert await queue.claim("lease-2", visibility_timeout=30) == []
+
+
+async def test_expired_lease_is_redelivered(queue: RequestProcessingQueue) -> None:
+    await queue.add(make_request("r1"))
+    await queue.claim("lease-1", visibility_timeout=0.05)
+
+    await asyncio.sleep(0.1)
+    redelivered = await queue.claim("lease-2", visibility_timeout=30, user_id="1")
+
+    assert [request["metadata"]["request_id"] for request in redelivered] == ["r1"]
+    # the first worker lost its lease
+    assert not await queue.ack("r1", "lease-1")
+    assert await queue.ack("r1", "lease-2")
+    assert await queue.depth() == 0
+
+
+async def test_ack_is_idempotent(queue: RequestProcessingQueue, redis_client: Redis) -> None:
+    await queue.add(make_request("r1"))
+    await queue.claim("lease-1", visibility_timeout=30)
+
+    assert await queue.ack("r1", "lease-1")
+    assert await queue.ack("r1", "lease-1")
+    assert await queue.depth() == 0
+    assert await queue.due_users() == []
+    assert await redis_client.exists("request:r1") == 0
+
+
+async def test_release_counts_retry(queue: RequestProcessingQueue) -> None:
+    await queue.add(make_request("r1"))
+    await queue.claim("lease-1", visibility_timeout=30)
+
+    assert not await queue.release("r1", "other-lease", time.time())
+    assert await queue.release("r1", "lease-1", time.time(), retry=True, error="timeout")
+    claimed = await queue.claim("lease-2", visibility_timeout=30)
+
+    assert claimed[0]["metadata"]["retries"] == 1
+    assert [error for _, error in await queue.history("r1")] == ["timeout"]
+
+
+async def test_requests_for_same_message_are_merged(queue: RequestProcessingQueue) -> None:
+    assert await queue.add(make_request("r1")) == "r1"
+    assert await queue.add(make_request("r2", user_id="2")) == "r1"
+    assert await queue.add(make_request("r3", message="other")) == "r3"
+
+    claimed = await queue.claim("lease-1", visibility_timeout=30, limit=10)
+
+    by_id = {request["metadata"]["request_id"]: request for request in claimed}
+    assert set(by_id) == {"r1", "r3"}
+    assert [(subscriber["request_id"], subscriber["user_id"]) for subscriber in by_id["r1"]["subscribers"]] == [
+        ("r2", "2")
+    ]
+    assert by_id["r3"]["subscribers"] == []
+
+
+async def test_claimed_request_is_not_merged_into(queue: RequestProcessingQueue) -> None:
+    await queue.add(make_request("r1"))
+    await queue.claim("lease-1", visibility_timeout=30)
+
+    # work in flight may already have been signed, a new request is queued on its own
+    assert await queue.add(make_request("r2")) == "r2"
+
+
+async def test_migrate_legacy_request(queue: RequestProcessingQueue, redis_client: Redis) -> None:
+    # request queued before per user sub-queues and the compact layout
+    legacy = make_request("r1")
+    del legacy["metadata"]["user_id"]
+    legacy["metadata"]["retries"] = 2
+    await redis_client.hset("request:r1", "data", json.dumps(legacy))
+    await redis_client.zadd("q", {"r1": time.time()})
+    subscriber = {"request_id": "r0", "webhook_url": "http://example.com/hook"}
+    await redis_client.rpush("request:r1:subscribers", json.dumps(subscriber))
+
+    assert await queue.due_users() == []
+    assert await queue.migrate() == 2
+    assert await queue.migrate() == 0
+    assert await queue.due_users() == [DEFAULT_USER_ID]
+
+    claimed = await queue.claim("lease-1", visibility_timeout=30, user_id=DEFAULT_USER_ID)
+    assert claimed[0]["message"] == "hello"
+    assert claimed[0]["metadata"]["retries"] == 2
+    assert claimed[0]["subscribers"] == [subscriber]
+    assert await redis_client.hget("request:r1", "data") is None
+
+
+async def test_migrate_scans_in_chunks_once(queue: RequestProcessingQueue, redis_client: Redis) -> None:
+    for i in range(5):
+        legacy = make_request(f"r{i}", message=f"m{i}")
+        del legacy["metadata"]["user_id"]
+        await redis_client.hset(f"request:r{i}", "data", json.dumps(legacy))
+        await redis_client.zadd("q", {f"r{i}": time.time()})
+    await queue.add(make_request("r5", message="m5"))
+
+    assert await queue.migrate(chunk_size=2) == 10
+    assert await redis_client.exists("q:migrated")
+    assert await queue.user_depth(DEFAULT_USER_ID) == 5
+
+    # later startups don't scan the queue again
+    await redis_client.hdel("request:r0", "user")
+    assert await queue.migrate() == 0
+
+
+async def test_unmigrated_legacy_request_is_claimed(queue: RequestProcessingQueue, redis_client: Redis) -> None:
+    legacy = make_request("r1")
+    await redis_client.hset("request:r1", "data", json.dumps(legacy))
+    await redis_client.zadd("q", {"r1": time.time()})
+
+    claimed = await queue.claim("lease-1", visibility_timeout=30)
+
+    assert claimed[0]["message"] == "hello"
+
+
+async def test_future_request_is_not_due(queue: RequestProcessingQueue) -> None:
+    await queue.add(make_request("r1", due_at=time.time() + 60))
+
+    assert await queue.claim("lease-1", visibility_timeout=30) == []
+    assert await queue.due_users() == []
+    assert 59 < await queue.next_due_in() <= 60
+
+
+async def test_due_users_checks_a_sample(redis_client: Redis) -> None:
+    queue = RequestProcessingQueue("q", redis_client, scheduling_sample=3)
+    for user_id in range(10):
+        await queue.add(make_request(f"r{user_id}", message=f"m{user_id}", user_id=str(user_id)))
+
+    seen = set()
+    for _ in range(30):
+        due_users = await queue.due_users()
+        assert len(due_users) == 3
+        seen.update(due_users)
+
+    assert seen == {str(user_id) for user_id in range(10)}
@@ -0,0 +1,145 @@
+import asyncio
+import time
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.cache import SignatureCache
+from service.queue import QueueProcessor, RequestProcessingQueue
+from service.rate_limiter import RateLimiter, UserRateLimiter
+from service.results import ResultStore
+from service.webhook_manager import WebhookManager
+from tests.conftest import FakeUpstream
+from tests.helpers import make_request
+from upstream.synthesia_api import SynthesiaAPI
+
+
+@pytest.fixture
+def queue(redis_client: Redis) -> RequestProcessingQueue:
+    return RequestProcessingQueue("q", redis_client, scheduling_sample=2)
+
+
+@pytest.fixture
+def results(redis_client: Redis) -> ResultStore:
+    return ResultStore(redis_client)
+
+
+@pytest.fixture
+def make_processor(
+    redis_client: Redis,
+    queue: RequestProcessingQueue,
+    upstream_api: SynthesiaAPI,
+    webhook_manager: WebhookManager,
+    results: ResultStore,
+) -> object:
+    def make(limit: int = 10, user_limit: int = 0) -> QueueProcessor:
+        return QueueProcessor(
+            queue,
+            upstream_api,
+            RateLimiter(redis_client, limit=limit),
+            SignatureCache(redis_client),
+            webhook_manager,
+            results,
+            max_idle_wait=1,
+            user_rate_limiter=UserRateLimiter(redis_client, user_limit) if user_limit else None,
+        )
+
+    return make
+
+
+async def test_processes_queued_request(
+    queue: RequestProcessingQueue,
+    results: ResultStore,
+    make_processor: object,
+    running: list[asyncio.Task],
+) -> None:
+    await results.set_pending("r1", "1")
+    await queue.add(make_request("r1", message="m1"))
+    running.append(asyncio.create_task(make_processor().process()))
+    running.append(asyncio.create_task(results.listen()))
+
+    result = await results.wait("r1", timeout=2)
+
+    assert (result.status, result.signature) == (200, "sig-m1")
+    # acked right after the result is stored
+    await asyncio.sleep(0.05)
+    assert await queue.depth() == 0
+
+
+async def test_due_requests_are_served_when_sample_misses_them(
+    queue: RequestProcessingQueue,
+    results: ResultStore,
+    make_processor: object,
+    running: list[asyncio.Task],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def no_due_users() -> list[str]:
+        return []
+
+    monkeypatch.setattr(queue, "due_users", no_due_users)
+    await results.set_pending("r1", "1")
+    await queue.add(make_request("r1", message="m1"))
+    running.append(asyncio.create_task(make_processor().process()))
+    running.append(asyncio.create_task(results.listen()))
+
+    result = await results.wait("r1", timeout=2)
+
+    assert result.status == 200
+
+
+async def test_idle_worker_sleeps_until_next_due_request(
+    queue: RequestProcessingQueue,
+    make_processor: object,
+    running: list[asyncio.Task],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    claims = 0
+    claim = queue.claim
+
+    async def counting_claim(*args: object, **kwargs: object) -> list:
+        nonlocal claims
+        claims += 1
+        return await claim(*args, **kwargs)
+
+    monkeypatch.setattr(queue, "claim", counting_claim)
+    await queue.add(make_request("r1", due_at=time.time() + 0.3))
+    running.append(asyncio.create_task(make_processor().process()))
+
+    await asyncio.sleep(0.2)
+    assert claims == 0
+    await asyncio.sleep(0.3)
+    assert claims == 1
+
+
+async def test_global_slot_is_taken_before_user_slot(redis_client: Redis, make_processor: object) -> None:
+    processor = make_processor(limit=1, user_limit=1)
+    global_limiter = RateLimiter(redis_client, limit=1)
+    user_limiter = UserRateLimiter(redis_client, 1).for_user("1")
+    assert await global_limiter.is_request_allowed("other")
+
+    assert not await processor._acquire_slot("r1", "1")
+    # losing the global race leaves the user's budget untouched
+    assert await user_limiter.window_calls() == 0
+
+
+async def test_capped_user_request_is_handed_back_until_slot_frees(
+    redis_client: Redis,
+    queue: RequestProcessingQueue,
+    make_processor: object,
+    running: list[asyncio.Task],
+    fake_upstream: FakeUpstream,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def no_due_users() -> list[str]:
+        return []
+
+    # claimed from the whole queue, so the user cap is only found out after the claim
+    monkeypatch.setattr(queue, "due_users", no_due_users)
+    assert await UserRateLimiter(redis_client, 1).for_user("1").is_request_allowed("earlier")
+    await queue.add(make_request("r1"))
+    running.append(asyncio.create_task(make_processor(user_limit=1).process()))
+
+    await asyncio.sleep(0.2)
+
+    assert fake_upstream.calls == []
+    assert await queue.next_due_in() > 1
@@ -0,0 +1,110 @@
+import asyncio
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.rate_limiter import RateLimiter, UserRateLimiter
+
+
+async def test_sliding_window_limits_calls(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=3, window=0.2)
+
+    assert [await limiter.is_request_allowed(f"r{i}") for i in range(4)] == [True, True, True, False]
+    assert 0 < await limiter.time_until_next_slot() <= 0.2
+    assert await limiter.window_calls() == 3
+
+
+async def test_sliding_window_frees_slots(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=1, window=0.1)
+    assert await limiter.is_request_allowed("r1")
+
+    await asyncio.sleep(0.15)
+
+    assert await limiter.time_until_next_slot() == 0
+    assert await limiter.is_request_allowed("r2")
+
+
+async def test_several_slots_are_taken_at_once(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=5, window=0.2)
+    assert await limiter.try_acquire("r1", count=2) == (True, 0)
+
+    allowed, retry_after = await limiter.try_acquire("r2", count=4)
+
+    # the calls of r1 have to leave the window first
+    assert not allowed
+    assert 0 < retry_after <= 0.2
+    assert await limiter.window_calls() == 2
+    assert await limiter.try_acquire("r3", count=3) == (True, 0)
+
+
+async def test_retries_take_their_own_slot(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=2, window=60)
+
+    assert await limiter.is_request_allowed("r1")
+    assert await limiter.is_request_allowed("r1")
+    assert not await limiter.is_request_allowed("r1")
+
+
+async def test_acquire_waits_for_slot(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=1, window=0.1)
+    assert await limiter.is_request_allowed("r1")
+
+    assert not await limiter.acquire("r2", timeout=0.01)
+    assert await limiter.acquire("r2", timeout=0.5)
+
+
+async def test_rate_limited_cuts_budget_and_pauses(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=10, window=60, decrease_factor=0.5)
+
+    await limiter.on_rate_limited(retry_after=0.1)
+
+    assert await limiter.budget() == 5
+    assert not await limiter.is_request_allowed("r1")
+    assert 0 < await limiter.time_until_next_slot() <= 0.1
+    await asyncio.sleep(0.15)
+    assert await limiter.is_request_allowed("r1")
+
+
+async def test_rate_limited_during_pause_cuts_once(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=10, window=60, decrease_factor=0.5)
+
+    # calls in flight when upstream starts rejecting all get a 429
+    for _ in range(3):
+        await limiter.on_rate_limited(retry_after=1)
+
+    assert await limiter.budget() == 5
+
+
+async def test_budget_never_drops_below_min_limit(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=4, window=60, min_limit=2, decrease_factor=0.1)
+
+    await limiter.on_rate_limited(retry_after=0)
+
+    assert await limiter.budget() == 2
+
+
+async def test_success_grows_budget_up_to_limit(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=10, window=60, increase=1, decrease_factor=0.5)
+    await limiter.on_rate_limited(retry_after=0)
+
+    await limiter.on_success()
+    assert await limiter.budget() == pytest.approx(5.2)
+
+    for _ in range(100):
+        await limiter.on_success()
+    assert await limiter.budget() == 10
+
+
+async def test_adaptive_budget_limits_window(redis_client: Redis) -> None:
+    limiter = RateLimiter(redis_client, limit=4, window=60, decrease_factor=0.5)
+    await limiter.on_rate_limited(retry_after=0)
+
+    assert [await limiter.is_request_allowed(f"r{i}") for i in range(3)] == [True, True, False]
+
+
+async def test_user_limiters_are_independent(redis_client: Redis) -> None:
+    limiter = UserRateLimiter(redis_client, limit=1, window=60)
+
+    assert await limiter.for_user("1").is_request_allowed("r1")
+    assert not await limiter.for_user("1").is_request_allowed("r2")
+    assert await limiter.for_user("2").is_request_allowed("r3")
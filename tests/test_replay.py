@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.dead_letters import REQUEST, WEBHOOK, DeadLetterQueue
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+from service.replay import DeadLetterReplayer
+from service.results import ResultStore
+from service.webhook_manager import WebhookDelivery, WebhookOutbox
+from tests.helpers import make_request
+
+
+@pytest.fixture
+def dead_letters(redis_client: Redis) -> DeadLetterQueue:
+    return DeadLetterQueue("dead_letters", redis_client)
+
+
+@pytest.fixture
+def queue(redis_client: Redis) -> RequestProcessingQueue:
+    return RequestProcessingQueue("q", redis_client)
+
+
+@pytest.fixture
+async def replayer(
+    redis_client: Redis,
+    dead_letters: DeadLetterQueue,
+    queue: RequestProcessingQueue,
+) -> DeadLetterReplayer:
+    # a budget of 10 calls, replays get 2 of them per window
+    replayer = DeadLetterReplayer(
+        dead_letters,
+        queue,
+        WebhookOutbox("webhooks", redis_client),
+        ResultStore(redis_client),
+        RateLimiter(redis_client, limit=10, window=60),
+        redis_client,
+        window=0.3,
+        share=0.2,
+    )
+    yield replayer
+    await replayer.close()
+
+
+async def test_replayed_requests_are_paced(
+    replayer: DeadLetterReplayer,
+    dead_letters: DeadLetterQueue,
+    queue: RequestProcessingQueue,
+) -> None:
+    dead_letter_ids = [
+        await dead_letters.add(REQUEST, make_request(f"r{i}", f"m{i}"), "status 500", []) for i in range(3)
+    ]
+    start = time.monotonic()
+
+    replayer.replay(dead_letter_ids)
+    await asyncio.sleep(0.1)
+
+    assert replayer.replaying()
+    assert await queue.depth() == 2
+    assert await dead_letters.depth() == 1
+    while replayer.replaying():
+        await asyncio.sleep(0.01)
+    assert time.monotonic() - start >= 0.25
+    assert await queue.depth() == 3
+    assert await dead_letters.depth() == 0
+
+
+async def test_replayed_requests_start_over(
+    replayer: DeadLetterReplayer,
+    dead_letters: DeadLetterQueue,
+    queue: RequestProcessingQueue,
+) -> None:
+    request = make_request("r1", user_id="7")
+    request["metadata"]["retries"] = 5
+    request["subscribers"] = [
+        {"request_id": "r2", "webhook_url": "http://hooks/2", "user_id": "8"},
+        {"request_id": "r3", "webhook_url": None},
+    ]
+    dead_letter_id = await dead_letters.add(REQUEST, request, "status 500", [])
+
+    replayer.replay([dead_letter_id])
+    while replayer.replaying():
+        await asyncio.sleep(0.01)
+
+    (replayed,) = await queue.claim("lease", visibility_timeout=10)
+    assert replayed["metadata"]["request_id"] == "r1"
+    assert replayed["metadata"]["retries"] == 0
+    assert replayed["metadata"]["user_id"] == "7"
+    assert [(subscriber["request_id"], subscriber["user_id"]) for subscriber in replayed["subscribers"]] == [
+        ("r2", "8"),
+        ("r3", "7"),
+    ]
+    # every replayed request keeps the user that may read its result
+    assert (await replayer._results.get("r1", "7")).status == 202
+    assert (await replayer._results.get("r2", "8")).status == 202
+    assert await replayer._results.get("r2", "7") is None
+
+
+async def test_webhooks_are_replayed_without_pacing(
+    replayer: DeadLetterReplayer,
+    dead_letters: DeadLetterQueue,
+) -> None:
+    deliveries = [
+        WebhookDelivery(
+            delivery_id=f"d{i}",
+            webhook_url="http://hooks/1",
+            data={},
+            attempts=5,
+            created_at=time.time(),
+            history=[[time.time(), "status 500"]],
+        )
+        for i in range(5)
+    ]
+    dead_letter_ids = [await dead_letters.add(WEBHOOK, delivery, "status 500", []) for delivery in deliveries]
+
+    replayer.replay(dead_letter_ids)
+    await asyncio.sleep(0.05)
+
+    assert not replayer.replaying()
+    assert await dead_letters.depth() == 0
+    assert await replayer._outbox.depth() == 5
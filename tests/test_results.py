@@ -0,0 +1,106 @@
+import asyncio
+
+from fastapi import status
+from redis.asyncio.client import Redis
+
+from service.models import CryptoSignResponse
+from service.results import ResultStore
+
+
+def signed(request_id: str) -> CryptoSignResponse:
+    return CryptoSignResponse(request_id=request_id, status=status.HTTP_200_OK, signature=f"sig-{request_id}")
+
+
+async def test_pending_then_result(redis_client: Redis) -> None:
+    results = ResultStore(redis_client)
+
+    assert await results.get("r1") is None
+    await results.set_pending("r1", "1")
+    assert (await results.get("r1")).status == status.HTTP_202_ACCEPTED
+
+    await results.set_many([signed("r1")])
+
+    assert (await results.get("r1")).signature == "sig-r1"
+
+
+async def test_results_are_only_found_by_their_user(redis_client: Redis) -> None:
+    results = ResultStore(redis_client)
+    await results.set_pending("r1", "1")
+    await results.set_many([signed("r1")])
+
+    assert (await results.get("r1", "1")).signature == "sig-r1"
+    assert await results.get("r1", "2") is None
+    assert await results.wait("r1", timeout=10, user_id="2") is None
+
+
+async def test_results_without_user_are_not_found(redis_client: Redis) -> None:
+    results = ResultStore(redis_client)
+    await results.set_many([signed("r1")])
+
+    assert await results.get("r1", "1") is None
+
+
+async def test_results_expire_after_ttl(redis_client: Redis) -> None:
+    results = ResultStore(redis_client, ttl=0.05)
+    await results.set_pending_many({"r1": "1", "r2": "1"})
+
+    await asyncio.sleep(0.1)
+
+    assert await results.get("r1") is None
+    assert await results.get("r2") is None
+
+
+async def test_wait_returns_completed_result_at_once(redis_client: Redis) -> None:
+    results = ResultStore(redis_client)
+    await results.set_many([signed("r1")])
+
+    assert (await results.wait("r1", timeout=10)).signature == "sig-r1"
+    assert await results.wait("unknown", timeout=10) is None
+
+
+async def test_wait_is_woken_by_published_result(redis_client: Redis, running: list[asyncio.Task]) -> None:
+    results = ResultStore(redis_client)
+    running.append(asyncio.create_task(results.listen()))
+    await results.set_pending("r1", "1")
+    await asyncio.sleep(0.05)
+
+    waiter = asyncio.create_task(results.wait("r1", timeout=5))
+    await asyncio.sleep(0.05)
+    await results.set_many([signed("r1")])
+
+    response = await asyncio.wait_for(waiter, 1)
+    assert response.signature == "sig-r1"
+    assert results._waiters == {}
+
+
+async def test_wait_times_out_with_pending_result(redis_client: Redis) -> None:
+    results = ResultStore(redis_client)
+    await results.set_pending("r1", "1")
+
+    response = await results.wait("r1", timeout=0.05)
+
+    assert response.status == status.HTTP_202_ACCEPTED
+    assert results._waiters == {}
+
+
+async def test_resubscribe_wakes_waiters(redis_client: Redis, running: list[asyncio.Task]) -> None:
+    results = ResultStore(redis_client)
+    await results.set_pending("r1", "1")
+    interrupted = asyncio.Event()
+
+    async def listen() -> None:
+        # the first subscription breaks off, results published meanwhile are missed
+        if not interrupted.is_set():
+            interrupted.set()
+            await asyncio.sleep(0.1)
+            raise ConnectionError("connection lost")
+        await asyncio.sleep(10)
+
+    results._listen = listen
+    running.append(asyncio.create_task(results.listen()))
+    await interrupted.wait()
+
+    # the waiter returns so the client polls again, before its own timeout
+    response = await asyncio.wait_for(results.wait("r1", timeout=5), 1)
+
+    assert response.status == status.HTTP_202_ACCEPTED
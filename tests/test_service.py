@@ -0,0 +1,131 @@
+from collections.abc import AsyncIterator
+import asyncio
+
+from fastapi import BackgroundTasks, status
+from redis.asyncio.client import Redis
+import pytest
+
+from service.cache import SignatureCache
+from service.queue import RequestProcessingQueue
+from service.rate_limiter import RateLimiter
+from service.results import ResultStore
+from service.service import Service
+from service.webhook_manager import WebhookManager
+from tests.conftest import FakeUpstream
+from upstream.synthesia_api import SynthesiaAPI
+from utils.helpers import RequestHeaders
+
+
+@pytest.fixture
+def queue(redis_client: Redis) -> RequestProcessingQueue:
+    return RequestProcessingQueue("q", redis_client)
+
+
+@pytest.fixture
+async def service(
+    redis_client: Redis,
+    queue: RequestProcessingQueue,
+    upstream_api: SynthesiaAPI,
+    webhook_manager: WebhookManager,
+) -> AsyncIterator[Service]:
+    service = Service(
+        queue,
+        upstream_api,
+        RateLimiter(redis_client, limit=10, window=60),
+        SignatureCache(redis_client),
+        webhook_manager,
+        ResultStore(redis_client),
+        deadline_reserve=0,
+    )
+    yield service
+    await service.close()
+
+
+def headers(request_id: str) -> RequestHeaders:
+    return RequestHeaders(user_id="1", request_id=request_id)
+
+
+async def test_signs_then_answers_from_cache(service: Service, fake_upstream: FakeUpstream) -> None:
+    first = await service.sign_message(headers("r1"), "hello", BackgroundTasks(), None)
+    second = await service.sign_message(headers("r2"), "hello", BackgroundTasks(), None)
+
+    assert (first.status, first.signature) == (status.HTTP_200_OK, "sig-hello")
+    assert (second.request_id, second.signature) == ("r2", "sig-hello")
+    assert len(fake_upstream.calls) == 1
+
+
+async def test_concurrent_requests_share_one_upstream_call(service: Service, fake_upstream: FakeUpstream) -> None:
+    fake_upstream.delay = 0.05
+
+    responses = await asyncio.gather(
+        *(service.sign_message(headers(f"r{i}"), "hello", BackgroundTasks(), None) for i in range(5))
+    )
+
+    assert [response.signature for response in responses] == ["sig-hello"] * 5
+    assert len(fake_upstream.calls) == 1
+    assert service._in_flight == {}
+
+
+async def test_failed_upstream_call_queues_the_request(
+    service: Service,
+    queue: RequestProcessingQueue,
+    fake_upstream: FakeUpstream,
+) -> None:
+    fake_upstream.status = 500
+
+    response = await service.sign_message(headers("r1"), "hello", BackgroundTasks(), None)
+
+    assert response.status == status.HTTP_202_ACCEPTED
+    assert await queue.depth() == 1
+    assert (await service._results.get("r1")).status == status.HTTP_202_ACCEPTED
+
+
+async def test_no_rate_slot_queues_the_request(
+    redis_client: Redis,
+    service: Service,
+    queue: RequestProcessingQueue,
+    fake_upstream: FakeUpstream,
+) -> None:
+    service._rate_limiter = RateLimiter(redis_client, limit=1, window=60, name="exhausted")
+    assert await service._rate_limiter.is_request_allowed("other")
+
+    response = await service.sign_message(headers("r1"), "hello", BackgroundTasks(), None)
+
+    assert response.status == status.HTTP_202_ACCEPTED
+    assert await queue.depth() == 1
+    assert fake_upstream.calls == []
+
+
+async def test_call_past_deadline_is_detached(
+    service: Service,
+    queue: RequestProcessingQueue,
+    fake_upstream: FakeUpstream,
+) -> None:
+    fake_upstream.delay = 0.2
+    deadline = asyncio.get_running_loop().time() + 0.05
+
+    response = await service.sign_message(headers("r1"), "hello", BackgroundTasks(), None, deadline=deadline)
+
+    assert response.status == status.HTTP_202_ACCEPTED
+    assert (await service._results.get("r1")).status == status.HTTP_202_ACCEPTED
+    await service.close()
+    # the call finished in the background without queueing the request
+    assert (await service._results.get("r1")).signature == "sig-hello"
+    assert await queue.depth() == 0
+    assert len(fake_upstream.calls) == 1
+
+
+async def test_batch_dedupes_messages(
+    service: Service,
+    queue: RequestProcessingQueue,
+    fake_upstream: FakeUpstream,
+) -> None:
+    await service._cache.set("cached", "sig")
+
+    items = await service.sign_batch(headers("b1"), ["a", "cached", "a", "b"], BackgroundTasks(), None)
+
+    assert [item.status for item in items] == [202, 200, 202, 202]
+    assert items[0].request_id == items[2].request_id
+    assert items[1].signature == "sig"
+    assert await queue.depth() == 2
+    assert fake_upstream.calls == []
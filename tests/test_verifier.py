@@ -0,0 +1,62 @@
+from fastapi import HTTPException
+from redis.asyncio.client import Redis
+import pytest
+
+from service.cache import SignatureCache
+from service.rate_limiter import RateLimiter
+from service.verifier import SignatureVerifier
+from tests.conftest import FakeUpstream
+from upstream.synthesia_api import SynthesiaAPI
+
+
+@pytest.fixture
+def cache(redis_client: Redis) -> SignatureCache:
+    return SignatureCache(redis_client)
+
+
+@pytest.fixture
+def verifier(redis_client: Redis, cache: SignatureCache, upstream_api: SynthesiaAPI) -> SignatureVerifier:
+    return SignatureVerifier(redis_client, cache, upstream_api, RateLimiter(redis_client, limit=2, window=60))
+
+
+async def test_issued_signatures_are_valid_without_upstream(
+    verifier: SignatureVerifier,
+    cache: SignatureCache,
+    fake_upstream: FakeUpstream,
+) -> None:
+    await cache.set("hello", "issued")
+
+    assert await verifier.verify("r1", "hello", "issued", timeout=0)
+    assert fake_upstream.calls == []
+
+
+async def test_upstream_results_are_cached(verifier: SignatureVerifier, fake_upstream: FakeUpstream) -> None:
+    assert await verifier.verify("r1", "hello", "sig-hello", timeout=0)
+    assert not await verifier.verify("r2", "hello", "forged", timeout=0)
+
+    # answered from the cached results, the limit of two calls per window is used up
+    assert await verifier.verify("r3", "hello", "sig-hello", timeout=0)
+    assert not await verifier.verify("r4", "hello", "forged", timeout=0)
+    assert len(fake_upstream.calls) == 2
+
+
+async def test_rate_limited_verification_raises_429(verifier: SignatureVerifier) -> None:
+    assert await verifier.verify("r1", "hello", "sig-hello", timeout=0)
+    assert await verifier.verify("r2", "other", "sig-other", timeout=0)
+
+    with pytest.raises(HTTPException) as e:
+        await verifier.verify("r3", "third", "sig-third", timeout=0)
+
+    assert e.value.status_code == 429
+    assert int(e.value.headers["Retry-After"]) > 0
+
+
+async def test_upstream_errors_are_not_cached(verifier: SignatureVerifier, fake_upstream: FakeUpstream) -> None:
+    fake_upstream.status = 500
+
+    with pytest.raises(HTTPException) as e:
+        await verifier.verify("r1", "hello", "sig-hello", timeout=0)
+
+    assert e.value.status_code == 502
+    fake_upstream.status = 200
+    assert await verifier.verify("r2", "hello", "sig-hello", timeout=0)
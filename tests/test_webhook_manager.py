@@ -0,0 +1,275 @@
+from collections.abc import Callable
+import asyncio
+import time
+import uuid
+
+from redis.asyncio.client import Redis
+import pytest
+
+from service.dead_letters import WEBHOOK, DeadLetterQueue
+from service.webhook_manager import HostLimiter, WebhookDelivery, WebhookManager, WebhookOutbox, WebhookProducer
+from tests.conftest import WebhookReceiver
+
+
+def make_delivery(webhook_url: str = "http://receiver/hook", batch: bool = False, **data: object) -> WebhookDelivery:
+    return WebhookDelivery(
+        delivery_id=uuid.uuid4().hex,
+        webhook_url=webhook_url,
+        data={"request_id": uuid.uuid4().hex, **data},
+        attempts=0,
+        created_at=time.time(),
+        batch=batch,
+    )
+
+
+def by_id(deliveries: list[WebhookDelivery]) -> list[WebhookDelivery]:
+    # deliveries due at the same time are claimed in id order
+    return sorted(deliveries, key=lambda delivery: delivery["delivery_id"])
+
+
+@pytest.fixture
+def outbox(redis_client: Redis) -> WebhookOutbox:
+    return WebhookOutbox("webhooks", redis_client)
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float = 2) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+async def test_claim_and_ack(outbox: WebhookOutbox) -> None:
+    delivery = make_delivery()
+    await outbox.add_many([(delivery, time.time())])
+
+    claimed = await outbox.claim("lease-1", visibility_timeout=30)
+
+    assert claimed == [delivery]
+    assert await outbox.claim("lease-2", visibility_timeout=30) == []
+    assert not await outbox.ack(delivery["delivery_id"], "lease-2")
+    assert await outbox.ack(delivery["delivery_id"], "lease-1")
+    assert await outbox.depth() == 0
+
+
+async def test_expired_lease_is_redelivered(outbox: WebhookOutbox) -> None:
+    delivery = make_delivery()
+    await outbox.add_many([(delivery, time.time())])
+    await outbox.claim("lease-1", visibility_timeout=0.05)
+
+    await asyncio.sleep(0.1)
+
+    assert await outbox.claim("lease-2", visibility_timeout=30) == [delivery]
+    assert not await outbox.ack(delivery["delivery_id"], "lease-1")
+
+
+async def test_batch_deliveries_are_claimed_per_url(outbox: WebhookOutbox) -> None:
+    first = [make_delivery(batch=True) for _ in range(3)]
+    other_url = make_delivery("http://other/hook", batch=True)
+    due_at = time.time() + 0.05
+    await outbox.add_many([(delivery, due_at) for delivery in [*first, other_url]])
+
+    assert await outbox.claim("lease-1", visibility_timeout=30) == []
+    assert await outbox.depth() == 4
+    await asyncio.sleep(0.1)
+    claimed = [await outbox.claim("lease-1", visibility_timeout=30) for _ in range(2)]
+
+    assert sorted(claimed, key=len) == [[other_url], by_id(first)]
+    assert await outbox.claim("lease-1", visibility_timeout=30) == []
+
+
+async def test_batch_group_is_claimed_up_to_group_limit(outbox: WebhookOutbox) -> None:
+    deliveries = [make_delivery(batch=True) for _ in range(5)]
+    await outbox.add_many([(delivery, time.time()) for delivery in deliveries])
+
+    first = await outbox.claim("lease-1", visibility_timeout=30, group_limit=3)
+    rest = await outbox.claim("lease-1", visibility_timeout=30, group_limit=3)
+
+    assert (len(first), len(rest)) == (3, 2)
+    assert by_id(first + rest) == by_id(deliveries)
+
+
+async def test_expired_batch_lease_is_regrouped(outbox: WebhookOutbox) -> None:
+    deliveries = [make_delivery(batch=True) for _ in range(3)]
+    await outbox.add_many([(delivery, time.time()) for delivery in deliveries])
+    await outbox.claim("lease-1", visibility_timeout=0.05)
+
+    await asyncio.sleep(0.1)
+
+    assert by_id(await outbox.claim("lease-2", visibility_timeout=30)) == by_id(deliveries)
+    assert await outbox.depth() == 3
+
+
+async def test_rescheduled_batch_delivery_joins_its_group(outbox: WebhookOutbox) -> None:
+    deliveries = [make_delivery(batch=True) for _ in range(2)]
+    await outbox.add_many([(delivery, time.time()) for delivery in deliveries])
+    claimed = await outbox.claim("lease-1", visibility_timeout=30)
+    fresh = make_delivery(batch=True)
+    await outbox.add_many([(fresh, time.time())])
+
+    assert await outbox.reschedule_many(claimed, "lease-1", time.time()) == [True, True]
+    assert await outbox.reschedule_many(claimed, "lease-1", time.time()) == [False, False]
+
+    assert by_id(await outbox.claim("lease-2", visibility_timeout=30)) == by_id([*deliveries, fresh])
+
+
+async def test_batch_retry_waits_out_its_backoff(outbox: WebhookOutbox) -> None:
+    retry = make_delivery(batch=True)
+    await outbox.add_many([(retry, time.time())])
+    await outbox.claim("lease-1", visibility_timeout=30)
+    await outbox.reschedule_many([retry], "lease-1", time.time() + 0.2)
+    fresh = make_delivery(batch=True)
+    await outbox.add_many([(fresh, time.time())])
+
+    assert await outbox.claim("lease-2", visibility_timeout=30) == [fresh]
+    assert await outbox.claim("lease-2", visibility_timeout=30) == []
+    assert 0 < await outbox.next_due_in() <= 0.2
+    await asyncio.sleep(0.25)
+    assert await outbox.claim("lease-3", visibility_timeout=30) == [retry]
+
+
+async def test_producer_only_enqueues(outbox: WebhookOutbox) -> None:
+    producer = WebhookProducer(outbox, batch_flush_window=0)
+
+    await producer.send("http://receiver/hook", {"request_id": "a"})
+
+    claimed = await outbox.claim("lease-1", visibility_timeout=30)
+    assert [delivery["data"] for delivery in claimed] == [{"request_id": "a"}]
+    await producer.close()
+
+
+async def test_sends_webhook(
+    webhook_manager: WebhookManager,
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    running.append(asyncio.create_task(webhook_manager.process()))
+
+    await webhook_manager.send("http://receiver/hook", {"request_id": "r1"})
+
+    await wait_for(lambda: webhook_receiver.posts == [("http://receiver/hook", {"request_id": "r1"})])
+    # receiver hosts are only tracked while deliveries to them are in flight
+    await wait_for(lambda: len(webhook_manager._hosts) == 0)
+
+
+async def test_sends_batch_as_one_array(
+    make_webhook_manager: Callable[..., WebhookManager],
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    manager = make_webhook_manager(batch_flush_window=0.1)
+    running.append(asyncio.create_task(manager.process()))
+
+    await manager.send_many([("http://receiver/hook", {"request_id": f"r{i}"}, True, None) for i in range(3)])
+
+    await wait_for(lambda: len(webhook_receiver.posts) == 1)
+    _, body = webhook_receiver.posts[0]
+    assert sorted(result["request_id"] for result in body) == ["r0", "r1", "r2"]
+
+
+async def test_unacknowledged_batch_results_are_retried(
+    make_webhook_manager: Callable[..., WebhookManager],
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    manager = make_webhook_manager(batch_flush_window=0.05, backoff_base=0.01)
+    webhook_receiver.json = {"acknowledged": ["r0"]}
+    running.append(asyncio.create_task(manager.process()))
+
+    await manager.send_many([("http://receiver/hook", {"request_id": f"r{i}"}, True, None) for i in range(2)])
+
+    await wait_for(lambda: len(webhook_receiver.posts) >= 2)
+    _, retried = webhook_receiver.posts[1]
+    assert retried == [{"request_id": "r1"}]
+
+
+async def test_rejected_batch_falls_back_to_single_deliveries(
+    make_webhook_manager: Callable[..., WebhookManager],
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    manager = make_webhook_manager(batch_flush_window=0.05)
+    webhook_receiver.batch_status = 400
+    running.append(asyncio.create_task(manager.process()))
+    await manager.send_many([("http://receiver/hook", {"request_id": f"r{i}"}, True, None) for i in range(2)])
+
+    await wait_for(lambda: len(webhook_receiver.posts) == 3)
+
+    assert isinstance(webhook_receiver.posts[0][1], list)
+    singles = sorted(body["request_id"] for _, body in webhook_receiver.posts[1:])
+    assert singles == ["r0", "r1"]
+
+
+async def test_saturated_host_is_waited_for(
+    make_webhook_manager: Callable[..., WebhookManager],
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    manager = make_webhook_manager(per_host_limit=1)
+    webhook_receiver.delay = 0.1
+    rescheduled = []
+    reschedule_many = manager._outbox.reschedule_many
+
+    async def record_reschedule(*args: object) -> list[bool]:
+        rescheduled.append(args)
+        return await reschedule_many(*args)
+
+    manager._outbox.reschedule_many = record_reschedule
+    running.append(asyncio.create_task(manager.process()))
+
+    await manager.send_many([("http://receiver/hook", {"request_id": f"r{i}"}, False, None) for i in range(2)])
+
+    await wait_for(lambda: len(webhook_receiver.posts) == 2)
+    await wait_for(lambda: len(manager._hosts) == 0)
+    # the second sender waited for the host instead of handing its delivery back
+    assert rescheduled == []
+
+
+async def test_host_slot_wait_is_bounded() -> None:
+    hosts = HostLimiter(1)
+    assert await hosts.acquire("receiver", timeout=0)
+
+    assert not await hosts.acquire("receiver", timeout=0.01)
+    assert len(hosts) == 1
+    hosts.release("receiver")
+    assert len(hosts) == 0
+
+
+def test_batch_rejections_are_bounded(make_webhook_manager: Callable[..., WebhookManager]) -> None:
+    manager = make_webhook_manager(batch_unsupported_ttl=60, batch_unsupported_size=2)
+
+    for i in range(3):
+        manager._reject_batches(f"http://receiver/{i}")
+
+    assert list(manager._batch_unsupported) == ["http://receiver/1", "http://receiver/2"]
+    assert manager._accepts_batch("http://receiver/0")
+    assert not manager._accepts_batch("http://receiver/1")
+    manager._batch_unsupported["http://receiver/1"] = time.time() - 1
+    assert manager._accepts_batch("http://receiver/1")
+    assert list(manager._batch_unsupported) == ["http://receiver/2"]
+
+
+async def test_exhausted_delivery_becomes_dead_letter(
+    redis_client: Redis,
+    make_webhook_manager: Callable[..., WebhookManager],
+    webhook_receiver: WebhookReceiver,
+    running: list[asyncio.Task],
+) -> None:
+    dead_letters = DeadLetterQueue("dead_letters", redis_client)
+    manager = make_webhook_manager(max_retries=2, backoff_base=0.01, dead_letters=dead_letters)
+    webhook_receiver.status = 500
+    running.append(asyncio.create_task(manager.process()))
+
+    await manager.send("http://receiver/hook", {"request_id": "r1"})
+
+    deadline = time.monotonic() + 2
+    while not await dead_letters.depth():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+    [dead_letter] = await dead_letters.get_many(await dead_letters.ids())
+    assert dead_letter["kind"] == WEBHOOK
+    assert dead_letter["payload"]["data"] == {"request_id": "r1"}
+    assert dead_letter["reason"] == "status 500"
+    assert len(dead_letter["history"]) == 2
+    assert len(webhook_receiver.posts) == 2
+    assert await manager._outbox.depth() == 0
@@ -1,14 +1,32 @@
+from email.utils import parsedate_to_datetime
 from logging import getLogger
 import asyncio
+import importlib.util
+import time
 
+from prometheus_client import Histogram
 from pydantic import BaseModel
 import httpx
 
 from configs.config import SynthesiaAPIConfig
+from utils.metrics import DURATION_BUCKETS
 
 
 logger = getLogger(__name__)
 
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Duration of Synthesia API sign calls by response status",
+    ("status",),
+    buckets=DURATION_BUCKETS,
+)
+UPSTREAM_VERIFY_DURATION = Histogram(
+    "upstream_verify_duration_seconds",
+    "Duration of Synthesia API verify calls by response status",
+    ("status",),
+    buckets=DURATION_BUCKETS,
+)
+
 
 class SynthesiaSignRequest(BaseModel):
     message: str
@@ -16,36 +34,142 @@ class SynthesiaSignRequest(BaseModel):
 
 class SynthesiaSignResponse(BaseModel):
     signature: str
+    # seconds until upstream accepts calls again, set when the response reports an exhausted quota
+    retry_after: float | None = None
+
+
+class SynthesiaVerifyRequest(BaseModel):
+    message: str
+    signature: str
+
+
+class SynthesiaVerifyResponse(BaseModel):
+    valid: bool
+    retry_after: float | None = None
+
+
+class SynthesiaRateLimitError(Exception):
+    def __init__(self, retry_after: float | None) -> None:
+        super().__init__(f"Synthesia API rate limit exceeded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(headers: httpx.Headers) -> float | None:
+    # Retry-After is either seconds or a http date
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                logger.warning(f"Invalid Retry-After header: {retry_after}")
+    # quota headers, reset is either seconds until reset or unix timestamp of the reset
+    for prefix in ("X-RateLimit-", "RateLimit-"):
+        remaining, reset = headers.get(f"{prefix}Remaining"), headers.get(f"{prefix}Reset")
+        if remaining is None or reset is None:
+            continue
+        try:
+            if float(remaining) > 0:
+                return None
+            reset_at = float(reset)
+        except ValueError:
+            logger.warning(f"Invalid rate limit headers: remaining {remaining}, reset {reset}")
+            return None
+        return max(0.0, reset_at - time.time() if reset_at > 1e9 else reset_at)
+    return None
 
 
 class SynthesiaAPI:
     def __init__(self, config: SynthesiaAPIConfig) -> None:
         self._config = config
         self._headers = {"Authorization": self._config.api_key}
+        http2 = self._config.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("HTTP/2 requested for Synthesia API but h2 package is not installed, using HTTP/1.1")
+            http2 = False
+        # long lived client, so upstream calls reuse keep-alive connections instead of a new handshake each time
+        self._client = httpx.AsyncClient(
+            base_url=self._config.base_url,
+            headers=self._headers,
+            timeout=httpx.Timeout(
+                self._config.timeout,
+                connect=self._config.connect_timeout,
+                read=self._config.read_timeout,
+            ),
+            limits=httpx.Limits(
+                max_connections=self._config.max_connections,
+                max_keepalive_connections=self._config.max_connections,
+                keepalive_expiry=self._config.keepalive_expiry,
+            ),
+            http2=http2,
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
 
     async def sign_message(self, request: SynthesiaSignRequest) -> SynthesiaSignResponse:
+        start = time.perf_counter()
+        status = "error"
         try:
-            logger.debug(f"Making Synthesia API request: {request.message}")
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self._config.base_url}{self._config.sign_endpoint}",
+            logger.debug("Making Synthesia API request for message of length %d", len(request.message))
+            # httpx timeouts apply per operation, total timeout bounds the whole call
+            async with asyncio.timeout(self._config.timeout):
+                response = await self._client.get(
+                    self._config.sign_endpoint,
                     params={"message": request.message},
-                    headers=self._headers,
                 )
-            logger.info(f"Synthesia API response data: {response.__dict__}")
+            status = str(response.status_code)
+            logger.debug("Synthesia API response status: %d", response.status_code)
+            if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                retry_after = _parse_retry_after(response.headers)
+                logger.warning(f"Synthesia API rate limit exceeded, retry after {retry_after}s")
+                raise SynthesiaRateLimitError(retry_after)
             response.raise_for_status()
             signature = response.text
-            return SynthesiaSignResponse(signature=signature)
-        except asyncio.TimeoutError:
+            return SynthesiaSignResponse(signature=signature, retry_after=_parse_retry_after(response.headers))
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            status = "timeout"
             logger.exception("Synthesia API request timed out")
-            # todo: update monitoring metrics
             raise
-        except httpx.HTTPStatusError as e:
-            logger.exception("Synthesia API request failed")
-            if e.response.status_code == httpx.codes.TOO_MANY_REQUESTS:
-                # todo: update monitoring metrics
-                logger.warning("Synthesia API rate limit exceeded")
+        except SynthesiaRateLimitError:
             raise
         except Exception:
             logger.exception("Synthesia API request failed")
             raise
+        finally:
+            UPSTREAM_REQUEST_DURATION.labels(status).observe(time.perf_counter() - start)
+
+    async def verify_signature(self, request: SynthesiaVerifyRequest) -> SynthesiaVerifyResponse:
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with asyncio.timeout(self._config.timeout):
+                response = await self._client.get(
+                    self._config.verify_endpoint,
+                    params={"message": request.message, "signature": request.signature},
+                )
+            status = str(response.status_code)
+            logger.debug("Synthesia API verify response status: %d", response.status_code)
+            if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+                retry_after = _parse_retry_after(response.headers)
+                logger.warning(f"Synthesia API rate limit exceeded, retry after {retry_after}s")
+                raise SynthesiaRateLimitError(retry_after)
+            response.raise_for_status()
+            # anything but an explicit answer is an upstream error, it must never be taken or cached as valid
+            body = response.text.strip().lower()
+            if body not in ("true", "false"):
+                raise ValueError(f"Unexpected Synthesia API verify response: {response.text[:100]!r}")
+            return SynthesiaVerifyResponse(valid=body == "true", retry_after=_parse_retry_after(response.headers))
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            status = "timeout"
+            logger.exception("Synthesia API verify request timed out")
+            raise
+        except SynthesiaRateLimitError:
+            raise
+        except Exception:
+            logger.exception("Synthesia API verify request failed")
+            raise
+        finally:
+            UPSTREAM_VERIFY_DURATION.labels(status).observe(time.perf_counter() - start)
@@ -1,20 +1,190 @@
+from collections.abc import Callable
 from typing import NewType
+import asyncio
+import hashlib
+import json
+import logging
+import math
 
 from fastapi import HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from redis.asyncio.client import Redis
 
-from configs.config import SynthesiaAPIConfig
+from service.rate_limiter import RateLimiter
 
 
+logger = logging.getLogger(__name__)
+
 UserId = NewType("UserId", str)
 
 
 class AuthInfo(BaseModel):
     user_id: UserId
+    priority: str = "normal"
+    admin: bool = False
+
+
+class ApiKey(BaseModel):
+    user_id: UserId
+    # priority class, mapped to the user's fair scheduling weight
+    priority: str = "normal"
+    # requests per quota window, 0 falls back to the registry default
+    quota: int = 0
+    # may inspect and replay dead letters
+    admin: bool = False
+
+
+def hash_key(api_key: str) -> str:
+    # keys are only stored and looked up hashed
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class ApiKeyRegistry:
+    # api keys from a local JSON file and a redis hash, both keyed by key hash. the whole registry is held in
+    # process and refreshed periodically, so authentication never waits for redis. quotas are sliding windows
+    # in redis shared by all api processes, a registry without redis client doesn't enforce them
+    def __init__(
+        self,
+        redis_client: Redis | None = None,
+        redis_key: str = "api_keys",
+        file_path: str | None = None,
+        legacy_key: str | None = None,
+        default_quota: int = 0,
+        quota_window: float = 60,
+        refresh_interval: float = 30,
+        on_load: Callable[["ApiKeyRegistry"], None] | None = None,
+    ) -> None:
+        self._redis_client = redis_client
+        self._redis_key = redis_key
+        self._file_path = file_path
+        # single key from the environment, kept so existing clients still work
+        self._legacy_key = legacy_key
+        self._default_quota = default_quota
+        self._quota_window = quota_window
+        self._refresh_interval = refresh_interval
+        self._on_load = on_load
+        self._keys: dict[str, ApiKey] = {}
+        # key hash -> quota of the key and its window
+        self._quotas: dict[str, tuple[int, RateLimiter]] = {}
+        self._reload_pending = False
+        self._reload_task: asyncio.Task[None] | None = None
+
+    @staticmethod
+    def _parse(key_hash: str, data: str | bytes | dict) -> ApiKey | None:
+        try:
+            return ApiKey.model_validate_json(data) if isinstance(data, str | bytes) else ApiKey.model_validate(data)
+        except ValidationError as e:
+            logger.error(f"Invalid api key entry {key_hash[:8]}: {e}")
+            return None
+
+    def _load_file(self) -> dict[str, ApiKey]:
+        # {"keys": [{"key_hash": "<sha256 hex>" or "key": "<plain key>", "user_id": "42", ...}]}
+        keys = {}
+        with open(self._file_path) as f:
+            for entry in json.load(f).get("keys", []):
+                key = entry.pop("key", None)
+                key_hash = entry.pop("key_hash", None) or (hash_key(key) if key else None)
+                if key_hash is None:
+                    logger.error(f"Api key entry of user {entry.get('user_id')} has neither key nor key_hash")
+                    continue
+                if (api_key := self._parse(key_hash, entry)) is not None:
+                    keys[key_hash] = api_key
+        return keys
+
+    async def _load_redis(self) -> dict[str, ApiKey]:
+        # hash field is the key hash, value the JSON encoded ApiKey
+        keys = {}
+        for key_hash, data in (await self._redis_client.hgetall(self._redis_key)).items():
+            key_hash = key_hash.decode("utf-8") if isinstance(key_hash, bytes) else key_hash
+            if (api_key := self._parse(key_hash, data)) is not None:
+                keys[key_hash] = api_key
+        return keys
+
+    async def load(self) -> None:
+        keys = {}
+        if self._legacy_key:
+            # shared by existing clients, so it is never an admin key
+            keys[hash_key(self._legacy_key)] = ApiKey(user_id=UserId("1"))
+        if self._file_path:
+            keys.update(self._load_file())
+        if self._redis_client is not None:
+            keys.update(await self._load_redis())
+        self._keys = keys
+        for key_hash in self._quotas.keys() - keys.keys():
+            del self._quotas[key_hash]
+        logger.info(f"Loaded {len(keys)} api keys")
+        if self._on_load is not None:
+            self._on_load(self)
+
+    async def refresh(self) -> None:
+        # picks up added, changed and revoked keys
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+            try:
+                await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Failed to refresh api keys, keeping the loaded ones: {e}")
+
+    def invalidate(self, key: str | None) -> None:
+        # keys changed in redis are picked up right away instead of on the next refresh
+        if key is not None and key != self._redis_key:
+            return
+        self._reload_pending = True
+        if self._reload_task is None or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload())
+
+    async def _reload(self) -> None:
+        # changes arriving during a load trigger one more load
+        while self._reload_pending:
+            self._reload_pending = False
+            try:
+                await self.load()
+            except Exception as e:
+                logger.exception(f"Failed to reload api keys, keeping the loaded ones: {e}")
+
+    def user_weights(self, priority_weights: dict[str, float]) -> dict[str, float]:
+        # fair scheduling weight of each user, from the highest priority class of the user's keys
+        weights: dict[str, float] = {}
+        for api_key in self._keys.values():
+            weight = priority_weights.get(api_key.priority, 1)
+            weights[api_key.user_id] = max(weight, weights.get(api_key.user_id, weight))
+        return weights
 
+    def _quota(self, key_hash: str, quota: int) -> RateLimiter:
+        current = self._quotas.get(key_hash)
+        if current is not None and current[0] == quota:
+            return current[1]
+        limiter = RateLimiter(
+            self._redis_client,
+            limit=quota,
+            window=self._quota_window,
+            name=f"rate_limiter:api_key:{key_hash}",
+            scope="api_key",
+        )
+        self._quotas[key_hash] = (quota, limiter)
+        return limiter
 
-def get_auth_info(authorization: str, config: SynthesiaAPIConfig) -> AuthInfo:
-    # this is dummy verification just for task, user_id is hardcoded
-    if authorization != config.api_key:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    return AuthInfo(user_id="1")
+    async def authenticate(self, authorization: str, cost: int = 1) -> AuthInfo:
+        # rejects unknown keys and keys over their quota before the request reaches the rate limiter or the queue.
+        # cost is taken from the quota as a whole or not at all, a cost the quota can never cover is rejected
+        key_hash = hash_key(authorization)
+        api_key = self._keys.get(key_hash)
+        if api_key is None:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+        quota = api_key.quota or self._default_quota
+        if quota > 0 and cost > 0 and self._redis_client is not None:
+            if cost > quota:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Request costs {cost} of an API key quota of {quota} per {self._quota_window:g}s",
+                )
+            allowed, retry_after = await self._quota(key_hash, quota).try_acquire(key_hash[:8], cost)
+            if not allowed:
+                raise HTTPException(
+                    status_code=429,
+                    detail="API key quota exceeded",
+                    headers={"Retry-After": str(math.ceil(retry_after))},
+                )
+        return AuthInfo(user_id=api_key.user_id, priority=api_key.priority, admin=api_key.admin)
@@ -0,0 +1,100 @@
+from abc import ABC, abstractmethod
+from types import ModuleType
+from typing import Any
+import json
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# records are stored as arrays, values written before the codec as JSON objects
+Encodable = list[Any] | dict[str, Any]
+
+# optional, pip install orjson msgpack
+orjson: ModuleType | None
+msgpack: ModuleType | None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(ABC):
+    # encoded values start with a format and layout version tag, so values written by another codec or by
+    # an older release stay readable. untagged values are JSON objects written before the tags existed
+    tag = b""
+
+    def dumps(self, value: Encodable) -> bytes:
+        return self.tag + self._dumps(value)
+
+    @abstractmethod
+    def _dumps(self, value: Encodable) -> bytes: ...
+
+    @abstractmethod
+    def _loads(self, data: bytes) -> Encodable: ...
+
+
+class JsonCodec(Codec):
+    tag = b"j1"
+
+    def _dumps(self, value: Encodable) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+    def _loads(self, data: bytes) -> Encodable:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    # same format as JsonCodec, encoded and decoded several times faster
+    def _dumps(self, value: Encodable) -> bytes:
+        return orjson.dumps(value)
+
+    def _loads(self, data: bytes) -> Encodable:
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    tag = b"m1"
+
+    def _dumps(self, value: Encodable) -> bytes:
+        return msgpack.packb(value)
+
+    def _loads(self, data: bytes) -> Encodable:
+        return msgpack.unpackb(data)
+
+
+def _json_codec() -> JsonCodec:
+    return OrjsonCodec() if orjson is not None else JsonCodec()
+
+
+def get_codec(name: str) -> Codec:
+    if name == "msgpack":
+        if msgpack is not None:
+            return MsgpackCodec()
+        logger.warning("msgpack codec requested but msgpack is not installed, falling back to json")
+    elif name != "json":
+        raise ValueError(f"Unknown codec {name}, expected json or msgpack")
+    return _json_codec()
+
+
+_DECODERS: dict[bytes, Codec] = {JsonCodec.tag: _json_codec()}
+if msgpack is not None:
+    _DECODERS[MsgpackCodec.tag] = MsgpackCodec()
+
+
+def loads(data: bytes | str) -> Encodable:
+    # decodes values of every codec, whichever one is configured for writing
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if data[:1] == b"{":
+        return json.loads(data)
+    codec = _DECODERS.get(data[:2])
+    if codec is None and data[:2] == MsgpackCodec.tag:
+        raise RuntimeError("Value was written with the msgpack codec but msgpack is not installed")
+    if codec is None:
+        raise ValueError(f"Unknown codec tag {data[:2]!r}")
+    return codec._loads(data[2:])
@@ -0,0 +1,88 @@
+from collections.abc import Callable
+import asyncio
+import logging
+
+from redis.asyncio.client import Redis
+
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "__redis__:invalidate"
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class InvalidationListener:
+    # server assisted client side caching in broadcasting mode. redis publishes the names of changed, deleted and
+    # expired keys under the registered prefixes, so in process copies are dropped as soon as redis changes.
+    # a dedicated connection owns the tracking and redirects the invalidations to a subscribed pubsub connection
+    def __init__(self, redis_client: Redis, check_interval: float = 5) -> None:
+        self._redis_client = redis_client
+        # how often the tracking connection is checked, it is dropped silently if either connection reconnects
+        self._check_interval = check_interval
+        # key prefix -> callback called with the invalidated key, or None when everything must be dropped
+        self._callbacks: dict[str, Callable[[str | None], None]] = {}
+
+    def register(self, prefix: str, callback: Callable[[str | None], None]) -> None:
+        self._callbacks[prefix] = callback
+
+    def _invalidate(self, keys: list[str] | None) -> None:
+        for prefix, callback in self._callbacks.items():
+            try:
+                if keys is None:
+                    callback(None)
+                    continue
+                for key in keys:
+                    if key.startswith(prefix):
+                        callback(key)
+            except Exception as e:
+                logger.exception(f"Invalidation callback of prefix {prefix} failed: {e}")
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                await self._listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis client tracking interrupted, dropping in process copies: {e}")
+            # changes made while tracking was off were missed
+            self._invalidate(None)
+            await asyncio.sleep(1)
+
+    async def _listen(self) -> None:
+        pubsub = self._redis_client.pubsub()
+        tracking = self._redis_client.client()
+        try:
+            # invalidations are redirected to the pubsub connection by id, which can't be asked once subscribed
+            await pubsub.connect()
+            await pubsub.connection.send_command("CLIENT", "ID")
+            client_id = await pubsub.connection.read_response()
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            await tracking.client_tracking(on=True, clientid=client_id, prefix=list(self._callbacks), bcast=True)
+            logger.info(f"Redis client tracking enabled for prefixes {list(self._callbacks)}")
+            # copies made before tracking was enabled are not covered
+            self._invalidate(None)
+            loop = asyncio.get_running_loop()
+            next_check_at = loop.time() + self._check_interval
+            while True:
+                message = await pubsub.get_message(timeout=self._check_interval)
+                if message is not None and message["type"] == "message":
+                    keys = message["data"]
+                    # None means the whole database was flushed
+                    self._invalidate(None if keys is None else [_decode(key) for key in keys])
+                if loop.time() >= next_check_at:
+                    await self._check(tracking)
+                    next_check_at = loop.time() + self._check_interval
+        finally:
+            await pubsub.aclose()
+            await tracking.aclose()
+
+    async def _check(self, tracking: Redis) -> None:
+        info = await tracking.execute_command("CLIENT", "TRACKINGINFO")
+        fields = dict(zip((_decode(name) for name in info[::2]), info[1::2], strict=True))
+        flags = {_decode(flag) for flag in fields.get("flags", [])}
+        if "off" in flags or "broken_redirect" in flags:
+            raise ConnectionError(f"Tracking connection lost its state, flags {sorted(flags)}")
@@ -0,0 +1,27 @@
+from collections.abc import Awaitable, Callable
+import logging
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+
+logger = logging.getLogger(__name__)
+
+# seconds, covers fast cache backed paths up to the upstream timeout
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# refresh gauges read from redis right before a scrape, so hot paths don't pay for them
+_collectors: list[Callable[[], Awaitable[None]]] = []
+
+
+def add_collector(collector: Callable[[], Awaitable[None]]) -> None:
+    _collectors.append(collector)
+
+
+async def render() -> tuple[bytes, str]:
+    # prometheus text exposition of the default registry and its content type
+    for collector in _collectors:
+        try:
+            await collector()
+        except Exception as e:
+            logger.exception(f"Metrics collector failed: {e}")
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
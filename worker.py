@@ -0,0 +1,161 @@
+from collections.abc import Generator
+import asyncio
+import contextlib
+import logging
+import signal
+
+from fastapi.responses import PlainTextResponse
+import fastapi
+import uvicorn
+
+from configs.config import (
+    LoggingConfig,
+    QueueConfig,
+    RedisConfig,
+    ResultConfig,
+    SynthesiaAPIConfig,
+    WorkerConfig,
+)
+from configs.logging import setup_logging
+from service.components import (
+    create_api_keys,
+    create_cache,
+    create_dead_letters,
+    create_invalidation_listener,
+    create_queue_processor,
+    create_rate_limiter,
+    create_redis,
+    create_webhook_manager,
+)
+from service.queue import RequestProcessingQueue
+from service.results import ResultStore
+from service.scheduler import FairScheduler
+from upstream.synthesia_api import SynthesiaAPI
+from utils.codec import get_codec
+from utils.helpers import is_docker
+from utils.metrics import add_collector, render as render_metrics
+
+
+# standalone queue worker, processes queued sign requests and webhook deliveries enqueued by api processes
+# started with API_RUN_WORKERS=false. scale it to the upstream budget, independently of the api processes
+
+logging_config = LoggingConfig()
+setup_logging(
+    app_name="signing_worker",
+    log_level=logging_config.level,
+    log_dir=logging_config.dir,
+    json_format=logging_config.json,
+    debug_sample_rate=logging_config.debug_sample_rate,
+    use_queue=logging_config.use_queue,
+)
+logger = logging.getLogger(__name__)
+
+metrics_app = fastapi.FastAPI(title="Synthesia Crypto Signing Worker")
+
+
+class MetricsServer(uvicorn.Server):
+    # signals are handled by the worker, which drains its tasks before stopping the metrics endpoint
+    @contextlib.contextmanager
+    def capture_signals(self) -> Generator[None, None, None]:
+        yield
+
+    def install_signal_handlers(self) -> None:
+        # uvicorn before 0.29
+        pass
+
+
+@metrics_app.get("/metrics", response_class=PlainTextResponse, description="Prometheus metrics")
+async def metrics() -> PlainTextResponse:
+    body, content_type = await render_metrics()
+    return PlainTextResponse(body, media_type=content_type)
+
+
+async def main() -> None:
+    logger.info("Worker startup")
+    if not is_docker():
+        raise EnvironmentError("This service must be run in a Docker container.")
+    worker_config = WorkerConfig()
+    redis_config = RedisConfig()
+    redis_client = create_redis(redis_config)
+    rate_limiter = create_rate_limiter(redis_client)
+    queue_config = QueueConfig()
+    queue = RequestProcessingQueue(
+        queue_config.name,
+        redis_client,
+        codec=get_codec(queue_config.codec),
+        scheduling_sample=queue_config.scheduling_sample,
+    )
+    await queue.migrate()
+    synthesia_config = SynthesiaAPIConfig()
+    upstream_api = SynthesiaAPI(synthesia_config)
+    cache = create_cache(redis_client, redis_config)
+    dead_letters = create_dead_letters(redis_client, queue_config)
+    webhook_manager = create_webhook_manager(redis_client, redis_config, dead_letters)
+    results = ResultStore(redis_client, ttl=ResultConfig().ttl)
+    scheduler = FairScheduler(queue_config.user_weights)
+    # api keys are only loaded for the fair scheduling weights of their priority classes
+    api_keys = create_api_keys(redis_client, scheduler, queue_config, synthesia_config.api_key)
+    await api_keys.load()
+    queue_processor = create_queue_processor(
+        redis_client,
+        redis_config,
+        queue_config,
+        queue,
+        upstream_api,
+        rate_limiter,
+        cache,
+        webhook_manager,
+        results,
+        scheduler,
+        dead_letters,
+    )
+    add_collector(queue.collect_metrics)
+    add_collector(rate_limiter.collect_metrics)
+    add_collector(webhook_manager.collect_metrics)
+    add_collector(dead_letters.collect_metrics)
+
+    tasks = [
+        asyncio.create_task(queue_processor.process()),
+        asyncio.create_task(webhook_manager.process()),
+        asyncio.create_task(api_keys.refresh()),
+    ]
+    if redis_config.client_tracking:
+        tasks.append(asyncio.create_task(create_invalidation_listener(redis_client, cache, api_keys).listen()))
+    metrics_server = None
+    metrics_task = None
+    if worker_config.metrics_port > 0:
+        metrics_server = MetricsServer(
+            uvicorn.Config(metrics_app, host="0.0.0.0", port=worker_config.metrics_port, log_level="warning")
+        )
+        metrics_task = asyncio.create_task(metrics_server.serve())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    stop_task = asyncio.create_task(stop.wait())
+    try:
+        # a background task only finishes on a fatal error
+        done, _ = await asyncio.wait(
+            [stop_task, *tasks, *([metrics_task] if metrics_task else [])],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in done:
+            if task is not stop_task and task.exception() is not None:
+                logger.error(f"Worker task failed, shutting down: {task.exception()}")
+    finally:
+        logger.info("Worker shutdown")
+        stop_task.cancel()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if metrics_server is not None and metrics_task is not None:
+            metrics_server.should_exit = True
+            await asyncio.gather(metrics_task, return_exceptions=True)
+        await webhook_manager.close()
+        await upstream_api.close()
+        await redis_client.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())